@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Benchmark create_keystone_users against a local stand-in for Keystone.
+
+A small HTTP server implementing the v2 token, tenant, user and role
+endpoints the script calls runs in its own process, seeded with a
+directory of unrelated tenants and users and adding a fixed latency to
+every request. Each scenario provisions a synthetic set of users into a
+fresh stand-in, then runs again to measure a converged re-run, and
+reports the requests the stand-in served and the wall time of each pass.
+Everything runs offline on one box.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import re
+import threading
+import time
+import uuid
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from keystoneclient.auth.identity import v2
+from keystoneclient.v2_0 import client
+
+# Local imports
+import create_keystone_users
+
+LOG = logging.getLogger(__name__)
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark'
+TENANT = 'benchmark'
+ROLES = ('admin', '_member_')
+OPERATIONS = (
+    ('GET', r'/$', 'discovery'),
+    ('GET', r'/v2\.0/?$', 'discovery'),
+    ('POST', r'/v2\.0/tokens$', 'token'),
+    ('GET', r'/v2\.0/tenants$', 'list tenants'),
+    ('POST', r'/v2\.0/tenants$', 'create tenant'),
+    ('GET', r'/v2\.0/tenants/(\w+)$', 'get tenant'),
+    ('GET', r'/v2\.0/users$', 'list users'),
+    ('POST', r'/v2\.0/users$', 'create user'),
+    ('GET', r'/v2\.0/users/(\w+)$', 'get user'),
+    ('GET', r'/v2\.0/OS-KSADM/roles$', 'list roles'),
+    ('GET', r'/v2\.0/tenants/(\w+)/users/(\w+)/roles$', 'roles for user'),
+    ('PUT', r'/v2\.0/tenants/(\w+)/users/(\w+)/roles/OS-KSADM/(\w+)$',
+     'grant role'),
+)
+
+
+class StandInKeystone(object):
+    """
+    In-memory Keystone v2 directory. Names are unique like in Keystone,
+    creating a duplicate or granting a role twice is a 409 Conflict.
+    """
+
+    def __init__(self, seed_size):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.tenants = {}
+        self.users = {}
+        self.roles = {}
+        self.grants = {}
+        self.names = {'tenants': set(), 'users': set(), 'roles': set()}
+        for name in ROLES:
+            self.add('roles', {'name': name})
+        for n in range(seed_size):
+            self.add('tenants', {'name': 'seed-tenant-{0}'.format(n),
+                                 'enabled': True})
+            self.add('users', {'name': 'seed-user-{0}'.format(n),
+                               'enabled': True})
+
+    def add(self, kind, obj):
+        if obj['name'] in self.names[kind]:
+            return None
+        self.names[kind].add(obj['name'])
+        obj['id'] = uuid.uuid4().hex
+        getattr(self, kind)[obj['id']] = obj
+        return obj
+
+    def handle(self, method, path, body, url):
+        """
+        Serve one request
+
+        :return (tuple): HTTP status and JSON body
+        """
+
+        for op_method, pattern, operation in OPERATIONS:
+            match = re.match(pattern, path)
+            if op_method == method and match:
+                break
+        else:
+            return 404, {'error': {'code': 404, 'message': path}}
+        with self.lock:
+            self.calls[operation] += 1
+            return getattr(self, operation.replace(' ', '_'))(
+                body, url, *match.groups())
+
+    def discovery(self, body, url):
+        version = {'id': 'v2.0', 'status': 'stable',
+                   'updated': '2014-04-17T00:00:00Z', 'media-types': [],
+                   'links': [{'rel': 'self', 'href': url + '/v2.0/'}]}
+        return 200, {'version': version}
+
+    def token(self, body, url):
+        endpoint = url + '/v2.0'
+        return 200, {'access': {
+            'token': {'id': uuid.uuid4().hex,
+                      'expires': '2099-01-01T00:00:00Z',
+                      'tenant': {'id': TENANT, 'name': TENANT}},
+            'user': {'id': USERNAME, 'name': USERNAME, 'roles': []},
+            'serviceCatalog': [{
+                'type': 'identity', 'name': 'keystone',
+                'endpoints': [{'adminURL': endpoint, 'publicURL': endpoint,
+                               'internalURL': endpoint,
+                               'region': 'RegionOne'}]}],
+            'metadata': {}}}
+
+    def list_tenants(self, body, url):
+        return 200, {'tenants': list(self.tenants.values())}
+
+    def create_tenant(self, body, url):
+        tenant = self.add('tenants', dict(body['tenant']))
+        if not tenant:
+            return 409, {'error': {'code': 409, 'message': 'Conflict'}}
+        return 200, {'tenant': tenant}
+
+    def get_tenant(self, body, url, tenant_id):
+        if tenant_id not in self.tenants:
+            return 404, {'error': {'code': 404, 'message': tenant_id}}
+        return 200, {'tenant': self.tenants[tenant_id]}
+
+    def list_users(self, body, url):
+        return 200, {'users': list(self.users.values())}
+
+    def create_user(self, body, url):
+        user = dict(body['user'])
+        user.pop('password', None)
+        user = self.add('users', user)
+        if not user:
+            return 409, {'error': {'code': 409, 'message': 'Conflict'}}
+        return 200, {'user': user}
+
+    def get_user(self, body, url, user_id):
+        if user_id not in self.users:
+            return 404, {'error': {'code': 404, 'message': user_id}}
+        return 200, {'user': self.users[user_id]}
+
+    def list_roles(self, body, url):
+        return 200, {'roles': list(self.roles.values())}
+
+    def roles_for_user(self, body, url, tenant_id, user_id):
+        return 200, {'roles': [self.roles[role_id] for role_id in
+                               self.grants.get((tenant_id, user_id), ())]}
+
+    def grant_role(self, body, url, tenant_id, user_id, role_id):
+        if tenant_id not in self.tenants or user_id not in self.users or \
+                role_id not in self.roles:
+            return 404, {'error': {'code': 404, 'message': 'Not found'}}
+        granted = self.grants.setdefault((tenant_id, user_id), set())
+        if role_id in granted:
+            return 409, {'error': {'code': 409, 'message': 'Conflict'}}
+        granted.add(role_id)
+        return 200, {'role': self.roles[role_id]}
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, with Nagle's algorithm
+    # the body waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        LOG.debug(format, *args)
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        path = self.path.split('?')[0]
+        if path == '/_calls':
+            code, reply = 200, dict(self.server.keystone.calls)
+        else:
+            time.sleep(self.server.latency)
+            code, reply = self.server.keystone.handle(
+                self.command, path, body,
+                'http://{0}:{1}'.format(*self.server.server_address))
+        data = json.dumps(reply).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = respond
+
+
+def serve(seed_size, latency, ready):
+    """
+    Run the stand-in Keystone until the process is terminated
+
+    :param seed_size: Number of unrelated tenants and users to start with
+    :param latency: Latency to add to every request, in seconds
+    :param ready (multiprocessing.Queue): Receives the server's port
+    """
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.keystone = StandInKeystone(seed_size)
+    server.latency = latency
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def synthetic_users(count, seed=0):
+    """
+    Build a users mapping in the format of KEYSTONE_USERS. Users are spread
+    over count / 20 tenants, a third of them belong to two tenants and
+    every 50th is also an admin.
+
+    :param count: Number of users
+    :return (dict):
+    """
+
+    rng = random.Random(seed)
+    tenants = max(count // 20, 1)
+    users = {}
+    for n in range(count):
+        roles = ['_member_'] + (['admin'] if n % 50 == 0 else [])
+        user_tenants = ['tenant-{0}'.format(rng.randrange(tenants))
+                        for _ in range(2 if n % 3 == 0 else 1)]
+        users['user-{0}'.format(n)] = {'roles': roles,
+                                       'tenants': sorted(set(user_tenants))}
+    return users
+
+
+def calls(port):
+    return requests.get('http://127.0.0.1:{0}/_calls'.format(port)).json()
+
+
+def run_pass(port, users, workers, retries):
+    """
+    Run the script's plan and apply steps once against the stand-in
+
+    :return (dict): Changes planned, failures, wall time and the requests
+                    served per operation
+    """
+
+    before = Counter(calls(port))
+    start = time.monotonic()
+    auth = v2.Password(auth_url='http://127.0.0.1:{0}/v2.0'.format(port),
+                       username=USERNAME, password=PASSWORD,
+                       tenant_name=TENANT)
+    keystone = client.Client(
+        session=create_keystone_users.make_session(auth, workers))
+    index = create_keystone_users.KeystoneIndex(keystone)
+    plan = create_keystone_users.make_plan(keystone, index, users, workers,
+                                           retries)
+    failures = create_keystone_users.apply_plan(keystone, index, plan,
+                                                workers, retries)
+    elapsed = time.monotonic() - start
+    operations = Counter(calls(port))
+    operations.subtract(before)
+    return {'changes': sum(len(plan[kind]) for kind in
+                           ('tenants', 'users', 'grants')),
+            'failures': failures + len(plan['errors']), 'seconds': elapsed,
+            'requests': sum(operations.values()),
+            'operations': dict((operation, count) for operation, count
+                               in operations.items() if count)}
+
+
+def report(results):
+    """
+    Print a table of requests and wall time for the scenarios
+
+    :param results (list):
+    """
+
+    print('{0:>6} {1:>7} {2:<9} {3:>8} {4:>9} {5:>9} {6:>9}'.format(
+        'users', 'workers', 'pass', 'changes', 'requests', 'seconds',
+        'req/s'))
+    for result in results:
+        print('{0:>6} {1:>7} {2:<9} {3:>8} {4:>9} {5:>9.2f} {6:>9.1f}'.format(
+            result['users'], result['workers'], result['pass'],
+            result['changes'], result['requests'], result['seconds'],
+            result['requests'] / result['seconds']))
+        for operation, count in sorted(result['operations'].items()):
+            print('    {0:<16} {1:>8}'.format(operation, count))
+        if result['failures']:
+            print('    {0} changes failed'.format(result['failures']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--users', action='store',
+        default='10,100,1000,10000',
+        help="Comma separated numbers of users to provision")
+    parser.add_argument(
+        '--seed-size', action='store',
+        default=1000,
+        type=int,
+        help="Number of unrelated tenants and users already in the "
+             "stand-in's directory")
+    parser.add_argument(
+        '--latency-ms', action='store',
+        default=0,
+        type=float,
+        help="Latency added to every request")
+    parser.add_argument(
+        '--workers', action='store',
+        default='1,{0}'.format(create_keystone_users.WORKERS),
+        help="Comma separated worker counts to run each workload with")
+    parser.add_argument(
+        '--retries', action='store',
+        default=create_keystone_users.RETRIES,
+        type=int,
+        help="Retries of a request answered with 409 or 5xx")
+    parser.add_argument(
+        '--json', action='store',
+        help="Also write the raw results to this JSON file")
+    parser.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="Increase verbosity (specify multiple times for more)")
+    args = parser.parse_args()
+
+    log_level = logging.WARNING
+    if args.verbose >= 1:
+        log_level = logging.INFO
+    if args.verbose >= 2:
+        log_level = logging.DEBUG
+
+    format = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(format=format, datefmt='%m-%d %H:%M', level=log_level)
+    create_keystone_users.LOG.setLevel(log_level)
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for count in args.users.split(','):
+        users = synthetic_users(int(count))
+        for workers in args.workers.split(','):
+            ready = context.Queue()
+            server = context.Process(target=serve, daemon=True, args=(
+                args.seed_size, args.latency_ms / 1000.0, ready))
+            server.start()
+            port = ready.get()
+            try:
+                for name in ('provision', 'rerun'):
+                    result = run_pass(port, users, int(workers),
+                                      args.retries)
+                    result.update({'users': int(count),
+                                   'workers': int(workers), 'pass': name})
+                    results.append(result)
+            finally:
+                server.terminate()
+                server.join()
+
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'seed_size': args.seed_size,
+                       'latency_ms': args.latency_ms, 'results': results},
+                      json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,38 @@
 #!/usr/bin/env python
+import argparse
+import json
 import logging
 import os
 import random
 import re
 import string
+import sys
+import time
+from concurrent import futures
+import requests
 from keystoneclient.auth.identity import v2
+from keystoneclient import exceptions
 from keystoneclient import session
 from keystoneclient.v2_0 import client
 
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s',
                     datefmt='%m-%d %H:%M')
 LOG = logging.getLogger(__name__)
 LOG.setLevel('INFO')
 
+WORKERS = 8
+RETRIES = 4
+RETRY_BACKOFF = 0.5
+RETRY_ERRORS = (exceptions.Conflict, exceptions.HttpServerError)
+# A create or grant that conflicts found the name taken or the role
+# already granted, retrying can't change that
+CREATE_RETRY_ERRORS = (exceptions.HttpServerError,)
+
 KEYSTONE_USERS = {
     'admin_user': {
         'roles': ['admin', '_member_'],
@@ -37,57 +57,284 @@ KEYSTONE_USERS = {
 }
 
 
-def create_tenant(client, tenant_name):
-    try:
-        tenant = None
-        tenant_list = client.tenants.list()
-        for tenant_class in tenant_list:
-            if tenant_name == tenant_class.name:
-                LOG.info('Found tenant {0}'.format(tenant_class.name))
-                tenant = tenant_class
-        if not tenant:
-            LOG.info('Created tenant {0}'.format(tenant_class.name))
-            tenant = client.tenants.create(tenant_name, enabled=True)
+class KeystoneIndex(object):
+    """
+    Tenants, users and roles keyed by name, listed once per run and kept
+    up to date as objects are created, so lookups make no API calls
+    """
+
+    def __init__(self, client):
+        self.tenants = dict((tenant.name, tenant)
+                            for tenant in client.tenants.list())
+        self.users = dict((user.name, user) for user in client.users.list())
+        self.roles = dict((role.name, role) for role in client.roles.list())
+        LOG.info('Indexed {0} tenants, {1} users and {2} roles'.format(
+            len(self.tenants), len(self.users), len(self.roles)))
+
+
+def make_session(auth, workers=WORKERS):
+    """
+    Keystone session whose keep-alive connection pool holds a connection
+    for each worker, requests keeps only 10 per host by default
+
+    :param auth: Keystone auth plugin
+    :param workers: Number of threads sharing the session
+    """
+
+    http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+    http.mount('http://', adapter)
+    http.mount('https://', adapter)
+    return session.Session(auth=auth, session=http)
+
+
+def retry(retries, func, *args, errors=RETRY_ERRORS, **kwargs):
+    """
+    Call func, retrying with exponential backoff and jitter while Keystone
+    answers with one of errors, 409 Conflict or a 5xx error by default.
+    The last error is raised.
+
+    :param retries: Number of retries after the first attempt
+    :param errors (tuple): The exceptions to retry on
+    """
+
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except errors as e:
+            if attempt == retries:
+                raise
+            delay = RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+            LOG.warning('{0}, retrying in {1:.1f}s'.format(e, delay))
+            time.sleep(delay)
+
+
+def create_tenant(client, index, tenant_name, retries=RETRIES):
+    tenant = index.tenants.get(tenant_name)
+    if tenant:
+        LOG.info('Found tenant {0}'.format(tenant_name))
         return tenant
+    try:
+        tenant = retry(retries, client.tenants.create, tenant_name,
+                       enabled=True, errors=CREATE_RETRY_ERRORS)
+        # The response holds the whole tenant, without this reading an
+        # attribute it lacks fetches it again
+        tenant.set_loaded(True)
+        LOG.info('Created tenant {0}'.format(tenant_name))
+    except exceptions.Conflict:
+        # Created by someone else since the index was read
+        try:
+            tenant = client.tenants.find(name=tenant_name)
+            LOG.info('Found tenant {0}'.format(tenant_name))
+        except Exception as e:
+            LOG.error('Tenant creation failed {0}'.format(e))
+            return None
     except Exception as e:
         LOG.error('Tenant creation failed {0}'.format(e))
+        return None
+    index.tenants[tenant_name] = tenant
+    return tenant
 
 
-def create_user(client, tenant, username):
-    try:
-        user = None
-        user_list = client.users.list()
-        for user_class in user_list:
-            if username == user_class.name:
-                user = user_class
-        if not user:
-            user = client.users.create(name=username, password=None,
-                                       tenant_id=tenant.id)
+def create_user(client, index, tenant, username, retries=RETRIES):
+    user = index.users.get(username)
+    if user:
         return user
+    try:
+        user = retry(retries, client.users.create, name=username,
+                     password=None, tenant_id=tenant.id,
+                     errors=CREATE_RETRY_ERRORS)
+        user.set_loaded(True)
+    except exceptions.Conflict:
+        try:
+            user = client.users.find(name=username)
+        except Exception as e:
+            LOG.error('User creation failed {0}'.format(e))
+            return None
     except Exception as e:
         LOG.error('User creation failed {0}'.format(e))
+        return None
+    index.users[username] = user
+    return user
+
 
+def add_role(client, index, username, tenant_name, role_name,
+             retries=RETRIES):
+    """
+    Grant a role to a user in a tenant, both already in the index.
+    Returns True when the user holds the role afterwards.
+    """
 
-def add_roles(client, user, tenant, role_list):
-    user_roles = client.roles.roles_for_user(user, tenant)
-    for role_name in role_list:
-        LOG.info('role_name is {0}'.format(role_name))
+    user = index.users.get(username)
+    tenant = index.tenants.get(tenant_name)
+    if not user or not tenant:
+        return False
+    try:
+        retry(retries, client.roles.add_user_role, user,
+              index.roles[role_name], tenant, errors=CREATE_RETRY_ERRORS)
+        LOG.info('Added user {0} to role {1} in tenant {2}'.format(
+            username, role_name, tenant_name))
+    except exceptions.Conflict:
+        LOG.info('User {0} already has role {1} in tenant {2}'.format(
+            username, role_name, tenant_name))
+    except Exception as e:
+        LOG.error('Role add failed {0}'.format(e))
+        return False
+    return True
+
+
+def load_users(path):
+    """
+    Read the desired users from a JSON or YAML file, in the format of
+    KEYSTONE_USERS
+    """
+
+    with open(path) as users_file:
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ValueError('PyYAML is needed to read {0}'.format(path))
+            users = yaml.safe_load(users_file)
+        else:
+            users = json.load(users_file)
+    if not isinstance(users, dict):
+        raise ValueError('{0} does not map usernames to their roles and '
+                         'tenants'.format(path))
+    return users
+
+
+def make_plan(client, index, users, workers=WORKERS, retries=RETRIES):
+    """
+    Diff the desired users against the index and the current role grants
+    of the user/tenant pairs that already exist, reading those grants on
+    a pool of workers. Returns the tenants to create, the users to create
+    with their default tenant, the (username, tenant_name, role_name)
+    grants to add and the errors that keep part of the users from being
+    planned, such as unknown roles or roles that couldn't be read.
+    """
+
+    def current_roles(pair):
+        user = index.users.get(pair[0])
+        tenant = index.tenants.get(pair[1])
+        if not user or not tenant:
+            return set()
         try:
-            role = client.roles.find(name=role_name)
-            if role not in user_roles:
-                LOG.info('Adding user {0} to role {1} '
-                         'in tenant is {2}'.format(user.name, role.name,
-                                                   tenant.name))
-                client.roles.add_user_role(user, role, tenant)
-            else:
-                LOG.info('User {0} already has role {1} '
-                         'in tenant {1}'.format(user.name, role.name,
-                                                tenant.name))
+            return set(role.id for role in retry(
+                retries, client.roles.roles_for_user, user, tenant))
         except Exception as e:
-            LOG.error('Role add failed {0}'.format(e))
+            # One unreadable pair mustn't stop the others being planned
+            return e
+
+    plan = {'tenants': [], 'users': [], 'grants': [], 'errors': []}
+    pairs = []
+    for username, user_data in sorted(users.items()):
+        tenants = user_data.get('tenants') or []
+        roles = user_data.get('roles') or []
+        for tenant_name in tenants:
+            if tenant_name not in index.tenants and \
+                    tenant_name not in plan['tenants']:
+                plan['tenants'].append(tenant_name)
+            pairs.append((username, tenant_name, roles))
+        if username not in index.users and tenants:
+            plan['users'].append((username, tenants[0]))
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for (username, tenant_name, roles), current in zip(
+                pairs, executor.map(current_roles, pairs)):
+            if isinstance(current, Exception):
+                plan['errors'].append(
+                    'Cannot read the roles of user {0} in tenant {1}: '
+                    '{2}'.format(username, tenant_name, current))
+                continue
+            for role_name in roles:
+                role = index.roles.get(role_name)
+                if not role:
+                    plan['errors'].append(
+                        'Role {0} of user {1} does not exist'.format(
+                            role_name, username))
+                elif role.id not in current:
+                    plan['grants'].append((username, tenant_name,
+                                           role_name))
+    return plan
+
+
+def print_plan(plan):
+    for tenant_name in plan['tenants']:
+        print('+ tenant {0}'.format(tenant_name))
+    for username, tenant_name in plan['users']:
+        print('+ user {0} (tenant {1})'.format(username, tenant_name))
+    for username, tenant_name, role_name in plan['grants']:
+        print('+ role {0} for user {1} in tenant {2}'.format(
+            role_name, username, tenant_name))
+    for error in plan['errors']:
+        print('! {0}'.format(error))
+    print('Plan: {0} tenants, {1} users, {2} role grants, {3} errors'.format(
+        len(plan['tenants']), len(plan['users']), len(plan['grants']),
+        len(plan['errors'])))
+
+
+def apply_plan(client, index, plan, workers=WORKERS, retries=RETRIES):
+    """
+    Make the creates and grants of a plan on a pool of workers. The
+    tenants are all created before any user, and the users before any
+    grant, since each phase needs the ids of the one before.
+    Returns the number of failed changes.
+
+    :param workers: Maximum number of concurrent requests to Keystone
+    :param retries: Retries of a request answered with 409 or 5xx
+    """
+
+    def create_plan_user(username, tenant_name):
+        tenant = index.tenants.get(tenant_name)
+        return tenant and create_user(client, index, tenant, username,
+                                      retries)
+
+    failures = 0
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = [executor.submit(create_tenant, client, index, tenant_name,
+                                retries)
+                for tenant_name in plan['tenants']]
+        failures += sum(1 for job in jobs if not job.result())
+        jobs = [executor.submit(create_plan_user, username, tenant_name)
+                for username, tenant_name in plan['users']]
+        failures += sum(1 for job in jobs if not job.result())
+        jobs = [executor.submit(add_role, client, index, username,
+                                tenant_name, role_name, retries)
+                for username, tenant_name, role_name in plan['grants']]
+        failures += sum(1 for job in jobs if not job.result())
+    return failures
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--users', action='store',
+        help="JSON or YAML file mapping each username to its roles and "
+             "tenants, the built-in KEYSTONE_USERS when not set")
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        default=False,
+        help="Only print the plan of changes")
+    parser.add_argument(
+        '--workers', action='store', type=int,
+        default=WORKERS,
+        help="Maximum number of concurrent requests to Keystone")
+    parser.add_argument(
+        '--retries', action='store', type=int,
+        default=RETRIES,
+        help="Retries, with exponential backoff, of a request answered "
+             "with 409 Conflict or a 5xx error")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    users = KEYSTONE_USERS
+    if args.users:
+        try:
+            users = load_users(args.users)
+        except (IOError, ValueError) as e:
+            parser.error('Cannot load {0}: {1}'.format(args.users, e))
+
     creds = {}
     creds['auth_url'] = os.environ['OS_AUTH_URL']
     creds['username'] = os.environ['OS_USERNAME']
@@ -99,18 +346,22 @@ def main():
                        username=os.environ['OS_USERNAME'],
                        password=os.environ['OS_PASSWORD'],
                        tenant_name=os.environ['OS_TENANT_NAME'])
-    sess = session.Session(auth=auth)
+    sess = make_session(auth, args.workers)
     keystone = client.Client(session=sess)
-    for k, v in KEYSTONE_USERS.items():
-        username = k
-        roles = v.get('roles')
-        tenants = v.get('tenants')
-        for tenant_name in tenants:
-            LOG.info('username {0} tenant {1} '
-                     'role_list {2}'.format(username, tenant_name, roles))
-            tenant = create_tenant(keystone, tenant_name)
-            user = create_user(keystone, tenant, username)
-            add_roles(keystone, user, tenant, roles)
+    index = KeystoneIndex(keystone)
+    plan = make_plan(keystone, index, users, args.workers, args.retries)
+    print_plan(plan)
+    failures = 0
+    if not args.dry_run:
+        failures = apply_plan(keystone, index, plan, args.workers,
+                              args.retries)
+    if failures:
+        LOG.error('{0} changes failed'.format(failures))
+    if plan['errors']:
+        LOG.error('{0} errors in the plan'.format(
+            len(plan['errors'])))
+    if failures or plan['errors']:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,73 @@
+import unittest
+
+# Local imports
+import create_keystone_users
+
+from keystoneclient import exceptions
+from unittest import mock
+
+
+def resource(resource_id, name):
+    """Return a mock Keystone resource, name can't be set by MagicMock()"""
+
+    obj = mock.MagicMock(id=resource_id)
+    obj.name = name
+    return obj
+
+
+class TestCreateKeystoneUsers(unittest.TestCase):
+    """
+    This unittest tests the functions for the create_keystone_users.py
+    script.
+    """
+
+    def setUp(self):
+        """Setup a mock client and an index of its directory"""
+
+        self.client = mock.MagicMock()
+        self.client.tenants.list.return_value = [resource('t1', 'tenant_1')]
+        self.client.users.list.return_value = [resource('u1', 'user_1')]
+        self.client.roles.list.return_value = [resource('r1', '_member_')]
+        self.index = create_keystone_users.KeystoneIndex(self.client)
+
+    @mock.patch('create_keystone_users.time.sleep')
+    def test_add_role_conflict(self, sleep):
+        """
+        Test that a grant answered with 409 counts as already granted
+        without being retried
+        """
+
+        self.client.roles.add_user_role.side_effect = exceptions.Conflict()
+        self.assertTrue(create_keystone_users.add_role(
+            self.client, self.index, 'user_1', 'tenant_1', '_member_'))
+        self.assertEqual(1, self.client.roles.add_user_role.call_count)
+        sleep.assert_not_called()
+
+    def test_make_plan_errors(self):
+        """
+        Test that an unreadable user/tenant pair and an unknown role are
+        plan errors which don't stop the other users being planned
+        """
+
+        self.client.users.list.return_value = [resource('u1', 'user_1'),
+                                               resource('u2', 'user_2')]
+        self.index = create_keystone_users.KeystoneIndex(self.client)
+
+        def roles_for_user(user, tenant):
+            if user.id == 'u1':
+                raise exceptions.HttpServerError()
+            return []
+
+        self.client.roles.roles_for_user.side_effect = roles_for_user
+        users = {'user_1': {'roles': ['_member_'], 'tenants': ['tenant_1']},
+                 'user_2': {'roles': ['_member_', 'no_such_role'],
+                            'tenants': ['tenant_1']}}
+        plan = create_keystone_users.make_plan(self.client, self.index,
+                                               users, retries=0)
+        self.assertEqual([('user_2', 'tenant_1', '_member_')],
+                         plan['grants'])
+        self.assertEqual(2, len(plan['errors']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,71 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
+import glob
 import hashlib
+import io
+import json
 import logging
+import multiprocessing
 import os
+import socket
+import socketserver
+import sqlite3
+import stat
+import sys
+import tarfile
+import time
+import uuid
+import zipfile
+
+from concurrent import futures
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.x509.oid import NameOID
+from datetime import datetime, timedelta, timezone
 from OpenSSL import crypto
 
 LOG = logging.getLogger(__name__)
 TYPE_RSA = crypto.TYPE_RSA
 TYPE_DSA = crypto.TYPE_DSA
+TYPE_EC = crypto.TYPE_EC
+# EVP_PKEY_ED25519, what PKey.type() returns for Ed25519 keys
+TYPE_ED25519 = 1087
+KEY_TYPES = {'rsa': TYPE_RSA, 'dsa': TYPE_DSA, 'ec': TYPE_EC,
+             'ed25519': TYPE_ED25519}
+KEY_TYPE_NAMES = {value: name for name, value in KEY_TYPES.items()}
+# EC keys are sized by their curve
+EC_CURVES = {256: ec.SECP256R1, 384: ec.SECP384R1, 521: ec.SECP521R1}
+CURVE_NAMES = {'P-256': 256, 'P-384': 384, 'P-521': 521}
+NAME_OIDS = {
+    'C': NameOID.COUNTRY_NAME,
+    'ST': NameOID.STATE_OR_PROVINCE_NAME,
+    'L': NameOID.LOCALITY_NAME,
+    'O': NameOID.ORGANIZATION_NAME,
+    'OU': NameOID.ORGANIZATIONAL_UNIT_NAME,
+    'CN': NameOID.COMMON_NAME,
+}
+BENCHMARK_KEYS = [(TYPE_RSA, 2048), (TYPE_RSA, 3072), (TYPE_RSA, 4096),
+                  (TYPE_EC, 256), (TYPE_EC, 384), (TYPE_EC, 521),
+                  (TYPE_ED25519, 256)]
+KEY_POOL_SIZE = 64
+# Claimed and partly written key files older than this are left overs
+KEY_POOL_STALE = 60 * 60
+INVENTORY = 'inventory.db'
+# Files scan looks into for certificates
+CERT_SUFFIXES = ('.cert', '.crt', '.pem')
+# Directories listed at once and files parsed per task by scan
+SCAN_THREADS = 16
+SCAN_CHUNK = 256
+# files writes a .csr, .pkey and .cert per certificate, pem one file with
+# the key, the certificate and its CA, pkcs12 the same as a .p12
+OUTPUT_FORMATS = ('files', 'pem', 'pkcs12')
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.zip')
+# Files written before they are flushed to disk together with --fsync
+FSYNC_BATCH = 256
 SUBJECT = {
     'C': 'US',
     'ST': 'New York',
@@ -17,9 +74,535 @@ SUBJECT = {
     'OU': 'DevOps Automation'
 }
 
+# CA loaded once by each batch worker process
+_worker_ca = {}
+
+
+class KeyPool:
+    """
+    A directory of pre-generated private keys of one type and size. Keys
+    are written under a temporary name and renamed into place, and taken
+    by renaming them to a claimed name, so concurrent processes never
+    see a partial key or hand out the same key twice.
+    """
+
+    def __init__(self, path, algo_type=TYPE_RSA, bits=4096,
+                 size=KEY_POOL_SIZE):
+        """
+        :param path: Directory holding a subdirectory per key type and size
+        :param algo_type: One of KEY_TYPES
+        :param bits (int): Key size, the curve size for EC keys
+        :param size (int): Number of keys fill keeps in the pool
+        """
+
+        self.algo_type = algo_type
+        self.bits = bits
+        self.size = size
+        self.path = os.path.join(path, '{0}-{1}'.format(
+            KEY_TYPE_NAMES[algo_type], bits))
+
+    def matches(self, algo_type, bits):
+        return (algo_type, bits) == (self.algo_type, self.bits)
+
+    def keys(self):
+        """
+        :return names (list): File names of the keys ready to be taken
+        """
+
+        if not os.path.isdir(self.path):
+            return []
+        return [entry.name for entry in os.scandir(self.path)
+                if entry.name.endswith('.pem')]
+
+    def add(self, pkey):
+        """
+        Add a private key to the pool
+
+        :param pkey (crypto.PKey object):
+        """
+
+        name = uuid.uuid4().hex
+        tmp_path = os.path.join(self.path, '{0}.tmp'.format(name))
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as key_file:
+            key_file.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, pkey))
+            key_file.flush()
+            os.fsync(key_file.fileno())
+        os.rename(tmp_path, os.path.join(self.path, '{0}.pem'.format(name)))
+
+    def take(self):
+        """
+        Remove a key from the pool and return it
+
+        :return (crypto.PKey object): or None when the pool is empty
+        """
+
+        for name in self.keys():
+            key_path = os.path.join(self.path, name)
+            claimed_path = '{0}.{1}.taken'.format(key_path, os.getpid())
+            try:
+                os.rename(key_path, claimed_path)
+            except FileNotFoundError:
+                # Another process took it first
+                continue
+            with open(claimed_path, 'rb') as key_file:
+                pkey = crypto.load_privatekey(crypto.FILETYPE_PEM,
+                                              key_file.read())
+            os.remove(claimed_path)
+            return pkey
+        return None
+
+    def remove_stale(self):
+        """Remove files left behind by processes that died mid-way"""
+
+        cutoff = time.time() - KEY_POOL_STALE
+        for entry in os.scandir(self.path):
+            if not entry.name.endswith('.pem') and \
+                    entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+
+    def fill(self):
+        """
+        Generate keys until the pool holds size of them
+
+        :return added (int): Number of keys generated
+        """
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, 0o700)
+        self.remove_stale()
+        added = 0
+        cert_gen = CertificateGenerator()
+        while len(self.keys()) < self.size:
+            self.add(cert_gen.generate_keypair(self.algo_type, self.bits))
+            added += 1
+        if added:
+            LOG.info('Added {0} keys to {1}'.format(added, self.path))
+        return added
+
+    def refill_forever(self, interval=5):
+        """
+        Keep the pool full at the lowest CPU priority, so keys are only
+        generated with cycles nothing else wants
+
+        :param interval: Seconds between checks of a full pool
+        """
+
+        os.nice(19)
+        while True:
+            self.fill()
+            time.sleep(interval)
+
+    def start_refill(self, interval=5):
+        """
+        Refill the pool from a background process for as long as the
+        calling process runs
+
+        :param interval: Seconds between checks of a full pool
+        :return process (multiprocessing.Process):
+        """
+
+        process = multiprocessing.Process(target=self.refill_forever,
+                                          args=(interval,), daemon=True)
+        process.start()
+        return process
+
+
+class Inventory:
+    """
+    SQLite database recording every certificate issued, which also hands
+    out their serial numbers, and caching what scan parsed. Processes
+    can share one inventory, SQLite locks it for each transaction.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Database file, created when missing
+        """
+
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        with self.open() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS serials ('
+                    'last INTEGER NOT NULL)')
+                connection.execute(
+                    'INSERT INTO serials (last) SELECT 0 WHERE NOT EXISTS '
+                    '(SELECT 1 FROM serials)')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS certificates ('
+                    'serial INTEGER PRIMARY KEY, subject TEXT NOT NULL, '
+                    'issuer TEXT NOT NULL, sans TEXT, '
+                    'not_after INTEGER NOT NULL, fingerprint TEXT NOT NULL, '
+                    'issued INTEGER NOT NULL)')
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS certificates_subject '
+                    'ON certificates (subject)')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS scanned ('
+                    'path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, '
+                    'size INTEGER NOT NULL, serial TEXT, subject TEXT, '
+                    'not_after INTEGER, fingerprint TEXT)')
+
+    @contextlib.contextmanager
+    def open(self):
+        """
+        Open the database. WAL mode with synchronous=NORMAL commits without
+        waiting for a flush, which is safe for the serials because they
+        never go back below the current time.
+        """
+
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            connection.execute('PRAGMA synchronous=NORMAL')
+            yield connection
+        finally:
+            connection.close()
+
+    def allocate(self, count=1):
+        """
+        Reserve serial numbers. They increase with every call and start at
+        the current time in microseconds, so they stay unique when the
+        database is lost or recreated.
+
+        :param count (int): Number of serials to reserve
+        :return serial (int): The first of count consecutive serials
+        """
+
+        with self.open() as connection:
+            with connection:
+                connection.execute(
+                    'UPDATE serials SET last = max(last + 1, ?) + ? - 1',
+                    (int(time.time() * 1000000), count))
+                last = connection.execute(
+                    'SELECT last FROM serials').fetchone()[0]
+        return last - count + 1
+
+    def record(self, cert, sans=None):
+        """
+        Record an issued certificate
+
+        :param cert (X509 object):
+        :param sans (list): DNS names of its subjectAltName extension
+        """
+
+        subject, not_after, fingerprint = describe_cert(cert)
+        with self.open() as connection:
+            with connection:
+                connection.execute(
+                    'INSERT INTO certificates (serial, subject, issuer, '
+                    'sans, not_after, fingerprint, issued) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (cert.get_serial_number(), subject,
+                     cert.to_cryptography().issuer.rfc4514_string(),
+                     json.dumps(sans) if sans else None, not_after,
+                     fingerprint, int(time.time())))
+
+    def issued(self, subject=None):
+        """
+        Read the recorded certificates, oldest first
+
+        :param subject: Only certificates with this subject when set
+        :return certs (list): One dict per certificate
+        """
+
+        query = 'SELECT serial, subject, issuer, sans, not_after, ' \
+                'fingerprint, issued FROM certificates'
+        params = ()
+        if subject is not None:
+            query += ' WHERE subject = ?'
+            params = (subject,)
+        with self.open() as connection:
+            rows = connection.execute(query + ' ORDER BY serial',
+                                      params).fetchall()
+        return [{'serial': row[0], 'subject': row[1], 'issuer': row[2],
+                 'sans': json.loads(row[3]) if row[3] else [],
+                 'not_after': row[4], 'fingerprint': row[5],
+                 'issued': row[6]} for row in rows]
+
+    def scanned(self, root):
+        """
+        :param root: Absolute path of a scanned directory
+        :return cached (dict): Cached scan rows below root by path
+        """
+
+        prefix = os.path.join(root, '')
+        with self.open() as connection:
+            rows = connection.execute(
+                'SELECT path, mtime_ns, size, serial, subject, not_after, '
+                'fingerprint FROM scanned WHERE substr(path, 1, ?) = ?',
+                (len(prefix), prefix)).fetchall()
+        return {row[0]: row for row in rows}
+
+    def update_scanned(self, rows, removed):
+        """
+        :param rows (list): Scan rows to cache, as parse_certs returns them
+        :param removed (list): Paths to drop from the cache
+        """
+
+        with self.open() as connection:
+            with connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO scanned (path, mtime_ns, size, '
+                    'serial, subject, not_after, fingerprint) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                connection.executemany(
+                    'DELETE FROM scanned WHERE path = ?',
+                    [(path,) for path in removed])
+
+
+def fsync_path(path):
+    """
+    Flush a file or directory to disk
+
+    :param path:
+    """
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class OutputWriter:
+    """
+    Base of the writers certificates are written through. Used as a
+    context manager, which closes the writer when the block succeeds and
+    discards what was not written yet when it fails.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def write(self, name, data, private=False):
+        """
+        :param name: Path of the file relative to the output
+        :param data (bytes):
+        :param private (bool): Holds a private key, readable by the owner
+                               only
+        """
+
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def discard(self):
+        raise NotImplementedError
+
+
+class DirectoryWriter(OutputWriter):
+    """
+    Write files below a directory under a temporary name and rename them
+    into place, so a crash never leaves a partly written file behind.
+    With fsync the files are flushed in batches before they are renamed,
+    and each directory once per batch after the renames.
+    """
+
+    def __init__(self, path, fsync=False, batch_size=FSYNC_BATCH):
+        """
+        :param path: Directory the files are written below
+        :param fsync (bool): Flush the files to disk
+        :param batch_size (int): Number of files flushed together
+        """
+
+        self.path = path
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.pending = []
+        self.directories = set()
+
+    def write(self, name, data, private=False):
+        path = os.path.join(self.path, name)
+        directory = os.path.dirname(path)
+        if directory not in self.directories:
+            os.makedirs(directory, exist_ok=True)
+            self.directories.add(directory)
+        tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600 if private else 0o644)
+        with os.fdopen(fd, 'wb') as output_file:
+            output_file.write(data)
+        self.pending.append((tmp_path, path))
+        if not self.fsync or len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Flush and rename the pending files"""
+
+        if self.fsync:
+            for tmp_path, path in self.pending:
+                fsync_path(tmp_path)
+        for tmp_path, path in self.pending:
+            os.rename(tmp_path, path)
+        if self.fsync:
+            for directory in {os.path.dirname(path)
+                              for tmp_path, path in self.pending}:
+                fsync_path(directory)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+
+    def discard(self):
+        for tmp_path, path in self.pending:
+            os.remove(tmp_path)
+        self.pending = []
+
+
+class ArchiveWriter(OutputWriter):
+    """
+    Write files into one tar or zip archive, compressed for .tar.gz, .tgz
+    and .zip. The archive is written under a temporary name and renamed
+    into place when closed.
+    """
+
+    def __init__(self, path, fsync=False):
+        """
+        :param path: Archive file, one of ARCHIVE_SUFFIXES
+        :param fsync (bool): Flush the archive to disk when closed
+        """
+
+        self.path = path
+        self.fsync = fsync
+        self.tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if path.endswith('.zip'):
+            self.archive = zipfile.ZipFile(self.tmp_path, 'w',
+                                           zipfile.ZIP_DEFLATED)
+        elif path.endswith(('.tar.gz', '.tgz')):
+            self.archive = tarfile.open(self.tmp_path, 'w:gz')
+        else:
+            self.archive = tarfile.open(self.tmp_path, 'w')
+        os.chmod(self.tmp_path, 0o600)
+
+    def write(self, name, data, private=False):
+        mode = 0o600 if private else 0o644
+        if isinstance(self.archive, zipfile.ZipFile):
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.external_attr = (stat.S_IFREG | mode) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = mode
+            info.mtime = time.time()
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.archive.close()
+        if self.fsync:
+            fsync_path(self.tmp_path)
+        os.rename(self.tmp_path, self.path)
+        if self.fsync:
+            fsync_path(os.path.dirname(os.path.abspath(self.path)))
+
+    def discard(self):
+        self.archive.close()
+        os.remove(self.tmp_path)
+
+
+def open_output(path, fsync=False):
+    """
+    :param path: An archive with one of ARCHIVE_SUFFIXES, or a directory
+    :param fsync (bool): Flush what is written to disk
+    :return writer (OutputWriter):
+    """
+
+    if path.endswith(ARCHIVE_SUFFIXES):
+        return ArchiveWriter(path, fsync)
+    return DirectoryWriter(path, fsync)
+
+
+def bundle_files(directory, pem_data, output_format='files',
+                 ca_cert_pem=None, password=None):
+    """
+    Encode a PEM serialized certificate bundle in one of OUTPUT_FORMATS
+
+    :param directory: Directory of the files relative to the output
+    :param pem_data (dict): Dictionary of PEM cert, request, private key
+                            and filename data.
+    :param output_format: One of OUTPUT_FORMATS
+    :param ca_cert_pem (bytes): Certificate of the CA, added to pem and
+                                pkcs12 bundles unless it is the bundle's
+                                own certificate
+    :param password (bytes): Encrypt pkcs12 bundles with this password
+    :return files (list): (name, data, private) tuples as OutputWriter
+                          writes them
+    """
+
+    fname = pem_data['fname']
+    path = os.path.join(directory, fname)
+    if ca_cert_pem == pem_data['cert']:
+        ca_cert_pem = None
+    if output_format == 'pem':
+        bundle = pem_data['key'] + pem_data['cert']
+        if ca_cert_pem:
+            bundle += ca_cert_pem
+        return [('{0}.pem'.format(path), bundle, True)]
+    if output_format == 'pkcs12':
+        cas = None
+        if ca_cert_pem:
+            cas = [x509.load_pem_x509_certificate(ca_cert_pem)]
+        encryption = serialization.NoEncryption()
+        if password:
+            encryption = serialization.BestAvailableEncryption(password)
+        return [('{0}.p12'.format(path),
+                 pkcs12.serialize_key_and_certificates(
+                     fname.encode(),
+                     serialization.load_pem_private_key(pem_data['key'],
+                                                        None),
+                     x509.load_pem_x509_certificate(pem_data['cert']),
+                     cas, encryption),
+                 True)]
+    return [('{0}.csr'.format(path), pem_data['req'], False),
+            ('{0}.pkey'.format(path), pem_data['key'], True),
+            ('{0}.cert'.format(path), pem_data['cert'], False)]
+
+
+def write_bundle(writer, directory, pem_data, output_format='files',
+                 ca_cert_pem=None, password=None):
+    """
+    Write a PEM serialized certificate bundle in one of OUTPUT_FORMATS,
+    taking the same arguments as bundle_files
+
+    :param writer (OutputWriter):
+    """
+
+    for name, data, private in bundle_files(directory, pem_data,
+                                            output_format, ca_cert_pem,
+                                            password):
+        writer.write(name, data, private)
+
 
 class CertificateGenerator:
 
+    def __init__(self, key_pool=None, inventory=None):
+        """
+        :param key_pool (KeyPool): Take private keys of its type and size
+                                   from this pool when set
+        :param inventory (Inventory): Take serials from and record the
+                                      certificates in this inventory
+                                      when set
+        """
+
+        self.key_pool = key_pool
+        self.inventory = inventory
+
     def create_local_path(self, path):
         """
         Create local path for backups
@@ -57,6 +640,15 @@ class CertificateGenerator:
         :return (X509Req Object): Certificate request object
         """
 
+        if pkey.type() == TYPE_ED25519:
+            # Ed25519 signs without a separate digest, which pyOpenSSL
+            # can't do
+            subject = x509.Name([x509.NameAttribute(NAME_OIDS[key], value)
+                                 for key, value in name.items()])
+            req = x509.CertificateSigningRequestBuilder().subject_name(
+                subject).sign(pkey.to_cryptography_key(), None)
+            return crypto.X509Req.from_cryptography(req)
+
         req = crypto.X509Req()
         subj = req.get_subject()
 
@@ -70,7 +662,8 @@ class CertificateGenerator:
         return req
 
     def generate_certificate(self, req, issuer_cert, issuer_key, serial,
-                             not_before, not_after, digest="sha256"):
+                             not_before, not_after, digest="sha256",
+                             sans=None, alt_names=None):
         """
         Generate a certificate given a certificate request.
 
@@ -84,9 +677,18 @@ class CertificateGenerator:
                                 certificate stops being valid.
         :param digest (str): Digest method to use for signing,
                              default is sha256
+        :param sans (list): DNS names for the subjectAltName extension,
+                            none added when None
+        :param alt_names (x509.SubjectAlternativeName): Used as the
+                            subjectAltName extension as is, instead of sans
         :return (X509 object) : The signed certificate in an X509 object
         """
 
+        if issuer_key.type() == TYPE_ED25519:
+            return self.generate_ed25519_certificate(
+                req, issuer_cert, issuer_key, serial, not_before, not_after,
+                sans, alt_names)
+
         cert = crypto.X509()
         LOG.debug('Serial is {0}'.format(serial))
         cert.set_serial_number(serial)
@@ -95,38 +697,120 @@ class CertificateGenerator:
         cert.set_issuer(issuer_cert.get_subject())
         cert.set_subject(req.get_subject())
         cert.set_pubkey(req.get_pubkey())
+        if alt_names:
+            # Raw DER keeps every kind of name, not only the DNS ones
+            der = ':'.join('{0:02x}'.format(byte)
+                           for byte in alt_names.public_bytes())
+            cert.add_extensions([crypto.X509Extension(
+                b'subjectAltName', False, 'DER:{0}'.format(der).encode())])
+        elif sans:
+            alt_names = ','.join('DNS:{0}'.format(name) for name in sans)
+            cert.add_extensions([crypto.X509Extension(
+                b'subjectAltName', False, alt_names.encode())])
         cert.sign(issuer_key, digest)
 
         return cert
 
+    def generate_ed25519_certificate(self, req, issuer_cert, issuer_key,
+                                     serial, not_before, not_after,
+                                     sans=None, alt_names=None):
+        """
+        Generate a certificate signed by an Ed25519 key. Takes the same
+        arguments as generate_certificate, without the digest. These are
+        X.509 v3 certificates, so a self-signed one is marked as a CA.
+
+        :return (X509 object) : The signed certificate in an X509 object
+        """
+
+        now = datetime.now(timezone.utc)
+        builder = x509.CertificateBuilder().serial_number(
+            serial).not_valid_before(
+            now + timedelta(seconds=not_before)).not_valid_after(
+            now + timedelta(seconds=not_after)).issuer_name(
+            issuer_cert.to_cryptography().subject).subject_name(
+            req.to_cryptography().subject).public_key(
+            req.to_cryptography().public_key()).add_extension(
+            x509.BasicConstraints(ca=issuer_cert is req, path_length=None),
+            critical=True)
+        if alt_names:
+            builder = builder.add_extension(alt_names, critical=False)
+        elif sans:
+            builder = builder.add_extension(x509.SubjectAlternativeName(
+                [x509.DNSName(alt_name) for alt_name in sans]),
+                critical=False)
+        cert = builder.sign(issuer_key.to_cryptography_key(), None)
+
+        return crypto.X509.from_cryptography(cert)
+
     def generate_keypair(self, algo_type, bits):
         """
-        Given a type of TYPE_RSA or TYPE_DSA and an integer of bits, generate a
-        private key.
+        Given a type from KEY_TYPES and an integer of bits, generate a
+        private key. EC keys take the size of their curve in bits and
+        Ed25519 keys ignore it.
 
         :param type (str): The type of encryption algorithm to use
         :param bits (int):
         :return (crypto.Pkey object): Private key
         """
 
+        if algo_type == TYPE_EC:
+            return crypto.PKey.from_cryptography_key(
+                ec.generate_private_key(EC_CURVES[bits]()))
+        if algo_type == TYPE_ED25519:
+            return crypto.PKey.from_cryptography_key(
+                ed25519.Ed25519PrivateKey.generate())
+
         pkey = crypto.PKey()
         pkey.generate_key(algo_type, bits)
 
         return pkey
 
+    def get_keypair(self, algo_type, bits):
+        """
+        Take a private key from the key pool when it holds keys of this
+        type and size, or generate one.
+
+        :param algo_type: One of KEY_TYPES
+        :param bits (int):
+        :return (crypto.Pkey object): Private key
+        """
+
+        if self.key_pool and self.key_pool.matches(algo_type, bits):
+            pkey = self.key_pool.take()
+            if pkey:
+                return pkey
+            LOG.warning('Key pool {0} is empty, generating a '
+                        'key'.format(self.key_pool.path))
+        return self.generate_keypair(algo_type, bits)
+
     def generate_serial(self, cname='localhost.localdomain'):
         """
 
         :param cname: Common name or hostname
-        :return: An integer of hexdigest in base 16
+        :return: An integer of hexdigest in base 16, cut to fit the 20
+                 octets RFC 5280 allows for serials
         """
 
         serial_hash = hashlib.sha256()
         serial_hash.update(cname.encode())
 
-        return int(serial_hash.hexdigest(), 16)
+        return int(serial_hash.hexdigest()[:39], 16)
+
+    def next_serial(self, cname):
+        """
+        A serial from the inventory when there is one, otherwise derived
+        from cname by generate_serial
+
+        :param cname: Common name or hostname
+        :return serial (int):
+        """
 
-    def generate_cert_data(self, cname, bits=4096, years=5, **ca_data):
+        if self.inventory:
+            return self.inventory.allocate()
+        return self.generate_serial(cname)
+
+    def generate_cert_data(self, cname, bits=4096, years=5, sans=None,
+                           algo_type=TYPE_RSA, **ca_data):
         """
         Creates a certificate bundle, which is returned in a dictionary
         for the write certs method.
@@ -134,12 +818,16 @@ class CertificateGenerator:
         :param bits (int): Number of bits to use in the private keys
         :param ca_data (dict): dictionary of ca req and keys
         :param years (int): Number of years the certs are valid
+        :param sans (list): Extra DNS names for the certificate. When
+                            not None the cname and these are added as a
+                            subjectAltName extension.
+        :param algo_type: Type of the private key, one of KEY_TYPES
         :return cert_data (dict): Dictionary of key and filename data
         """
 
         cert_data = {}
-        key = self.generate_keypair(TYPE_RSA, bits)
-        subject = SUBJECT
+        key = self.get_keypair(algo_type, bits)
+        subject = dict(SUBJECT)
         subject['CN'] = cname
         req = self.generate_csr(key, **subject)
         not_after = self.create_timestamp(years)
@@ -147,21 +835,113 @@ class CertificateGenerator:
             cert_data['fname'] = cname.replace('.', '-')
             cakey = ca_data['key']
             careq = ca_data['req']
-            serial = self.generate_serial(cname)
+            serial = self.next_serial(cname)
         else:
             # We're self-signing because this is the ca
             cert_data['fname'] = '{0}-CA'.format(cname.replace('.', '-'))
             cakey = key
             careq = req
-            serial = 0
+            serial = self.inventory.allocate() if self.inventory else 1
+        if sans is not None:
+            sans = [cname] + [name for name in sans if name != cname]
         cert = self.generate_certificate(req, careq, cakey, serial, 0,
-                                         not_after)
+                                         not_after, sans=sans)
+        if self.inventory:
+            self.inventory.record(cert, sans)
         cert_data['req'] = req
         cert_data['key'] = key
         cert_data['cert'] = cert
 
         return cert_data
 
+    def dump_cert_data(self, **cert_data):
+        """
+        Serialize a certificate bundle to PEM
+
+        :param cert_data (dict): Dictionary of cert, request, private key and
+                                 filename data.
+        :return pem_data (dict): The same keys with PEM bytes
+        """
+
+        return {
+            'fname': cert_data['fname'],
+            'req': crypto.dump_certificate_request(crypto.FILETYPE_PEM,
+                                                   cert_data['req']),
+            'key': crypto.dump_privatekey(crypto.FILETYPE_PEM,
+                                          cert_data['key']),
+            'cert': crypto.dump_certificate(crypto.FILETYPE_PEM,
+                                            cert_data['cert']),
+        }
+
+    def write_pem_data(self, path, **pem_data):
+        """
+        Write a PEM serialized certificate bundle to file
+
+        :param path (os.path object): The path to store the certs in
+        :param pem_data (dict): Dictionary of PEM cert, request, private key
+                                and filename data.
+        """
+
+        with DirectoryWriter(path) as writer:
+            write_bundle(writer, '', pem_data)
+
+    def load_ca(self, cert_path, key_path):
+        """
+        Load an existing CA certificate and private key
+
+        :param cert_path: PEM certificate of the CA
+        :param key_path: PEM private key of the CA
+        :return ca_data (dict): The CA certificate as req and cert, and its
+                                key, as generate_cert_data takes them
+        """
+
+        with open(cert_path, 'rb') as cert_file:
+            cert = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                           cert_file.read())
+        with open(key_path, 'rb') as key_file:
+            key = crypto.load_privatekey(crypto.FILETYPE_PEM, key_file.read())
+        if crypto.dump_publickey(crypto.FILETYPE_PEM, cert.get_pubkey()) != \
+                crypto.dump_publickey(crypto.FILETYPE_PEM, key):
+            raise ValueError('{0} is not the key of {1}'.format(key_path,
+                                                                cert_path))
+        LOG.info('Loaded CA {0}'.format(cert.get_subject().CN))
+        return {'req': cert, 'cert': cert, 'key': key}
+
+    def sign_csr(self, csr, years=1, sans=None, **ca_data):
+        """
+        Sign a certificate request with a CA. Without sans the certificate
+        gets the subjectAltName the request asks for, if any.
+
+        :param csr (X509Req object): The request, its signature is checked
+        :param years (int): Number of years the cert is valid
+        :param sans (list): Extra DNS names for the certificate, as in
+                            generate_cert_data
+        :param ca_data (dict): The CA's req and key
+        :return (X509 object): The signed certificate
+        """
+
+        if not csr.verify(csr.get_pubkey()):
+            raise ValueError('The request signature does not match its key')
+        cname = csr.get_subject().CN
+        alt_names = None
+        if sans is not None:
+            sans = [cname] + [name for name in sans if name != cname]
+        else:
+            extensions = csr.to_cryptography().extensions
+            try:
+                alt_names = extensions.get_extension_for_class(
+                    x509.SubjectAlternativeName).value
+                sans = alt_names.get_values_for_type(x509.DNSName)
+            except x509.ExtensionNotFound:
+                pass
+        cert = self.generate_certificate(csr, ca_data['req'], ca_data['key'],
+                                         self.next_serial(cname), 0,
+                                         self.create_timestamp(years),
+                                         sans=sans, alt_names=alt_names)
+        if self.inventory:
+            self.inventory.record(cert, sans)
+        return cert
+
     def write_certs(self, path, **cert_data):
         """
         Write certificate bundle to file
@@ -171,21 +951,468 @@ class CertificateGenerator:
                                  filename data.
         """
 
-        req_pem = crypto.dump_certificate_request(crypto.FILETYPE_PEM,
-                                                  cert_data['req'])
-        pkey_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM,
-                                          cert_data['key'])
-        cert_pem = crypto.dump_certificate(crypto.FILETYPE_PEM,
-                                           cert_data['cert'])
-        fname = cert_data['fname']
-        with open('{0}/{1}.csr'.format(path, fname), 'w') as fname_file:
-            fname_file.write(req_pem.decode('utf-8'))
+        self.write_pem_data(path, **self.dump_cert_data(**cert_data))
+
+
+def find_ca(ca_dir):
+    """
+    Find the CA certificate and key written by write_certs in a directory
+
+    :param ca_dir:
+    :return (cert_path, key_path):
+    """
+
+    certs = glob.glob(os.path.join(ca_dir, '*-CA.cert'))
+    if len(certs) != 1:
+        raise ValueError('Expected one *-CA.cert in {0}, found {1}'.format(
+            ca_dir, len(certs)))
+    return certs[0], certs[0][:-len('.cert')] + '.pkey'
+
+
+class CertificateSigner:
+    """
+    Keep a parsed CA in memory to sign many requests. Can serve them on a
+    Unix socket, one JSON request per connection, answered with one JSON
+    line:
+
+    {"csr": "<PEM request>", "sans": [...]} signs a request
+    {"cname": "host.example.com", "sans": [...]} generates a key too
+    """
+
+    def __init__(self, ca_data, years=1, key_pool=None, algo_type=TYPE_RSA,
+                 bits=4096, inventory=None):
+        """
+        :param ca_data (dict): The CA's req and key
+        :param years (int): Number of years the certs are valid
+        :param key_pool (KeyPool): Pool keys are taken from for cname
+                                   requests
+        :param algo_type: Key type for cname requests
+        :param bits (int): Key size for cname requests
+        :param inventory (Inventory): Inventory recording the certificates
+        """
+
+        self.ca_data = {'req': ca_data['req'], 'key': ca_data['key']}
+        self.years = years
+        self.algo_type = algo_type
+        self.bits = bits
+        self.cert_gen = CertificateGenerator(key_pool, inventory)
+
+    def sign(self, csr_pem, sans=None):
+        """
+        Sign a PEM certificate request
+
+        :param csr_pem (bytes):
+        :param sans (list):
+        :return cert_pem (bytes):
+        """
+
+        req = crypto.load_certificate_request(crypto.FILETYPE_PEM, csr_pem)
+        cert = self.cert_gen.sign_csr(req, self.years, sans, **self.ca_data)
+        return crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+
+    def issue(self, cname, sans=None):
+        """
+        Generate a key and a certificate for cname
+
+        :param cname:
+        :param sans (list):
+        :return pem_data (dict):
+        """
+
+        cert_data = self.cert_gen.generate_cert_data(
+            cname, self.bits, self.years, sans, self.algo_type,
+            **self.ca_data)
+        return self.cert_gen.dump_cert_data(**cert_data)
+
+    def handle_request(self, request):
+        """
+        :param request (dict): A csr or a cname, and optional sans
+        :return reply (dict):
+        """
+
+        try:
+            if 'csr' in request:
+                cert = self.sign(request['csr'].encode(),
+                                 request.get('sans'))
+                return {'ok': True, 'cert': cert.decode()}
+            if 'cname' in request:
+                pem_data = self.issue(request['cname'], request.get('sans'))
+                return {'ok': True, 'cert': pem_data['cert'].decode(),
+                        'key': pem_data['key'].decode(),
+                        'csr': pem_data['req'].decode()}
+        except Exception as e:
+            # A malformed request must still get a reply
+            LOG.exception('Request failed with error {0}'.format(e))
+            return {'ok': False, 'error': str(e)}
+        return {'ok': False, 'error': 'expected a csr or a cname'}
+
+    def serve(self, socket_path):
+        """
+        Answer requests on a Unix socket until interrupted
+
+        :param socket_path:
+        """
+
+        signer = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline().decode())
+                except ValueError as e:
+                    reply = {'ok': False, 'error': str(e)}
+                else:
+                    reply = signer.handle_request(request)
+                self.wfile.write((json.dumps(reply) + '\n').encode())
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        os.chmod(socket_path, 0o600)
+        server.daemon_threads = True
+        LOG.info('Signing requests on {0}'.format(socket_path))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(socket_path)
+
+
+def request_certificate(socket_path, **request):
+    """
+    Send a request to a CertificateSigner serving on a Unix socket
+
+    :param socket_path:
+    :param request: csr or cname, and optional sans
+    :return reply (dict):
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + '\n').encode())
+        return json.loads(client.makefile('rb').readline().decode())
+
+
+def load_batch(path):
+    """
+    Read a batch file. Each line holds a hostname, used as the common name,
+    optionally followed by extra DNS names for the certificate, separated
+    by whitespace. Blank lines and lines starting with # are ignored.
+
+    :param path:
+    :return hosts (list): list of (hostname, sans) tuples
+    """
+
+    hosts = []
+    with open(path) as batch_file:
+        for line in batch_file:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                hosts.append((fields[0], fields[1:]))
+    return hosts
+
+
+def init_worker(ca_cert_pem, ca_key_pem, key_pool=None, inventory=None):
+    """
+    Parse the CA once in each batch worker process
+
+    :param ca_cert_pem (bytes):
+    :param ca_key_pem (bytes):
+    :param key_pool (KeyPool): Pool the worker takes its keys from
+    :param inventory (Inventory): Inventory the worker records in
+    """
 
-        with open('{0}/{1}.pkey'.format(path, fname), 'w') as fname_file:
-            fname_file.write(pkey_pem.decode('utf-8'))
+    _worker_ca['key_pool'] = key_pool
+    _worker_ca['inventory'] = inventory
+    _worker_ca['cert_pem'] = ca_cert_pem
+    _worker_ca['req'] = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                                ca_cert_pem)
+    _worker_ca['key'] = crypto.load_privatekey(crypto.FILETYPE_PEM,
+                                               ca_key_pem)
 
-        with open('{0}/{1}.cert'.format(path, fname), 'w') as fname_file:
-            fname_file.write(cert_pem.decode('utf-8'))
+
+def issue_cert(cname, sans, bits, years, algo_type=TYPE_RSA,
+               output_format='files', password=None):
+    """
+    Generate a key and a certificate signed by the worker's CA. Runs in a
+    batch worker process, so the result is returned already encoded in
+    the output format.
+
+    :param cname:
+    :param sans (list):
+    :param bits (int):
+    :param years (int):
+    :param algo_type: One of KEY_TYPES
+    :param output_format: One of OUTPUT_FORMATS
+    :param password (bytes): Password of pkcs12 bundles
+    :return files (list): (name, data, private) tuples
+    """
+
+    cert_gen = CertificateGenerator(_worker_ca['key_pool'],
+                                    _worker_ca['inventory'])
+    cert_data = cert_gen.generate_cert_data(cname, bits, years, sans,
+                                            algo_type,
+                                            req=_worker_ca['req'],
+                                            key=_worker_ca['key'])
+    return bundle_files(cert_data['fname'],
+                        cert_gen.dump_cert_data(**cert_data), output_format,
+                        _worker_ca['cert_pem'], password)
+
+
+def issue_batch(hosts, writer, ca_data, bits=4096, years=1,
+                workers=None, key_pool=None, algo_type=TYPE_RSA,
+                inventory=None, output_format='files', password=None):
+    """
+    Issue a certificate for every host, generating the keys on a pool of
+    worker processes, one per core by default. Each host's files are
+    written to its own directory of the output.
+
+    :param hosts (list): (hostname, sans) tuples
+    :param writer (OutputWriter): Output the certificates are written to
+    :param ca_data (dict): The signing CA's certificate and key
+    :param bits (int):
+    :param years (int):
+    :param workers (int): Number of worker processes
+    :param key_pool (KeyPool): Pool the workers take their keys from
+    :param algo_type: One of KEY_TYPES
+    :param inventory (Inventory): Inventory the workers record in
+    :param output_format: One of OUTPUT_FORMATS
+    :param password (bytes): Password of pkcs12 bundles
+    :return failures (int): Number of hosts without a certificate
+    """
+
+    ca_cert_pem = crypto.dump_certificate(crypto.FILETYPE_PEM,
+                                          ca_data['cert'])
+    ca_key_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM, ca_data['key'])
+    start = time.monotonic()
+    issued = 0
+    failures = 0
+    with futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=init_worker,
+            initargs=(ca_cert_pem, ca_key_pem, key_pool,
+                      inventory)) as executor:
+        jobs = {executor.submit(issue_cert, cname, sans, bits, years,
+                                algo_type, output_format, password): cname
+                for cname, sans in hosts}
+        for job in futures.as_completed(jobs):
+            cname = jobs[job]
+            try:
+                for name, data, private in job.result():
+                    writer.write(name, data, private)
+            except Exception as e:
+                # Any error, a broken worker pool included, only fails
+                # this host, the others are still reported
+                LOG.error('Issuing {0} failed with error {1}: {2}'.format(
+                    cname, type(e).__name__, e))
+                failures += 1
+                continue
+            issued += 1
+            if issued % 100 == 0:
+                LOG.info('Issued {0}/{1} certificates'.format(
+                    issued, len(hosts)))
+
+    elapsed = time.monotonic() - start
+    LOG.info('Issued {0} certificates in {1:.1f}s ({2:.1f} certs/s), '
+             '{3} failed'.format(issued, elapsed, issued / elapsed,
+                                 failures))
+    return failures
+
+
+def describe_cert(cert):
+    """
+    :param cert (X509 object):
+    :return (subject, not_after, fingerprint): The subject as an RFC 4514
+                                               string, notAfter in seconds
+                                               since the epoch and the
+                                               SHA-256 fingerprint
+    """
+
+    not_after = datetime.strptime(cert.get_notAfter().decode(),
+                                  '%Y%m%d%H%M%SZ')
+    return (cert.to_cryptography().subject.rfc4514_string(),
+            int(not_after.replace(tzinfo=timezone.utc).timestamp()),
+            cert.digest('sha256').decode())
+
+
+def list_certs(path):
+    """
+    List one directory for scan
+
+    :param path:
+    :return (files, subdirs): Certificate files as (path, mtime_ns, size)
+                              tuples and the subdirectory paths
+    """
+
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.endswith(CERT_SUFFIXES) and entry.is_file():
+                    stat = entry.stat()
+                    files.append((entry.path, stat.st_mtime_ns,
+                                  stat.st_size))
+    except OSError as e:
+        LOG.warning('Skipping {0}: {1}'.format(path, e))
+    return files, subdirs
+
+
+def find_certs(root, threads=SCAN_THREADS):
+    """
+    Walk a directory tree, listing the directories of each level on a
+    thread pool, so slow or network file systems are walked in parallel
+
+    :param root:
+    :param threads (int):
+    :return found (list): (path, mtime_ns, size) tuples
+    """
+
+    found = []
+    pending = [root]
+    with futures.ThreadPoolExecutor(threads) as executor:
+        while pending:
+            listed = list(executor.map(list_certs, pending))
+            pending = []
+            for files, subdirs in listed:
+                found.extend(files)
+                pending.extend(subdirs)
+    return found
+
+
+def parse_certs(files):
+    """
+    Parse the first certificate of each file. Files that hold no
+    certificate are returned without one, so they are cached as well.
+
+    :param files (list): (path, mtime_ns, size) tuples
+    :return rows (list): (path, mtime_ns, size, serial, subject,
+                         not_after, fingerprint) tuples
+    """
+
+    rows = []
+    for path, mtime_ns, size in files:
+        try:
+            with open(path, 'rb') as cert_file:
+                cert = crypto.load_certificate(crypto.FILETYPE_PEM,
+                                               cert_file.read())
+        except (OSError, crypto.Error):
+            rows.append((path, mtime_ns, size, None, None, None, None))
+            continue
+        rows.append((path, mtime_ns, size,
+                     '{0:x}'.format(cert.get_serial_number())) +
+                    describe_cert(cert))
+    return rows
+
+
+def scan(root, inventory, days=30, workers=None):
+    """
+    Find the certificates below root that expire within days, or have
+    expired. Only files that are new or whose mtime or size changed since
+    the last scan are parsed, on a pool of worker processes.
+
+    :param root:
+    :param inventory (Inventory): Inventory holding the scan cache
+    :param days: Expiry horizon in days
+    :param workers (int): Number of parsing processes, one per core if
+                          not set
+    :return expiring (list): (not_after, subject, path) tuples, soonest
+                             first
+    """
+
+    root = os.path.abspath(root)
+    start = time.monotonic()
+    found = find_certs(root)
+    cached = inventory.scanned(root)
+    current = []
+    changed = []
+    for path, mtime_ns, size in found:
+        row = cached.pop(path, None)
+        if row and row[1:3] == (mtime_ns, size):
+            current.append(row)
+        else:
+            changed.append((path, mtime_ns, size))
+
+    if len(changed) <= SCAN_CHUNK:
+        parsed = parse_certs(changed)
+    else:
+        chunks = [changed[i:i + SCAN_CHUNK]
+                  for i in range(0, len(changed), SCAN_CHUNK)]
+        parsed = []
+        with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for rows in executor.map(parse_certs, chunks):
+                parsed.extend(rows)
+    inventory.update_scanned(parsed, list(cached))
+
+    horizon = time.time() + days * 24 * 60 * 60
+    expiring = sorted((row[5], row[4], row[0]) for row in current + parsed
+                      if row[5] is not None and row[5] <= horizon)
+    LOG.info('Scanned {0} files in {1:.1f}s, parsed {2}, {3} certificates '
+             'expire within {4} days'.format(len(found),
+                                             time.monotonic() - start,
+                                             len(parsed), len(expiring),
+                                             days))
+    return expiring
+
+
+def measure_rate(operation, seconds):
+    """
+    Run an operation repeatedly for about seconds
+
+    :param operation: Callable taking no arguments
+    :param seconds:
+    :return rate (float): Operations per second
+    """
+
+    count = 0
+    start = time.monotonic()
+    while True:
+        operation()
+        count += 1
+        elapsed = time.monotonic() - start
+        if elapsed >= seconds:
+            return count / elapsed
+
+
+def benchmark(seconds=2, keys=BENCHMARK_KEYS):
+    """
+    Measure the key generation, CSR, signing and PEM serialization rates
+    of each key type and size on this machine, printing one line each.
+    Each certificate is self-signed with its own key.
+
+    :param seconds: Time spent on each measurement
+    :param keys (list): (algo_type, bits) tuples to measure
+    :return results (list): One dict of rates per key type and size
+    """
+
+    cert_gen = CertificateGenerator()
+    subject = dict(SUBJECT, CN='benchmark.example.com')
+    results = []
+    print('{0:<12} {1:>10} {2:>10} {3:>10} {4:>10}'.format(
+        'key', 'keygen/s', 'csr/s', 'sign/s', 'pem/s'))
+    for algo_type, bits in keys:
+        key = cert_gen.generate_keypair(algo_type, bits)
+        req = cert_gen.generate_csr(key, **subject)
+        cert = cert_gen.generate_certificate(req, req, key, 1, 0, 3600)
+        cert_data = {'fname': 'benchmark', 'req': req, 'key': key,
+                     'cert': cert}
+        result = {
+            'key': '{0}-{1}'.format(KEY_TYPE_NAMES[algo_type], bits),
+            'keygen': measure_rate(
+                lambda: cert_gen.generate_keypair(algo_type, bits), seconds),
+            'csr': measure_rate(
+                lambda: cert_gen.generate_csr(key, **subject), seconds),
+            'sign': measure_rate(
+                lambda: cert_gen.generate_certificate(req, req, key, 1, 0,
+                                                      3600), seconds),
+            'pem': measure_rate(
+                lambda: cert_gen.dump_cert_data(**cert_data), seconds),
+        }
+        print('{key:<12} {keygen:>10.1f} {csr:>10.1f} {sign:>10.1f} '
+              '{pem:>10.1f}'.format(**result))
+        results.append(result)
+    return results
 
 
 def main():
@@ -206,15 +1433,134 @@ def main():
         default=4096,
         type=int,
         help="Number of bits to use in the private keys")
+    parser.add_argument(
+        '--key-type', action='store',
+        default='rsa',
+        choices=['rsa', 'ec', 'ed25519'],
+        help="Type of the private keys")
+    parser.add_argument(
+        '--curve', action='store',
+        default='P-256',
+        choices=sorted(CURVE_NAMES),
+        help="Curve of the private keys with --key-type ec")
     parser.add_argument(
         '--years', action='store',
         default=1,
         type=int,
         help="Number of years that the certs are valid")
+    parser.add_argument(
+        '--batch', action='store',
+        help="File listing a hostname and optional extra DNS names on each "
+             "line; issues a certificate for each of them signed by one CA "
+             "named after --hostname")
+    parser.add_argument(
+        '--workers', action='store',
+        type=int,
+        help="Number of key generating processes with --batch and cert "
+             "parsing processes with --scan, one per core if not set")
+    parser.add_argument(
+        '--output-dir', action='store',
+        default=os.getcwd(),
+        help="Directory the per-host certificate directories are "
+             "created in")
+    parser.add_argument(
+        '--output-format', action='store',
+        default='files',
+        choices=OUTPUT_FORMATS,
+        help="Write a .csr, .pkey and .cert per certificate, one .pem "
+             "with the key, certificate and CA, or the same as a PKCS#12 "
+             ".p12")
+    parser.add_argument(
+        '--archive', action='store',
+        help="Write everything into this tar or zip archive instead of "
+             "--output-dir, one of {0}".format(', '.join(ARCHIVE_SUFFIXES)))
+    parser.add_argument(
+        '--fsync', action='store_true',
+        default=False,
+        help="Flush the written files to disk, {0} at a time".format(
+            FSYNC_BATCH))
+    parser.add_argument(
+        '--pkcs12-password-file', action='store',
+        help="File holding the password the .p12 bundles are encrypted "
+             "with, unencrypted if not set")
+    parser.add_argument(
+        '--key-pool', action='store',
+        help="Directory of pre-generated private keys to take keys from")
+    parser.add_argument(
+        '--key-pool-size', action='store',
+        default=KEY_POOL_SIZE,
+        type=int,
+        help="Number of keys --fill-key-pool and --refill-key-pool keep "
+             "in the pool")
+    parser.add_argument(
+        '--fill-key-pool', action='store_true',
+        default=False,
+        help="Fill the key pool for --key-type and its size and exit")
+    parser.add_argument(
+        '--refill-key-pool', action='store_true',
+        default=False,
+        help="Keep the key pool full at the lowest CPU priority until "
+             "stopped")
+    parser.add_argument(
+        '--ca-cert', action='store',
+        help="Sign with this existing CA certificate instead of creating "
+             "a CA, needs --ca-key")
+    parser.add_argument(
+        '--ca-key', action='store',
+        help="Private key of --ca-cert")
+    parser.add_argument(
+        '--ca-dir', action='store',
+        help="Directory holding an existing CA written by this script, "
+             "instead of --ca-cert and --ca-key")
+    parser.add_argument(
+        '--csr', action='store',
+        help="Sign this certificate request with the existing CA and "
+             "write the certificate to --output-dir, keeping the "
+             "subjectAltName the request asks for")
+    parser.add_argument(
+        '--serve', action='store',
+        help="Keep the existing CA loaded and sign requests on this Unix "
+             "socket until interrupted")
+    parser.add_argument(
+        '--inventory', action='store',
+        help="Database recording the issued certificates and their "
+             "serials, and caching --scan results. Certificates are only "
+             "recorded when this is set, --scan defaults to {0} in "
+             "--output-dir".format(INVENTORY))
+    parser.add_argument(
+        '--scan', action='store',
+        help="List the certificates below this directory that expire "
+             "within --expires-within days and exit")
+    parser.add_argument(
+        '--expires-within', action='store',
+        default=30,
+        type=float,
+        help="Number of days --scan looks ahead")
+    parser.add_argument(
+        '--benchmark', action='store_true',
+        default=False,
+        help="Measure keygen, CSR, signing and PEM rates of each key type "
+             "and size on this machine and exit")
+    parser.add_argument(
+        '--benchmark-seconds', action='store',
+        default=2,
+        type=float,
+        help="Time spent on each --benchmark measurement")
     parser.add_argument(
         '-v', '--verbose', action='count', default=0,
         help="Increase verbosity (specify multiple times for more)")
     args = parser.parse_args()
+    if (args.fill_key_pool or args.refill_key_pool) and not args.key_pool:
+        parser.error('--fill-key-pool and --refill-key-pool need '
+                     '--key-pool')
+    if bool(args.ca_cert) != bool(args.ca_key):
+        parser.error('--ca-cert and --ca-key go together')
+    if (args.csr or args.serve) and not (args.ca_cert or args.ca_dir):
+        parser.error('--csr and --serve need --ca-cert/--ca-key or '
+                     '--ca-dir')
+    if args.archive and not args.archive.endswith(ARCHIVE_SUFFIXES):
+        parser.error('--archive must end with one of {0}'.format(
+            ', '.join(ARCHIVE_SUFFIXES)))
 
     log_level = logging.INFO
     if args.verbose >= 1:
@@ -223,21 +1569,111 @@ def main():
     format = '%(asctime)s - %(levelname)s - %(message)s'
     logging.basicConfig(format=format, datefmt='%m-%d %H:%M', level=log_level)
 
+    if args.benchmark:
+        benchmark(args.benchmark_seconds)
+        return
+
+    inventory = None
+    if args.inventory or args.scan:
+        inventory = Inventory(args.inventory or
+                              os.path.join(args.output_dir, INVENTORY))
+    if args.scan:
+        now = time.time()
+        for not_after, subject, path in scan(args.scan, inventory,
+                                             args.expires_within,
+                                             args.workers):
+            print('{0} {1:>6d} {2} {3}'.format(
+                datetime.fromtimestamp(not_after, timezone.utc).strftime(
+                    '%Y-%m-%d'), int((not_after - now) / (24 * 60 * 60)),
+                subject, path))
+        return
+
     cname = args.hostname
+    algo_type = KEY_TYPES[args.key_type]
     bits = args.key_bits
+    if algo_type == TYPE_EC:
+        bits = CURVE_NAMES[args.curve]
+    elif algo_type == TYPE_ED25519:
+        bits = 256
     years = args.years
-    local_dir = os.path.join(os.getcwd(), cname.replace('.', '-'))
-    cert_gen = CertificateGenerator()
-    cert_gen.create_local_path(local_dir)
-
-    if args.create_ca:
-        ca_data = cert_gen.generate_cert_data(cname, bits, years)
-        LOG.info('ca_data {0}'.format(ca_data))
-        cert_gen.write_certs(local_dir, **ca_data)
-        client_data = cert_gen.generate_cert_data(cname, bits, years,
-                                                  **ca_data)
-        LOG.info('client_data {0}'.format(client_data))
-        cert_gen.write_certs(local_dir, **client_data)
+    key_pool = None
+    if args.key_pool:
+        key_pool = KeyPool(args.key_pool, algo_type, bits, args.key_pool_size)
+    if args.fill_key_pool:
+        key_pool.fill()
+        return
+    if args.refill_key_pool:
+        key_pool.refill_forever()
+
+    output = args.archive or args.output_dir
+    password = None
+    if args.pkcs12_password_file:
+        with open(args.pkcs12_password_file, 'rb') as password_file:
+            password = password_file.readline().rstrip(b'\r\n')
+
+    cert_gen = CertificateGenerator(key_pool, inventory)
+    ca_data = None
+    if args.ca_cert or args.ca_dir:
+        try:
+            ca_cert, ca_key = find_ca(args.ca_dir) if args.ca_dir else \
+                (args.ca_cert, args.ca_key)
+            ca_data = cert_gen.load_ca(ca_cert, ca_key)
+        except (OSError, ValueError, crypto.Error) as e:
+            parser.error('Cannot load the CA: {0}'.format(e))
+
+    if args.serve:
+        if key_pool:
+            key_pool.start_refill()
+        CertificateSigner(ca_data, years, key_pool, algo_type, bits,
+                          inventory).serve(args.serve)
+        return
+
+    if args.csr:
+        with open(args.csr, 'rb') as csr_file:
+            req = crypto.load_certificate_request(crypto.FILETYPE_PEM,
+                                                  csr_file.read())
+        cert = cert_gen.sign_csr(req, years, **ca_data)
+        cert_name = '{0}.cert'.format(req.get_subject().CN.replace('.', '-'))
+        with open_output(output, args.fsync) as writer:
+            writer.write(cert_name, crypto.dump_certificate(
+                crypto.FILETYPE_PEM, cert))
+        LOG.info('Wrote {0} to {1}'.format(cert_name, output))
+        return
+
+    local_dir = cname.replace('.', '-')
+    failures = 0
+    with open_output(output, args.fsync) as writer:
+        if args.batch:
+            hosts = load_batch(args.batch)
+            if not ca_data:
+                ca_data = cert_gen.generate_cert_data(cname, bits, years,
+                                                      algo_type=algo_type)
+                write_bundle(writer, local_dir,
+                             cert_gen.dump_cert_data(**ca_data),
+                             args.output_format, password=password)
+            failures = issue_batch(hosts, writer, ca_data, bits, years,
+                                   args.workers, key_pool, algo_type,
+                                   inventory, args.output_format, password)
+        elif args.create_ca:
+            if not ca_data:
+                ca_data = cert_gen.generate_cert_data(cname, bits, years,
+                                                      algo_type=algo_type)
+                LOG.info('ca_data {0}'.format(ca_data))
+                write_bundle(writer, local_dir,
+                             cert_gen.dump_cert_data(**ca_data),
+                             args.output_format, password=password)
+            client_data = cert_gen.generate_cert_data(cname, bits, years,
+                                                      algo_type=algo_type,
+                                                      **ca_data)
+            LOG.info('client_data {0}'.format(client_data))
+            write_bundle(writer, local_dir,
+                         cert_gen.dump_cert_data(**client_data),
+                         args.output_format,
+                         crypto.dump_certificate(crypto.FILETYPE_PEM,
+                                                 ca_data['cert']),
+                         password)
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
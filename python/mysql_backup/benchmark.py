@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+"""
+Benchmark mysql_backup against a local stand-in for a database host.
+
+A paramiko SSH/SFTP server runs in its own process and executes the
+commands mysql_backup sends with a local bash, where sudo is a no-op and
+mysqldump prints a pre-generated synthetic dump. A TCP proxy between the
+client and that server adds latency and caps bandwidth. Each scenario
+runs in a fresh client process so its peak RSS is measured on its own.
+Everything runs offline on one Linux box.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+
+from queue import Empty, Queue
+
+import paramiko
+
+# Local imports
+import mysql_backup
+
+LOG = logging.getLogger(__name__)
+DATABASE = 'benchmark'
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark'
+BLOCK_SIZE = 1024 * 1024
+UNIQUE_BLOCKS = 64
+WORDS = [b'alpha', b'bravo', b'charlie', b'delta', b'echo', b'foxtrot',
+         b'golf', b'hotel', b'india', b'juliet', b'kilo', b'lima']
+
+
+def parse_size(size):
+    """
+    Parse a size such as 512K, 256M or 2G into bytes
+
+    :param size (str):
+    :return (int):
+    """
+
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    size = size.strip().upper()
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def synthetic_block(rng, compressibility):
+    """
+    Build about BLOCK_SIZE bytes of INSERT statements. compressibility is
+    the share of each row made of repeated words rather than random hex.
+
+    :param rng (random.Random):
+    :param compressibility (float): 0.0 to 1.0
+    :return (bytes):
+    """
+
+    rows = []
+    size = 0
+    row_id = 0
+    while size < BLOCK_SIZE:
+        words = b' '.join(rng.choice(WORDS) for _ in range(
+            int(16 * compressibility)))
+        noise = rng.getrandbits(int(256 * (1 - compressibility)) * 4 or 4)
+        row = b"(%d,'%s','%x')" % (row_id, words, noise)
+        rows.append(row)
+        size += len(row) + 1
+        row_id += 1
+        if len(rows) == 1000:
+            rows[-1] += b';\nINSERT INTO `t` VALUES '
+    return b'INSERT INTO `t` VALUES ' + b','.join(rows) + b';\n'
+
+
+def generate_dump(path, size, compressibility, seed=0):
+    """
+    Write a synthetic mysqldump of about size bytes. UNIQUE_BLOCKS
+    distinct blocks are cycled, far enough apart that stream compressors
+    don't see the repetition.
+
+    :param path:
+    :param size (int):
+    :param compressibility (float):
+    :param seed (int):
+    """
+
+    rng = random.Random(seed)
+    blocks = [synthetic_block(rng, compressibility)
+              for _ in range(min(UNIQUE_BLOCKS, size // BLOCK_SIZE + 1))]
+    written = 0
+    with open(path, 'wb') as dump:
+        dump.write(b'-- MySQL dump (synthetic benchmark data)\n'
+                   b'CREATE TABLE `t` (`id` int, `a` text, `b` text);\n')
+        while written < size:
+            block = blocks[(written // BLOCK_SIZE) % len(blocks)]
+            dump.write(block)
+            written += len(block)
+
+
+def write_shims(bin_dir, dump_path):
+    """
+    Create the sudo and mysqldump stand-ins the remote commands run with
+
+    :param bin_dir:
+    :param dump_path:
+    """
+
+    shims = {'sudo': '#!/bin/sh\nexec "$@"\n',
+             'mysqldump': '#!/bin/sh\nexec cat {0}\n'.format(dump_path)}
+    for name, script in shims.items():
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as shim:
+            shim.write(script)
+        os.chmod(path, stat.S_IRWXU)
+
+
+class StandInSFTPHandle(paramiko.SFTPHandle):
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(
+            os.fstat(self.readfile.fileno()))
+
+
+class StandInSFTPServer(paramiko.SFTPServerInterface):
+    """Read-only sftp access to the local filesystem"""
+
+    def open(self, path, flags, attr):
+        try:
+            handle = StandInSFTPHandle(flags)
+            handle.readfile = open(path, 'rb')
+            handle.filename = path
+            return handle
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+
+class StandInServer(paramiko.ServerInterface):
+    """
+    Accept any password and run exec requests with a local bash whose
+    PATH starts with the shims
+    """
+
+    def __init__(self, env):
+        self.env = env
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=run_command,
+                         args=(channel, command.decode(), self.env),
+                         daemon=True).start()
+        return True
+
+
+def run_command(channel, command, env):
+    """
+    Run a command for a channel, wiring its stdio to the channel
+
+    :param channel:
+    :param command:
+    :param env:
+    """
+
+    process = subprocess.Popen(['bash', '-c', command], env=env,
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+
+    def feed_stdin():
+        try:
+            for data in iter(lambda: channel.recv(32768), b''):
+                process.stdin.write(data)
+                process.stdin.flush()
+            process.stdin.close()
+        except (OSError, ValueError):
+            pass
+
+    def pump(source, send):
+        for data in iter(lambda: os.read(source.fileno(), 65536), b''):
+            send(data)
+
+    threading.Thread(target=feed_stdin, daemon=True).start()
+    stderr = threading.Thread(target=pump, args=(process.stderr,
+                                                 channel.sendall_stderr))
+    stderr.start()
+    pump(process.stdout, channel.sendall)
+    stderr.join()
+    channel.send_exit_status(process.wait())
+    channel.close()
+
+
+def shape(source, destination, delay, rate):
+    """
+    Forward one direction of a proxied connection, delaying every piece
+    of data by delay seconds and capping throughput at rate bytes/s
+
+    :param source (socket):
+    :param destination (socket):
+    :param delay (float):
+    :param rate (float): 0 for unlimited
+    """
+
+    pending = Queue()
+
+    def read():
+        try:
+            for data in iter(lambda: source.recv(65536), b''):
+                pending.put((time.monotonic() + delay, data))
+        except OSError:
+            pass
+        pending.put(None)
+
+    threading.Thread(target=read, daemon=True).start()
+    next_free = time.monotonic()
+    while True:
+        item = pending.get()
+        if item is None:
+            break
+        due, data = item
+        if rate:
+            due = max(due, next_free)
+            next_free = due + len(data) / rate
+        pause = due - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        destination.sendall(data)
+    try:
+        destination.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+def serve_proxy(listener, server_port, latency, rate):
+    """
+    Accept client connections and forward them to the SSH server through
+    shape in both directions
+
+    :param listener (socket):
+    :param server_port:
+    :param latency (float): Round trip latency to add, in seconds
+    :param rate (float): Bandwidth cap per direction in bytes/s
+    """
+
+    while True:
+        client, _ = listener.accept()
+        upstream = socket.create_connection(('127.0.0.1', server_port))
+        for source, destination in ((client, upstream), (upstream, client)):
+            threading.Thread(target=shape,
+                             args=(source, destination, latency / 2, rate),
+                             daemon=True).start()
+
+
+def serve(workdir, size, compressibility, latency, rate, ready):
+    """
+    Run the stand-in database host until the process is terminated. The
+    caller removes workdir, terminating the process skips any cleanup here.
+
+    :param workdir: Empty directory for the dump, shims and remote files
+    :param size: Size of the synthetic dump in bytes
+    :param compressibility:
+    :param latency: Round trip latency to add, in seconds
+    :param rate: Bandwidth cap in bytes/s, 0 for unlimited
+    :param ready (multiprocessing.Queue): Receives the proxy port and the
+                                          remote backup directory
+    """
+
+    bin_dir = os.path.join(workdir, 'bin')
+    remote_dir = os.path.join(workdir, 'remote')
+    os.makedirs(bin_dir)
+    os.makedirs(remote_dir)
+    dump_path = os.path.join(workdir, 'dump.sql')
+    generate_dump(dump_path, size, compressibility)
+    write_shims(bin_dir, dump_path)
+    env = dict(os.environ, PATH='{0}:{1}'.format(bin_dir,
+                                                 os.environ['PATH']))
+    host_key = paramiko.RSAKey.generate(2048)
+
+    server_socket = socket.socket()
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(16)
+    proxy_socket = socket.socket()
+    proxy_socket.bind(('127.0.0.1', 0))
+    proxy_socket.listen(16)
+    threading.Thread(target=serve_proxy,
+                     args=(proxy_socket, server_socket.getsockname()[1],
+                           latency, rate), daemon=True).start()
+    ready.put((proxy_socket.getsockname()[1], remote_dir,
+               os.path.getsize(dump_path)))
+
+    while True:
+        sock, _ = server_socket.accept()
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer,
+                                        StandInSFTPServer)
+        transport.start_server(server=StandInServer(env))
+
+
+def run_scenario(port, remote_dir, local_dir, scenario, results):
+    """
+    Run one backup against the stand-in and report its metrics. A
+    scenario that raises is reported as failed with its error.
+
+    :param port: Port of the stand-in's proxy
+    :param remote_dir:
+    :param local_dir: Empty directory for the backup, the caller removes it
+    :param scenario (dict): mode, codec, compress_on and transport, the
+                            name of one of TUNE_PROFILES
+    :param results (multiprocessing.Queue):
+    """
+
+    metrics = mysql_backup.BackupMetrics('stand-in', DATABASE)
+    ssh = paramiko.SSHClient()
+    backup = None
+    stored = 0
+    error = None
+    start = time.monotonic()
+    try:
+        with metrics.stage('connect'):
+            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh.connect('127.0.0.1', port=port, username=USERNAME,
+                        password=PASSWORD, look_for_keys=False,
+                        allow_agent=False, **mysql_backup.connect_options(
+                            mysql_backup.TUNE_PROFILES[
+                                scenario['transport']]))
+        options = {'metrics': metrics,
+                   'codec': mysql_backup.Codec(scenario['codec']),
+                   'compress_on': scenario['compress_on']}
+        if scenario['mode'] == 'stream':
+            options['stream'] = True
+        elif scenario['mode'] == 'repository':
+            options['repository'] = os.path.join(local_dir, 'repository')
+        backup = mysql_backup.run_backup(ssh, DATABASE, local_dir,
+                                         remote_dir, **options)
+        if backup:
+            stored = mysql_backup.path_size(options.get('repository',
+                                                        backup))
+    except Exception as e:
+        LOG.exception('Scenario {0} failed'.format(scenario))
+        error = '{0}: {1}'.format(type(e).__name__, e)
+    finally:
+        elapsed = time.monotonic() - start
+        ssh.close()
+    results.put(dict(scenario, success=bool(backup), seconds=elapsed,
+                     stored_bytes=stored, stages=metrics.stages,
+                     error=error, peak_rss_kb=resource.getrusage(
+                         resource.RUSAGE_SELF).ru_maxrss))
+
+
+def wait_for(queue, process, timeout=None):
+    """
+    Get the message a process puts on queue
+
+    :param queue (multiprocessing.Queue):
+    :param process (multiprocessing.Process):
+    :param timeout: Seconds to wait, None to wait while the process lives
+    :return: The message, None if the process exited without one or the
+             timeout passed
+    """
+
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive():
+                # It may have put the message just before exiting
+                try:
+                    return queue.get(timeout=1)
+                except Empty:
+                    return None
+            if deadline and time.monotonic() > deadline:
+                return None
+
+
+def failed_result(scenario, error):
+    """
+    Result of a scenario whose process died or timed out before reporting
+
+    :param scenario (dict):
+    :param error:
+    :return (dict):
+    """
+
+    return dict(scenario, success=False, seconds=0, stored_bytes=0,
+                stages=[], error=error, peak_rss_kb=0)
+
+
+def report(results, dump_size):
+    """
+    Print a throughput table for the scenarios
+
+    :param results (list):
+    :param dump_size: Size of the synthetic dump in bytes
+    """
+
+    print('{0:<11} {1:<5} {2:<7} {3:<15} {4:>9} {5:>9} {6:>8} '
+          '{7:>10}'.format('mode', 'codec', 'on', 'transport', 'seconds',
+                           'MB/s', 'ratio', 'peak RSS'))
+    for result in results:
+        if result.get('error'):
+            print('{0:<11} {1:<5} {2:<7} {3:<15} failed: {4}'.format(
+                result['mode'], result['codec'], result['compress_on'],
+                result['transport'], result['error']))
+            continue
+        print('{0:<11} {1:<5} {2:<7} {3:<15} {4:>9.2f} {5:>9.1f} {6:>8.2f} '
+              '{7:>8.1f}MB'.format(
+                  result['mode'], result['codec'], result['compress_on'],
+                  result['transport'], result['seconds'],
+                  dump_size / result['seconds'] / 1e6,
+                  dump_size / max(result['stored_bytes'], 1),
+                  result['peak_rss_kb'] / 1024.0))
+        for stage in result['stages']:
+            print('    {0:<14} {1:>8.3f}s {2:>10} MB/s'.format(
+                stage['stage'], stage['seconds'], str(stage['mb_per_s'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '--size', action='store',
+        default='256M',
+        help="Size of the synthetic dump, with an optional K/M/G suffix")
+    parser.add_argument(
+        '--compressibility', action='store',
+        default=0.5,
+        type=float,
+        help="Share of each synthetic row made of repeated words, "
+             "from 0 (random) to 1 (highly compressible)")
+    parser.add_argument(
+        '--latency-ms', action='store',
+        default=0,
+        type=float,
+        help="Round trip latency added between client and server")
+    parser.add_argument(
+        '--bandwidth-mbit', action='store',
+        default=0,
+        type=float,
+        help="Bandwidth cap per direction in Mbit/s, 0 for unlimited")
+    parser.add_argument(
+        '--modes', action='store',
+        default='remote,stream',
+        help="Comma separated backup modes: remote, stream, repository")
+    parser.add_argument(
+        '--codecs', action='store',
+        default='gzip',
+        help="Comma separated codecs to run each mode with")
+    parser.add_argument(
+        '--compress-on', action='store',
+        default='remote',
+        help="Comma separated compression placements: remote, local")
+    parser.add_argument(
+        '--transports', action='store',
+        default='default',
+        help="Comma separated SSH transport profiles to run each "
+             "scenario with, from: {0}".format(', '.join(
+                 sorted(mysql_backup.TUNE_PROFILES))))
+    parser.add_argument(
+        '--repeat', action='store',
+        default=1,
+        type=int,
+        help="Number of runs of each scenario")
+    parser.add_argument(
+        '--timeout', action='store',
+        default=3600,
+        type=float,
+        help="Seconds a scenario may run before it is stopped and "
+             "reported as failed")
+    parser.add_argument(
+        '--json', action='store',
+        help="Also write the raw results to this JSON file")
+    parser.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="Increase verbosity (specify multiple times for more)")
+    args = parser.parse_args()
+
+    log_level = logging.WARNING
+    if args.verbose >= 1:
+        log_level = logging.INFO
+
+    format = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(format=format, datefmt='%m-%d %H:%M', level=log_level)
+
+    context = multiprocessing.get_context('spawn')
+    ready = context.Queue()
+    workdir = tempfile.mkdtemp(prefix='mysql-backup-bench-')
+    server = context.Process(target=serve, daemon=True, args=(
+        workdir, parse_size(args.size), args.compressibility,
+        args.latency_ms / 1000.0, args.bandwidth_mbit * 1e6 / 8, ready))
+    server.start()
+
+    results = []
+    try:
+        started = wait_for(ready, server)
+        if not started:
+            raise SystemExit('The stand-in host exited with status '
+                             '{0}'.format(server.exitcode))
+        port, remote_dir, dump_size = started
+        for mode in args.modes.split(','):
+            for codec in args.codecs.split(','):
+                for compress_on in args.compress_on.split(','):
+                    for transport in args.transports.split(','):
+                        scenario = {'mode': mode, 'codec': codec,
+                                    'compress_on': compress_on,
+                                    'transport': transport}
+                        for _ in range(args.repeat):
+                            queue = context.Queue()
+                            local_dir = tempfile.mkdtemp(
+                                prefix='mysql-backup-bench-local-')
+                            client = context.Process(
+                                target=run_scenario,
+                                args=(port, remote_dir, local_dir, scenario,
+                                      queue))
+                            client.start()
+                            result = wait_for(queue, client, args.timeout)
+                            if result is None and client.is_alive():
+                                client.terminate()
+                                result = failed_result(
+                                    scenario, 'timed out after {0}s'.format(
+                                        args.timeout))
+                            client.join()
+                            shutil.rmtree(local_dir, ignore_errors=True)
+                            if result is None:
+                                result = failed_result(
+                                    scenario, 'exited with status {0}'.format(
+                                        client.exitcode))
+                            results.append(result)
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report(results, dump_size)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'dump_size': dump_size, 'results': results},
+                      json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
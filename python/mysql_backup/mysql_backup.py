@@ -1,29 +1,531 @@
 #!/usr/bin/env python3
 import argparse
+import fcntl
+import gzip
+import hashlib
+import heapq
+import json
 import paramiko
 import logging
 import os
+import random
+import re
+import shlex
+import shutil
+import signal
+import socket
+import socketserver
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
 
-from datetime import datetime
+from concurrent import futures
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
 LOG = logging.getLogger(__name__)
 SSH_USER = "centos"
+CHUNK_SIZE = 1024 * 1024
+PREFETCH_WINDOW = 16
+TRANSFER_ATTEMPTS = 3
+TRANSFER_RETRY_DELAY = 5
+PARALLEL_JOBS = 4
+SNAPSHOT_TIMEOUT = 60
+PROGRESS_INTERVAL = 10
+MANIFEST = 'manifest.json'
+COMMANDS = ('backup', 'restore', 'extract', 'verify', 'list', 'latest',
+            'prune', 'daemon', 'trigger', 'status', 'tune')
+CATALOG = 'catalog.db'
+CHECKSUM_SUFFIX = '.sha256'
+CODECS = {
+    'gzip': {'suffix': '.gz', 'magic': b'\x1f\x8b', 'command': 'gzip',
+             'threads': None, 'all_threads': None},
+    'pigz': {'suffix': '.gz', 'magic': b'\x1f\x8b', 'command': 'pigz',
+             'threads': '-p {0}', 'all_threads': None},
+    'zstd': {'suffix': '.zst', 'magic': b'\x28\xb5\x2f\xfd',
+             'command': 'zstd -q', 'threads': '-T{0}', 'all_threads': '-T0'},
+    'lz4': {'suffix': '.lz4', 'magic': b'\x04\x22\x4d\x18',
+            'command': 'lz4 -q', 'threads': None, 'all_threads': None},
+    'none': {'suffix': '', 'magic': None, 'command': None,
+             'threads': None, 'all_threads': None},
+}
+CHUNK_MIN = 16 * 1024
+CHUNK_MAX = 256 * 1024
+CHUNK_MASK = 0x1f
+BINLOG_COORDINATES = re.compile(r"(?:MASTER|SOURCE)_LOG_FILE='([^']+)', "
+                                r"(?:MASTER|SOURCE)_LOG_POS=(\d+)")
 
+SCHEDULE_OPTIONS = ('stream', 'per_table', 'jobs', 'incremental',
+                    'repository', 'codec', 'level', 'threads', 'compress_on')
+RECONNECT_BACKOFF = (5, 600)
+DAEMON_SOCKET = '/tmp/mysql_backup.sock'
+# SSH transport settings create_connection takes, a setting left out keeps
+# paramiko's default
+TRANSPORT_OPTIONS = ('ciphers', 'macs', 'window_size', 'max_packet_size',
+                     'compress')
+# Transport settings tune_transport measures against a host
+TUNE_PROFILES = {
+    'default': {},
+    'wide': {'window_size': 16 * 1024 * 1024,
+             'max_packet_size': 64 * 1024},
+    'gcm-wide': {'ciphers': ['aes128-gcm@openssh.com'],
+                 'window_size': 16 * 1024 * 1024,
+                 'max_packet_size': 64 * 1024},
+    'compressed-wide': {'window_size': 16 * 1024 * 1024,
+                        'max_packet_size': 64 * 1024, 'compress': True},
+}
+# Text the tuning probe reads, moderately compressible like a dump
+# compressed on this host rather than remotely
+TUNE_COMMAND = 'head -c {0} /dev/urandom | base64'
+TUNE_BYTES = 32 * 1024 * 1024
+TUNE_MAX_AGE = 7 * 24 * 60 * 60
+TUNE_CACHE = os.path.expanduser('~/.mysql_backup_transport.json')
 
-def backup_database(ssh, database, directory):
+_catalog_lock = threading.Lock()
+
+
+class Codec:
+    """
+    A compression program and its settings. The same program is used
+    whether it runs on the database host or on the backup host, so a
+    backup can be restored wherever the program is installed.
+    """
+
+    def __init__(self, name='gzip', level=None, threads=0):
+        """
+        :param name: One of CODECS
+        :param level (int): Compression level, the program's default
+                            when None
+        :param threads (int): Compression threads, 0 for all cores on
+                              codecs that support threads
+        """
+
+        self.name = name
+        self.level = level
+        self.threads = threads
+        self.settings = CODECS[name]
+
+    @property
+    def suffix(self):
+        return self.settings['suffix']
+
+    @classmethod
+    def detect(cls, path):
+        """
+        Return the codec of a compressed file from its header
+
+        :param path:
+        :return (Codec):
+        """
+
+        with open(path, 'rb') as compressed_file:
+            header = compressed_file.read(4)
+        for name in ('gzip', 'zstd', 'lz4'):
+            if header.startswith(CODECS[name]['magic']):
+                return cls(name)
+        return cls('none')
+
+    def compress_command(self):
+        """
+        Return the command compressing stdin to stdout, or None for none
+
+        :return command (str):
+        """
+
+        if not self.settings['command']:
+            return None
+        command = [self.settings['command']]
+        if self.level is not None:
+            command.append('-{0}'.format(self.level))
+        if self.threads and self.settings['threads']:
+            command.append(self.settings['threads'].format(self.threads))
+        elif self.settings['all_threads']:
+            command.append(self.settings['all_threads'])
+        command.append('-c')
+        return ' '.join(command)
+
+    def decompress_command(self):
+        """
+        Return the command decompressing stdin to stdout
+
+        :return command (str):
+        """
+
+        if not self.settings['command']:
+            return 'cat'
+        return '{0} -dc'.format(self.settings['command'])
+
+    def local_process(self, output, decompress=False):
+        """
+        Start the codec on the local host, writing to output
+
+        :param output: File object the codec's output is written to
+        :param decompress:
+        :return (CodecProcess):
+        """
+
+        command = self.decompress_command() if decompress \
+            else self.compress_command()
+        return CodecProcess(command, output)
+
+
+class CodecProcess:
+    """
+    A codec running on the local host. Input is fed with write() and a
+    thread copies the output to a file object, so wrappers like
+    DigestFile see every byte that reaches the disk.
+    """
+
+    def __init__(self, command, output):
+        args = shlex.split(command)
+        if not shutil.which(args[0]):
+            raise OSError('{0} is not installed on the local host'.format(
+                args[0]))
+        self.name = args[0]
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self._copy = threading.Thread(target=shutil.copyfileobj,
+                                      args=(self.process.stdout, output,
+                                            CHUNK_SIZE))
+        self._copy.start()
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        """
+        Wait for the codec to finish
+
+        :raises OSError: if the codec failed
+        """
+
+        self.process.stdin.close()
+        self._copy.join()
+        self.process.stdout.close()
+        if self.process.wait() > 0:
+            raise OSError('{0} exited with status {1}'.format(
+                self.name, self.process.returncode))
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self._copy.join()
+        self.process.stdout.close()
+
+
+class DigestFile:
+    """
+    A local file that computes the SHA-256 of everything written to it,
+    so a checksum costs no extra read pass
+    """
+
+    def __init__(self, path, mode='wb'):
+        self.path = path
+        self.file = open(path, mode)
+        self.hash = hashlib.sha256()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def fsync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class BackupMetrics:
+    """
+    Wall time and byte counts of each stage of one backup job, written
+    out as JSON lines and Prometheus textfile metrics
+    """
+
+    def __init__(self, server, database):
+        self.server = server
+        self.database = database
+        self.started = time.time()
+        self.stages = []
+        self.success = False
+
+    def add(self, stage, seconds, bytes_in=None, bytes_out=None):
+        """
+        Record a finished stage
+
+        :param stage: Stage name
+        :param seconds: Wall time of the stage
+        :param bytes_in: Bytes the stage consumed, if known
+        :param bytes_out: Bytes the stage produced, if known
+        """
+
+        moved = bytes_out if bytes_out is not None else bytes_in
+        record = {'stage': stage, 'seconds': round(seconds, 3),
+                  'bytes_in': bytes_in, 'bytes_out': bytes_out,
+                  'mb_per_s': None, 'ratio': None}
+        if moved is not None and seconds > 0:
+            record['mb_per_s'] = round(moved / seconds / 1000000, 3)
+        if bytes_in and bytes_out:
+            record['ratio'] = round(bytes_in / bytes_out, 3)
+        self.stages.append(record)
+        LOG.info('{0}/{1} {2}: {3:.3f}s, {4} bytes in, {5} bytes out, '
+                 '{6} MB/s'.format(self.server, self.database, stage,
+                                   seconds, bytes_in, bytes_out,
+                                   record['mb_per_s']))
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block as a stage. The yielded dict takes
+        bytes_in and bytes_out.
+
+        :param name: Stage name
+        """
+
+        counts = {'bytes_in': None, 'bytes_out': None}
+        start = time.monotonic()
+        try:
+            yield counts
+        finally:
+            self.add(name, time.monotonic() - start, **counts)
+
+    def to_dict(self):
+        return {'time': datetime.fromtimestamp(self.started).isoformat(),
+                'server': self.server, 'database': self.database,
+                'success': self.success,
+                'seconds': round(time.time() - self.started, 3),
+                'stages': self.stages}
+
+
+def path_size(path):
+    """
+    Return the size of a file, or of every file below a directory
+
+    :param path:
+    :return size (int):
+    """
+
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+
+def write_metrics(path, metrics):
+    """
+    Append one JSON line per backup job to a metrics file
+
+    :param path:
+    :param metrics (list): BackupMetrics of each job
+    """
+
+    with open(path, 'a') as metrics_file:
+        for job in metrics:
+            metrics_file.write(json.dumps(job.to_dict(), sort_keys=True) +
+                               '\n')
+
+
+def write_prometheus(path, metrics):
+    """
+    Write the jobs' metrics in the node_exporter textfile collector format,
+    replacing the file atomically
+
+    :param path:
+    :param metrics (list): BackupMetrics of each job
+    """
+
+    lines = [
+        '# HELP mysql_backup_success Whether the last backup succeeded',
+        '# TYPE mysql_backup_success gauge',
+        '# HELP mysql_backup_duration_seconds Wall time of the last backup',
+        '# TYPE mysql_backup_duration_seconds gauge',
+        '# HELP mysql_backup_timestamp_seconds Start time of the last backup',
+        '# TYPE mysql_backup_timestamp_seconds gauge',
+        '# HELP mysql_backup_stage_duration_seconds Wall time of a stage',
+        '# TYPE mysql_backup_stage_duration_seconds gauge',
+        '# HELP mysql_backup_stage_bytes Bytes consumed or produced by a '
+        'stage',
+        '# TYPE mysql_backup_stage_bytes gauge',
+    ]
+    for job in metrics:
+        job_data = job.to_dict()
+        labels = 'server="{0}",database="{1}"'.format(job.server,
+                                                      job.database)
+        lines.append('mysql_backup_success{{{0}}} {1}'.format(
+            labels, int(job.success)))
+        lines.append('mysql_backup_duration_seconds{{{0}}} {1}'.format(
+            labels, job_data['seconds']))
+        lines.append('mysql_backup_timestamp_seconds{{{0}}} {1}'.format(
+            labels, int(job.started)))
+        for stage in job.stages:
+            stage_labels = '{0},stage="{1}"'.format(labels, stage['stage'])
+            lines.append(
+                'mysql_backup_stage_duration_seconds{{{0}}} {1}'.format(
+                    stage_labels, stage['seconds']))
+            for direction in ('in', 'out'):
+                count = stage['bytes_' + direction]
+                if count is not None:
+                    lines.append(
+                        'mysql_backup_stage_bytes{{{0},direction="{1}"}} '
+                        '{2}'.format(stage_labels, direction, count))
+    with open(path + '.tmp', 'w') as prometheus_file:
+        prometheus_file.write('\n'.join(lines) + '\n')
+    os.rename(path + '.tmp', path)
+
+
+class ConnectionPool:
+    """
+    Hand out one authenticated SSHClient per host so that every job run
+    against that host shares a single transport, and limit how many jobs
+    may use a host at the same time.
+    """
+
+    def __init__(self, username, per_host=2, keepalive=0, backoff=None,
+                 timeout=None, tuner=None):
+        """
+        :param username:
+        :param per_host: Maximum number of jobs using a host at once
+        :param keepalive: Seconds between keep-alive packets on idle
+                          connections, 0 to send none
+        :param backoff (tuple): First and longest delay in seconds before
+                                reconnecting to a host that failed,
+                                doubling after every failure. A failed
+                                host is never retried when None.
+        :param timeout: Connect timeout, create_connection's default
+                        when None
+        :param tuner (TransportTuner): Chooses the transport settings of
+                                       each host when set
+        """
+
+        self.username = username
+        self.per_host = per_host
+        self.keepalive = keepalive
+        self.backoff = backoff
+        self.timeout = timeout
+        self.tuner = tuner
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._failures = {}
+        self._host_locks = {}
+        self._slots = {}
+
+    def connect(self, hostname):
+        """
+        Open a new connection to hostname with the pool's settings
+
+        :param hostname:
+        :return ssh:
+        """
+
+        options = {}
+        if self.tuner:
+            options['transport'] = self.tuner.options(hostname)
+        if self.timeout is None:
+            ssh = create_connection(hostname, self.username, **options)
+        else:
+            ssh = create_connection(hostname, self.username, self.timeout,
+                                    **options)
+        if self.keepalive:
+            ssh.get_transport().set_keepalive(self.keepalive)
+        return ssh
+
+    def get(self, hostname):
+        """
+        Return the shared client for hostname, connecting on first use
+        and again when the connection was lost. After a failed connect
+        the error is raised without retrying until the backoff delay has
+        passed, or for the rest of the run without a backoff.
+
+        :param hostname:
+        :return ssh:
+        """
+
+        with self._lock:
+            host_lock = self._host_locks.setdefault(hostname,
+                                                    threading.Lock())
+        with host_lock:
+            error, failures, retry_at = self._failures.get(hostname,
+                                                           (None, 0, 0))
+            if error and (self.backoff is None or
+                          time.monotonic() < retry_at):
+                raise error
+            ssh = self._clients.get(hostname)
+            if ssh is not None and not (ssh.get_transport() and
+                                        ssh.get_transport().is_active()):
+                LOG.warning('Connection to {0} was lost, '
+                            'reconnecting'.format(hostname))
+                ssh.close()
+                ssh = None
+            if ssh is None:
+                try:
+                    ssh = self.connect(hostname)
+                except (paramiko.ssh_exception.SSHException, OSError) as e:
+                    delay = 0
+                    if self.backoff:
+                        delay = min(self.backoff[0] * 2 ** failures,
+                                    self.backoff[1])
+                        LOG.warning('Connecting to {0} failed, retrying in '
+                                    '{1}s'.format(hostname, delay))
+                    self._failures[hostname] = (e, failures + 1,
+                                                time.monotonic() + delay)
+                    raise
+                self._failures.pop(hostname, None)
+                self._clients[hostname] = ssh
+            return ssh
+
+    def slot(self, hostname):
+        """
+        Return the semaphore limiting concurrent jobs on hostname
+
+        :param hostname:
+        :return semaphore:
+        """
+
+        with self._lock:
+            return self._slots.setdefault(
+                hostname, threading.BoundedSemaphore(self.per_host))
+
+    def close_all(self):
+        """Close every client held by the pool"""
+
+        with self._lock:
+            for ssh in self._clients.values():
+                ssh.close()
+            self._clients.clear()
+
+
+def backup_database(ssh, database, directory, master_data=False):
     """
     Use paramiko to run mysql dump on the remote host
 
     :param ssh:
     :param database:
     :param backup_dir:
+    :param master_data: Record the binlog coordinates in the dump header
     :return back_path:
     """
 
-    backup_time = datetime.now().strftime('%m-%d-%Y-%H:%M:%S')
-    path = '{0}/{1}-{2}.sql'.format(directory, database, backup_time)
-    mysqldump_cmd = "sudo bash -c 'mysqldump {0} > {1}'".format(database,
-                                                                path)
+    path = '{0}/{1}'.format(directory, backup_filename(database))
+    mysqldump_cmd = "sudo bash -c 'mysqldump {0}{1} > {2}'".format(
+        dump_options(master_data), database, path)
     try:
         _, stdout, stderr = ssh.exec_command(mysqldump_cmd)
         exit_status = stdout.channel.recv_exit_status()
@@ -38,16 +540,31 @@ def backup_database(ssh, database, directory):
                   '{0}'.format(e))
 
 
-def compress_db_backup(ssh, path):
+def backup_filename(database):
+    """
+    Build the timestamped file name used for a database backup
+
+    :param database:
+    :return file_name:
+    """
+
+    backup_time = datetime.now().strftime('%m-%d-%Y-%H:%M:%S')
+    return '{0}-{1}.sql'.format(database, backup_time)
+
+
+def compress_db_backup(ssh, path, codec=None):
     """
-    Compress backup file with remote host's gzip command
+    Compress backup file with the remote host's copy of the codec
 
     :param ssh:
     :param path:
+    :param codec (Codec): gzip with default settings when None
     :return:
     """
-    compress_cmd = 'sudo gzip {0}'.format(path)
-    compressed_path = '{0}.gz'.format(path)
+    codec = codec or Codec()
+    compressed_path = '{0}{1}'.format(path, codec.suffix)
+    compress_cmd = "sudo bash -c '{0} < {1} > {2} && rm -f {1}'".format(
+        codec.compress_command(), path, compressed_path)
     file_list_output = ''
 
     try:
@@ -63,24 +580,278 @@ def compress_db_backup(ssh, path):
     return compressed_path if compressed_path in file_list_output else None
 
 
-def create_connection(hostname, username):
+def compress_local_file(path, codec):
+    """
+    Compress a local file with the codec, replacing the original and
+    its checksum file
+
+    :param path:
+    :param codec (Codec):
+    :return compressed_path:
+    """
+
+    compressed_path = '{0}{1}'.format(path, codec.suffix)
+    try:
+        with open(path, 'rb') as source, \
+                DigestFile(compressed_path) as compressed_file:
+            process = codec.local_process(compressed_file)
+            try:
+                shutil.copyfileobj(source, process, CHUNK_SIZE)
+                process.close()
+            except OSError:
+                process.kill()
+                raise
+        write_checksum(compressed_path, compressed_file.hexdigest())
+    except OSError as e:
+        LOG.error('Compressing {0} failed with error {1}'.format(path, e))
+        if os.path.exists(compressed_path):
+            os.remove(compressed_path)
+        return None
+    os.remove(path)
+    if os.path.exists(path + CHECKSUM_SUFFIX):
+        os.remove(path + CHECKSUM_SUFFIX)
+    return compressed_path
+
+
+def connect_options(transport=None):
+    """
+    Turn transport settings into SSHClient.connect keyword arguments.
+    Preferred ciphers and MACs are moved to the front of paramiko's list,
+    so hosts without them still connect with the others. The window and
+    packet sizes apply to every channel opened on the connection.
+
+    :param transport (dict): Any of TRANSPORT_OPTIONS
+    :return kwargs (dict):
+    """
+
+    transport = transport or {}
+
+    def transport_factory(sock, **kwargs):
+        ssh_transport = paramiko.Transport(
+            sock, default_window_size=transport.get('window_size') or
+            paramiko.common.DEFAULT_WINDOW_SIZE,
+            default_max_packet_size=transport.get('max_packet_size') or
+            paramiko.common.DEFAULT_MAX_PACKET_SIZE, **kwargs)
+        security = ssh_transport.get_security_options()
+        for option, attribute in (('ciphers', 'ciphers'),
+                                  ('macs', 'digests')):
+            preferred = transport.get(option)
+            if not preferred:
+                continue
+            available = getattr(security, attribute)
+            unknown = [name for name in preferred if name not in available]
+            if unknown:
+                LOG.warning('Ignoring unsupported {0} {1}'.format(
+                    option, ', '.join(unknown)))
+            preferred = [name for name in preferred if name in available]
+            setattr(security, attribute, preferred +
+                    [name for name in available if name not in preferred])
+        return ssh_transport
+
+    return {'compress': bool(transport.get('compress')),
+            'transport_factory': transport_factory}
+
+
+def create_connection(hostname, username, timeout=180, transport=None):
     """
     Create a connection to the remote host
 
     :param hostname:
     :param username:
+    :param timeout: Seconds to wait for the TCP connect, the SSH banner
+                    and authentication
+    :param transport (dict): SSH transport settings, see connect_options
     :return:
     """
     LOG.info('Trying to connect')
+    if transport:
+        LOG.debug('Transport settings {0}'.format(transport))
     ssh = paramiko.SSHClient()
     ssh.load_system_host_keys()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(hostname=hostname, username=username, timeout=180,
-                look_for_keys=True)
+    ssh.connect(hostname=hostname, username=username, timeout=timeout,
+                banner_timeout=timeout, auth_timeout=timeout,
+                look_for_keys=True, **connect_options(transport))
 
     return ssh
 
 
+def probe_transport(ssh, size=TUNE_BYTES):
+    """
+    Measure how fast a connection delivers the output of TUNE_COMMAND
+
+    :param ssh:
+    :param size: Random bytes the probe encodes, it reads a third more
+    :return rate (float): Bytes per second, None when the probe failed
+    """
+
+    channel = ssh.get_transport().open_session()
+    channel.exec_command(TUNE_COMMAND.format(size))
+    start = time.monotonic()
+    received = 0
+    for data in iter(lambda: channel.recv(CHUNK_SIZE), b''):
+        received += len(data)
+    elapsed = time.monotonic() - start
+    exit_status = channel.recv_exit_status()
+    channel.close()
+    if exit_status != 0 or not received:
+        LOG.error('Transport probe exited with status {0}'.format(
+            exit_status))
+        return None
+    return received / elapsed
+
+
+def tune_transport(connect, profiles=TUNE_PROFILES, size=TUNE_BYTES):
+    """
+    Probe every transport profile over a new connection and pick the
+    fastest
+
+    :param connect: Callable taking transport settings and returning a
+                    connected SSHClient
+    :param profiles (dict): Transport settings by profile name
+    :param size: Size of each probe
+    :return (name, rates): The fastest profile, None when every probe
+                           failed, and the bytes per second of each
+    """
+
+    rates = {}
+    for name, transport in sorted(profiles.items()):
+        try:
+            ssh = connect(transport)
+        except (paramiko.ssh_exception.SSHException, OSError) as e:
+            LOG.warning('Cannot connect with transport profile {0}: '
+                        '{1}'.format(name, e))
+            continue
+        try:
+            rate = probe_transport(ssh, size)
+        except (paramiko.ssh_exception.SSHException, OSError) as e:
+            LOG.warning('Transport profile {0} failed with error '
+                        '{1}'.format(name, e))
+            rate = None
+        finally:
+            ssh.close()
+        if rate:
+            rates[name] = rate
+            LOG.info('Transport profile {0}: {1:.1f} MB/s'.format(
+                name, rate / 1e6))
+    if not rates:
+        return None, rates
+    return max(rates, key=rates.get), rates
+
+
+def load_transport_cache(path):
+    """
+    :param path:
+    :return cache (dict): Tuned transport by hostname, empty when the
+                          cache is missing or unreadable
+    """
+
+    try:
+        with open(path) as cache_file:
+            return json.load(cache_file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        LOG.warning('Ignoring transport cache {0}: {1}'.format(path, e))
+        return {}
+
+
+def save_transport_cache(path, cache):
+    """
+    Replace the transport cache atomically
+
+    :param path:
+    :param cache (dict):
+    """
+
+    with open(path + '.tmp', 'w') as cache_file:
+        json.dump(cache, cache_file, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+class TransportTuner:
+    """
+    Choose the SSH transport settings of each host: the profile
+    tune_transport found fastest for it, cached for max_age seconds, with
+    settings given explicitly taking precedence
+    """
+
+    def __init__(self, cache_path=TUNE_CACHE, username=SSH_USER,
+                 overrides=None, auto_tune=False, timeout=180,
+                 probe_size=TUNE_BYTES, max_age=TUNE_MAX_AGE):
+        """
+        :param cache_path: JSON file of the tuned profiles
+        :param username:
+        :param overrides (dict): Transport settings applied on top of the
+                                 tuned profile
+        :param auto_tune (bool): Tune hosts without a fresh cached
+                                 profile instead of using the defaults
+        :param timeout: Connect timeout of the probes
+        :param probe_size: Size of each probe
+        :param max_age: Seconds a tuned profile is used for
+        """
+
+        self.cache_path = cache_path
+        self.username = username
+        self.overrides = overrides or {}
+        self.auto_tune = auto_tune
+        self.timeout = timeout
+        self.probe_size = probe_size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+    def cached(self, hostname):
+        """
+        :param hostname:
+        :return entry (dict): The host's fresh cache entry or None
+        """
+
+        entry = load_transport_cache(self.cache_path).get(hostname)
+        if entry and time.time() - entry['time'] < self.max_age:
+            return entry
+        return None
+
+    def tune(self, hostname):
+        """
+        Measure the profiles against hostname and cache the fastest
+
+        :param hostname:
+        :return entry (dict): profile, options, rates and time, or None
+                              when every probe failed
+        """
+
+        LOG.info('Tuning the transport to {0}'.format(hostname))
+        name, rates = tune_transport(
+            lambda transport: create_connection(hostname, self.username,
+                                                self.timeout, transport),
+            size=self.probe_size)
+        if name is None:
+            LOG.error('Cannot tune the transport to {0}'.format(hostname))
+            return None
+        entry = {'profile': name, 'options': TUNE_PROFILES[name],
+                 'rates': rates, 'time': time.time()}
+        LOG.info('Using transport profile {0} for {1}'.format(
+            name, hostname))
+        with self._lock:
+            cache = load_transport_cache(self.cache_path)
+            cache[hostname] = entry
+            save_transport_cache(self.cache_path, cache)
+        return entry
+
+    def options(self, hostname):
+        """
+        :param hostname:
+        :return transport (dict): Settings for create_connection
+        """
+
+        entry = self.cached(hostname)
+        if entry is None and self.auto_tune:
+            entry = self.tune(hostname)
+        transport = dict(entry['options']) if entry else {}
+        transport.update(self.overrides)
+        return transport
+
+
 def create_local_path(path):
     """
     Create local path for backups
@@ -117,24 +888,74 @@ def create_remote_path(ssh, path):
                   '{0}'.format(e))
 
 
-def get_backup_file(ssh, local_path, remote_path):
+def get_backup_file(ssh, local_path, remote_path, chunk_size=CHUNK_SIZE,
+                    window=PREFETCH_WINDOW):
     """
     Retrieve backup file from MySQL host
 
+    The file is read in chunk_size pieces with up to window chunks in
+    flight at once, so memory use is capped at chunk_size * window. Data
+    is written to a .part file which is renamed into place once complete,
+    and an existing .part file is resumed rather than downloaded again.
+    The SHA-256 of the file is computed as it is written and stored in a
+    .sha256 file next to it.
+
     :param ssh:
     :param local_path:
     :param remote_path:
-    :return:
+    :param chunk_size:
+    :param window:
+    :return local_path:
     """
 
     sftp = ssh.open_sftp()
     backup_file = remote_path.split('/')[-1]
     local_path = '/'.join([local_path, backup_file])
+    partial_path = '{0}.part'.format(local_path)
+
+    try:
+        remote_size = sftp.stat(remote_path).st_size
+        offset = 0
+        if os.path.exists(partial_path):
+            offset = os.path.getsize(partial_path)
+            if offset > remote_size:
+                LOG.info('Discarding stale partial file '
+                         '{0}'.format(partial_path))
+                offset = 0
+            else:
+                LOG.info('Resuming {0} at byte {1}'.format(partial_path,
+                                                           offset))
 
-    with sftp.open(remote_path, mode='rb') as remote_file:
-        contents = remote_file.read()
-        with open(local_path, 'wb') as local_file:
-            local_file.write(contents)
+        mode = 'ab' if offset else 'wb'
+        with sftp.open(remote_path, mode='rb') as remote_file, \
+                DigestFile(partial_path, mode) as local_file:
+            if offset:
+                # Hash what an earlier attempt already downloaded
+                with open(partial_path, 'rb') as partial_file:
+                    for data in iter(lambda: partial_file.read(chunk_size),
+                                     b''):
+                        local_file.hash.update(data)
+            while offset < remote_size:
+                chunks = []
+                window_offset = offset
+                while len(chunks) < window and window_offset < remote_size:
+                    size = min(chunk_size, remote_size - window_offset)
+                    chunks.append((window_offset, size))
+                    window_offset += size
+                for data in remote_file.readv(chunks):
+                    local_file.write(data)
+                    offset += len(data)
+            local_file.fsync()
+    except (paramiko.ssh_exception.SSHException, IOError) as e:
+        LOG.error('Transfer of {0} failed with error {1}, partial file '
+                  'kept at {2}'.format(remote_path, e, partial_path))
+        return None
+    finally:
+        sftp.close()
+
+    os.rename(partial_path, local_path)
+    write_checksum(local_path, local_file.hexdigest())
+    return local_path
 
 
 def remote_cleanup(ssh, remote_path):
@@ -162,48 +983,2761 @@ def remote_cleanup(ssh, remote_path):
                   '{0}'.format(e))
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument(
-        '--local-dir', action='store',
-        default='/tmp',
-        help="The backup directory on the local host")
-    parser.add_argument(
-        '--remote-dir', action='store',
-        default='/tmp',
-        help="The backup directory on the remote database host")
-    parser.add_argument(
-        '--database', action='store',
-        required=True,
-        help="The database you want to backup")
-    parser.add_argument(
-        '--server', action='store',
-        required=True,
-        help="The database server ip/hostname")
-    parser.add_argument(
-        '-v', '--verbose', action='count', default=0,
-        help="Increase verbosity (specify multiple times for more)")
-    args = parser.parse_args()
+def write_checksum(path, digest):
+    """
+    Write a sha256sum compatible checksum file next to a backup file
 
-    log_level = logging.INFO
-    if args.verbose >= 1:
-        log_level = logging.DEBUG
+    :param path:
+    :param digest:
+    :return checksum_path:
+    """
 
-    format = '%(asctime)s - %(levelname)s - %(message)s'
-    logging.basicConfig(format=format, datefmt='%m-%d %H:%M', level=log_level)
+    checksum_path = path + CHECKSUM_SUFFIX
+    with open(checksum_path + '.tmp', 'w') as checksum_file:
+        checksum_file.write('{0}  {1}\n'.format(digest,
+                                                os.path.basename(path)))
+    os.rename(checksum_path + '.tmp', checksum_path)
+    return checksum_path
+
+
+def read_checksum(path):
+    """
+    Read the digest stored next to a backup file
+
+    :param path:
+    :return digest: or None without a checksum file
+    """
+
+    checksum_path = path + CHECKSUM_SUFFIX
+    if not os.path.exists(checksum_path):
+        return None
+    with open(checksum_path) as checksum_file:
+        return checksum_file.read().split()[0]
+
+
+def verify_file(checksum_path, chunk_size=CHUNK_SIZE):
+    """
+    Check a backup file against its checksum file
+
+    :param checksum_path:
+    :param chunk_size:
+    :return (path, error): error is None when the file matches
+    """
+
+    path = checksum_path[:-len(CHECKSUM_SUFFIX)]
+    expected = read_checksum(path)
+    file_hash = hashlib.sha256()
+    try:
+        with open(path, 'rb') as backup_file:
+            for data in iter(lambda: backup_file.read(chunk_size), b''):
+                file_hash.update(data)
+    except OSError as e:
+        return path, str(e)
+    if file_hash.hexdigest() != expected:
+        return path, 'checksum mismatch'
+    return path, None
+
+
+def verify_backups(directory, jobs=None):
+    """
+    Verify every backup file with a checksum file under directory. Files
+    are hashed concurrently; hashlib releases the GIL while hashing, so
+    the threads run on all cores.
+
+    :param directory:
+    :param jobs: Number of files hashed at once, one per core when None
+    :return results (list): (path, error) for every file checked
+    """
+
+    checksum_paths = []
+    for root, _, files in os.walk(directory):
+        checksum_paths.extend(os.path.join(root, name) for name in files
+                              if name.endswith(CHECKSUM_SUFFIX))
+    jobs = jobs or os.cpu_count()
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(verify_file, sorted(checksum_paths)))
+    for path, error in results:
+        if error:
+            LOG.error('{0}: {1}'.format(path, error))
+        else:
+            LOG.debug('{0}: OK'.format(path))
+    LOG.info('Verified {0} files, {1} failed'.format(
+        len(results), len([r for r in results if r[1]])))
+    return results
+
+
+def stream_command(ssh, command, local_path, chunk_size=CHUNK_SIZE,
+                   codec=None):
+    """
+    Run a command on the remote host and write its stdout to a local file
+    as it arrives, with its SHA-256 in a .sha256 file next to it. The
+    local file is removed if the command fails.
+
+    :param ssh:
+    :param command:
+    :param local_path:
+    :param chunk_size:
+    :param codec (Codec): Compress the output on the local host with this
+                          codec before it is written
+    :return (bool):
+    """
+
+    process = None
+    try:
+        _, stdout, stderr = ssh.exec_command(command)
+        channel = stdout.channel
+        with DigestFile(local_path) as local_file:
+            sink = local_file
+            if codec and codec.compress_command():
+                process = codec.local_process(local_file)
+                sink = process
+            while True:
+                chunk = channel.recv(chunk_size)
+                if not chunk:
+                    break
+                sink.write(chunk)
+            if process:
+                process.close()
+                process = None
+        exit_status = channel.recv_exit_status()
+        if exit_status > 0:
+            LOG.error('Command exit status'
+                      ' {0} {1}'.format(exit_status, stderr.read().decode()))
+            os.remove(local_path)
+            return False
+        write_checksum(local_path, local_file.hexdigest())
+        return True
+    except (paramiko.ssh_exception.SSHException, OSError) as e:
+        LOG.error('Streaming to {0} failed with error '
+                  '{1}'.format(local_path, e))
+        if process:
+            process.kill()
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        return False
+
+
+def remote_pipeline(command, codec=None, compress_on='remote'):
+    """
+    Return the remote command line running command with its output
+    compressed on the remote host, or left uncompressed when it is
+    compressed locally
+
+    :param command:
+    :param codec (Codec): gzip with default settings when None
+    :param compress_on: remote or local
+    :return remote_cmd (str):
+    """
+
+    codec = codec or Codec()
+    if compress_on == 'remote' and codec.compress_command():
+        command = 'set -o pipefail; {0} | {1}'.format(
+            command, codec.compress_command())
+    return 'sudo bash -c {0}'.format(shlex.quote(command))
+
+
+def backup_script(database, remote_dir, master_data=False, codec=None,
+                  compress_on='remote'):
+    """
+    Build the bash script that runs every remote step of a backup in a
+    single invocation. Each step reports a "STEP name exit_status
+    elapsed_ms bytes" line. Once the file is ready the script prints its
+    SHA-256 on a DIGEST line, then READY, and waits for "cleanup" (or
+    anything else to keep the file) on stdin, so the download can happen
+    in between without a new channel.
+
+    :param database:
+    :param remote_dir:
+    :param master_data: Record the binlog coordinates in the dump header
+    :param codec (Codec): gzip with default settings when None
+    :param compress_on: remote or local
+    :return (script, remote_path):
+    """
+
+    codec = codec or Codec()
+    path = '{0}/{1}'.format(remote_dir, backup_filename(database))
+    partial = [path]
+    steps = [
+        'run mkdir {0} mkdir -p {0}'.format(shlex.quote(remote_dir)),
+        'run dump {0} dump'.format(shlex.quote(path)),
+    ]
+    functions = ['dump() {{ mysqldump {0}{1} > {2}; }}'.format(
+        dump_options(master_data), shlex.quote(database), shlex.quote(path))]
+    if compress_on == 'remote' and codec.compress_command():
+        compressed_path = path + codec.suffix
+        functions.append('compress() {{ {0} < {1} > {2} && rm -f {1}; }}'
+                         .format(codec.compress_command(), shlex.quote(path),
+                                 shlex.quote(compressed_path)))
+        steps.append('run compress {0} compress'.format(
+            shlex.quote(compressed_path)))
+        path = compressed_path
+        partial.append(path)
+
+    script = '\n'.join([
+        'set -o pipefail',
+        'err=$(mktemp)',
+        'partial=({0})'.format(' '.join(shlex.quote(p) for p in partial)),
+        'run() {',
+        '    local name=$1 file=$2 start rc elapsed size',
+        '    shift 2',
+        '    start=$(date +%s%N)',
+        '    "$@" 2>>"$err"',
+        '    rc=$?',
+        '    elapsed=$(( ($(date +%s%N) - start) / 1000000 ))',
+        '    size=$(stat -c %s "$file" 2>/dev/null || echo 0)',
+        '    echo "STEP $name $rc $elapsed $size"',
+        '    if [ $rc -ne 0 ]; then',
+        '        echo "ERROR $(tail -c 2000 "$err" | tr "\\n" " ")"',
+        '        rm -f "$err" "${partial[@]}"',
+        '        exit $rc',
+        '    fi',
+        '}',
+    ] + functions + steps + [
+        'echo "DIGEST $(sha256sum < {0} | cut -d" " -f1)"'.format(
+            shlex.quote(path)),
+        'echo READY {0}'.format(shlex.quote(path)),
+        'read -r reply',
+        'if [ "$reply" = cleanup ]; then',
+        '    run cleanup {0} rm -f {0}'.format(shlex.quote(path)),
+        'fi',
+        'rm -f "$err"',
+    ])
+    return script, path
+
+
+def parse_step(line):
+    """
+    Parse a STEP line printed by the backup script
+
+    :param line:
+    :return step (dict): name, exit_status, elapsed (seconds) and bytes,
+                         or None if line is not a STEP line
+    """
+
+    fields = line.split()
+    if len(fields) != 5 or fields[0] != 'STEP':
+        return None
+    return {'name': fields[1], 'exit_status': int(fields[2]),
+            'elapsed': int(fields[3]) / 1000.0, 'bytes': int(fields[4])}
+
+
+def run_remote_backup(ssh, database, local_dir, remote_dir,
+                      master_data=False, codec=None, compress_on='remote',
+                      metrics=None, attempts=TRANSFER_ATTEMPTS):
+    """
+    Back up a database through a file on the remote host, running all of
+    the remote steps in one channel and downloading the result over sftp.
+    A failed download is resumed from its partial file up to attempts
+    times, the remote file is removed once the download succeeds or the
+    attempts run out.
+
+    :param ssh:
+    :param database:
+    :param local_dir:
+    :param remote_dir:
+    :param master_data: Record the binlog coordinates in the dump header
+    :param codec (Codec): gzip with default settings when None
+    :param compress_on: Compress on the remote or the local host
+    :param metrics (BackupMetrics): Records the remote steps and the
+                                    transfer when set
+    :param attempts: Number of tries to download the remote file
+    :return (local_backup, steps): The local file, or None on failure,
+                                   and the status of each remote step
+    """
+
+    script, remote_path = backup_script(database, remote_dir, master_data,
+                                        codec, compress_on)
+    steps = []
+    local_backup = None
+    try:
+        stdin, stdout, stderr = ssh.exec_command(
+            'sudo bash -c {0}'.format(shlex.quote(script)))
+        ready = False
+        remote_digest = None
+        for line in stdout:
+            step = parse_step(line)
+            if step:
+                steps.append(step)
+            elif line.startswith('DIGEST'):
+                remote_digest = line.split()[1]
+            elif line.startswith('ERROR'):
+                LOG.error('Remote step {0} failed: {1}'.format(
+                    steps[-1]['name'] if steps else 'setup', line[6:]))
+            elif line.startswith('READY'):
+                ready = True
+                break
+
+        if ready:
+            start = time.monotonic()
+            for attempt in range(1, attempts + 1):
+                if attempt > 1:
+                    LOG.info('Retrying the download of {0}, attempt {1} of '
+                             '{2}'.format(remote_path, attempt, attempts))
+                    time.sleep(TRANSFER_RETRY_DELAY * (attempt - 1))
+                # A failed attempt leaves a .part file the next one resumes
+                local_backup = get_backup_file(ssh, local_dir, remote_path)
+                if local_backup and \
+                        read_checksum(local_backup) != remote_digest:
+                    LOG.error('Checksum of {0} does not match the remote '
+                              'file, discarding it'.format(local_backup))
+                    os.remove(local_backup)
+                    os.remove(local_backup + CHECKSUM_SUFFIX)
+                    local_backup = None
+                if local_backup:
+                    break
+            if metrics and local_backup:
+                metrics.add('transfer', time.monotonic() - start,
+                            bytes_out=path_size(local_backup))
+            if not local_backup:
+                # The next run dumps to a new file, nothing would resume
+                # this one or its partial download
+                partial_path = os.path.join(
+                    local_dir, os.path.basename(remote_path) + '.part')
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+                LOG.error('Giving up on {0} after {1} attempts'.format(
+                    remote_path, attempts))
+            stdin.write('cleanup\n')
+            stdin.flush()
+            for line in stdout:
+                step = parse_step(line)
+                if step:
+                    steps.append(step)
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status > 0:
+            LOG.error('Command exit status'
+                      ' {0} {1}'.format(exit_status, stderr.read().decode()))
+    except paramiko.ssh_exception.SSHException as e:
+        LOG.error('Connection to host failed with error'
+                  '{0}'.format(e))
+
+    for step in steps:
+        LOG.info('Remote step {name}: exit status {exit_status}, '
+                 '{elapsed:.3f}s, {bytes} bytes'.format(**step))
+    if metrics:
+        sizes = {step['name']: step['bytes'] for step in steps}
+        for step in steps:
+            if step['name'] == 'dump':
+                metrics.add('dump', step['elapsed'], bytes_out=step['bytes'])
+            elif step['name'] == 'compress':
+                metrics.add('compress', step['elapsed'],
+                            bytes_in=sizes.get('dump'),
+                            bytes_out=step['bytes'])
+            else:
+                metrics.add(step['name'], step['elapsed'])
+    return local_backup, steps
+
+
+def stream_backup(ssh, database, local_dir, chunk_size=CHUNK_SIZE,
+                  master_data=False, codec=None, compress_on='remote'):
+    """
+    Run mysqldump on the remote host and stream its compressed output
+    straight into a local file, without touching the remote disk
+
+    :param ssh:
+    :param database:
+    :param local_dir:
+    :param chunk_size:
+    :param master_data: Record the binlog coordinates in the dump header
+    :param codec (Codec): gzip with default settings when None
+    :param compress_on: Compress on the remote or the local host
+    :return local_path:
+    """
+
+    codec = codec or Codec()
+    local_path = '{0}/{1}{2}'.format(local_dir, backup_filename(database),
+                                     codec.suffix)
+    stream_cmd = remote_pipeline('mysqldump {0}{1}'.format(
+        dump_options(master_data), shlex.quote(database)), codec, compress_on)
+    local_codec = codec if compress_on == 'local' else None
+    if stream_command(ssh, stream_cmd, local_path, chunk_size, local_codec):
+        return local_path
+    return None
+
+
+def dump_options(master_data=False):
+    """
+    Return the extra mysqldump options for a full backup. With master_data
+    the dump runs in a single transaction and its header records the
+    binlog coordinates it is consistent with, which incremental backups
+    start from.
+
+    :param master_data:
+    :return options (str):
+    """
+
+    if master_data:
+        return '--single-transaction --master-data=2 '
+    return ''
+
+
+@contextmanager
+def open_backup(path):
+    """
+    Open a local backup file for reading its uncompressed contents,
+    whatever codec it was written with
+
+    :param path:
+    :return (file object): Yields a binary file object
+    """
+
+    codec = Codec.detect(path)
+    if codec.name == 'gzip':
+        with gzip.open(path, 'rb') as backup_file:
+            yield backup_file
+    elif codec.name == 'none':
+        with open(path, 'rb') as backup_file:
+            yield backup_file
+    else:
+        with open(path, 'rb') as backup_file:
+            args = shlex.split(codec.decompress_command())
+            process = subprocess.Popen(args, stdin=backup_file,
+                                       stdout=subprocess.PIPE)
+            try:
+                yield process.stdout
+            finally:
+                process.kill()
+                process.wait()
+                process.stdout.close()
+
+
+def read_dump_coordinates(path):
+    """
+    Read the binlog coordinates that mysqldump --master-data wrote near
+    the top of a compressed dump
+
+    :param path:
+    :return coordinates (dict): binlog_file and binlog_position, or None
+    """
+
+    with open_backup(path) as dump:
+        for line_number, line in enumerate(dump):
+            match = BINLOG_COORDINATES.search(line.decode(errors='replace'))
+            if match:
+                return {'binlog_file': match.group(1),
+                        'binlog_position': int(match.group(2))}
+            if line_number > 100:
+                break
+    return None
+
+
+class TableSplitter:
+    """
+    Split an uncompressed mysqldump stream into one gzip file per table.
+    Everything before the first table section is the dump header (session
+    settings) and is repeated at the top of every table file so each one
+    can be loaded on its own. The GTID_PURGED statement is dropped from
+    the header since it can only be applied once per server.
+    """
+
+    MARKER = b'-- Table structure for table `'
+    TAIL_MARKERS = (b'-- Final view structure for view `',
+                    b'-- Dumping routines for database ',
+                    b'-- Dumping events for database ')
+    MARKERS = re.compile(b'|'.join(re.escape(marker) for marker in
+                                   (MARKER,) + TAIL_MARKERS))
+    MARKER_LENGTH = max(len(marker) for marker in (MARKER,) + TAIL_MARKERS)
+
+    def __init__(self, paths, directory=None, level=9, on_table=None,
+                 tail_path=None):
+        """
+        :param paths (dict): Local file path for each table name
+        :param directory: Where tables missing from paths are written
+        :param level (int): gzip compression level of the table files
+        :param on_table: Called with the table name and path of every
+                         finished table file, and with None and tail_path
+                         for the tail
+        :param tail_path: When set, the view, routine and event
+                          definitions after the tables go to this file
+                          instead of the last table's
+        """
+
+        self.paths = paths
+        self.directory = directory
+        self.level = level
+        self.on_table = on_table
+        self.tail_path = tail_path
+        self.header = b''
+        self.current = None
+        self.digests = {}
+        self._name = None
+        self._raw = None
+        self._pending = b''
+
+    def _close_table(self):
+        self.current.close()
+        self._raw.close()
+        write_checksum(self._raw.path, self._raw.hexdigest())
+        self.digests[self._raw.path] = self._raw.hexdigest()
+        self.current = None
+        if self.on_table:
+            self.on_table(self._name, self._raw.path)
+
+    def _open(self, name, path):
+        if self.current:
+            self._close_table()
+        else:
+            self.header = b''.join(
+                line for line in self.header.splitlines(True)
+                if not line.startswith(b'SET @@GLOBAL.GTID_PURGED'))
+        self._name = name
+        self._raw = DigestFile(path)
+        self.current = gzip.GzipFile(filename='', mode='wb',
+                                     fileobj=self._raw,
+                                     compresslevel=self.level)
+        self.current.write(self.header)
+
+    def _start_table(self, marker_line):
+        name = marker_line[len(self.MARKER):marker_line.rindex(b'`')]
+        name = name.replace(b'``', b'`').decode()
+        path = self.paths.get(name) or \
+            os.path.join(self.directory, table_filename(name))
+        self._open(name, path)
+
+    def _write(self, data):
+        if self.current:
+            self.current.write(data)
+        else:
+            self.header += data
+
+    def _starts_section(self, marker):
+        if marker == self.MARKER:
+            return True
+        # The tail starts once, at its first marker
+        return self.tail_path is not None and self._name is not None
+
+    def feed(self, data):
+        """
+        Route a piece of the dump stream to the file of the table it
+        belongs to
+
+        :param data (bytes):
+        """
+
+        buf = self._pending + data
+        start = 0
+        while True:
+            match = self.MARKERS.search(buf, start)
+            if match is None:
+                cut = max(start, len(buf) - self.MARKER_LENGTH)
+                break
+            idx = match.start()
+            if idx > 0 and buf[idx - 1:idx] != b'\n' or \
+                    not self._starts_section(match.group()):
+                start = idx + 1
+                continue
+            end = buf.find(b'\n', idx)
+            if end == -1:
+                cut = idx
+                break
+            self._write(buf[:idx])
+            if match.group() == self.MARKER:
+                self._start_table(buf[idx:end])
+            else:
+                self._open(None, self.tail_path)
+            buf = buf[idx:]
+            start = end - idx + 1
+        self._write(buf[:cut])
+        self._pending = buf[cut:]
+
+    def close(self):
+        """Flush any buffered data and close the current table file"""
+
+        self._write(self._pending)
+        self._pending = b''
+        if self.current:
+            self._close_table()
+
+
+def acquire_snapshot_lock(ssh, timeout=SNAPSHOT_TIMEOUT):
+    """
+    Open a mysql session on the remote host that holds a global read lock
+    and read the binlog coordinates at the lock point. Dumps started with
+    --single-transaction while the lock is held all see the same data.
+
+    :param ssh:
+    :param timeout:
+    :return (stdin, snapshot): The lock session and snapshot details,
+                               or (None, None) on failure
+    """
+
+    stdin = None
+    try:
+        stdin, stdout, stderr = ssh.exec_command('sudo mysql -N -B -n',
+                                                 timeout=timeout)
+        stdin.write('FLUSH TABLES WITH READ LOCK;\n'
+                    'SHOW MASTER STATUS;\n'
+                    "SELECT 'SNAPSHOT_LOCKED';\n")
+        stdin.flush()
+        snapshot = {'time': datetime.now().isoformat(),
+                    'binlog_file': None, 'binlog_position': None}
+        for line in stdout:
+            fields = line.strip().split('\t')
+            if fields == ['SNAPSHOT_LOCKED']:
+                return stdin, snapshot
+            if len(fields) >= 2 and fields[1].isdigit():
+                snapshot['binlog_file'] = fields[0]
+                snapshot['binlog_position'] = int(fields[1])
+        LOG.error('Snapshot lock failed {0}'.format(stderr.read().decode()))
+    except (paramiko.ssh_exception.SSHException, OSError) as e:
+        LOG.error('Snapshot lock failed with error {0}'.format(e))
+        if stdin:
+            # Don't leave a queued FLUSH TABLES behind on the server
+            stdin.channel.close()
+    return None, None
+
+
+def release_snapshot_lock(stdin):
+    """
+    Release the global read lock and end the lock session
+
+    :param stdin:
+    """
+
+    try:
+        stdin.write('UNLOCK TABLES;\n')
+        stdin.flush()
+        stdin.channel.shutdown_write()
+        stdin.channel.recv_exit_status()
+    except (paramiko.ssh_exception.SSHException, OSError) as e:
+        LOG.error('Releasing snapshot lock failed with error '
+                  '{0}'.format(e))
+
+
+def sql_string(value):
+    """
+    Quote a value as a MySQL string literal, escaping backslashes and
+    quotes as the default sql_mode reads them
+
+    :param value:
+    :return (str):
+    """
+
+    return "'{0}'".format(value.replace('\\', '\\\\').replace("'", "''"))
+
+
+def sql_identifier(name):
+    """
+    Quote a name as a MySQL identifier, doubling the backticks in it
+
+    :param name:
+    :return (str):
+    """
+
+    return '`{0}`'.format(name.replace('`', '``'))
+
+
+def list_tables(ssh, database):
+    """
+    List the tables and views of a database with their on-disk size
+
+    :param ssh:
+    :param database:
+    :return tables (list): dicts of name, type and size, or None
+    """
+
+    query = ("SELECT table_name, table_type, "
+             "COALESCE(data_length + index_length, 0) "
+             "FROM information_schema.tables "
+             "WHERE table_schema = {0} ORDER BY table_name".format(
+                 sql_string(database)))
+    list_cmd = 'sudo mysql -N -B -e {0}'.format(shlex.quote(query))
+    try:
+        _, stdout, stderr = ssh.exec_command(list_cmd)
+        output = stdout.read().decode()
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status > 0:
+            LOG.error('Command exit status'
+                      ' {0} {1}'.format(exit_status, stderr.read().decode()))
+            return None
+    except paramiko.ssh_exception.SSHException as e:
+        LOG.error('Connection to host failed with error'
+                  '{0}'.format(e))
+        return None
+
+    tables = []
+    for line in output.splitlines():
+        name, table_type, size = line.split('\t')
+        tables.append({'name': name, 'type': table_type, 'size': int(size)})
+    return tables
+
+
+def table_groups(tables, jobs):
+    """
+    Spread tables over jobs groups so each group holds a similar amount
+    of data, largest tables first
+
+    :param tables:
+    :param jobs:
+    :return groups (list): Lists of table names
+    """
+
+    groups = [[] for _ in range(min(jobs, len(tables)))]
+    sizes = [0] * len(groups)
+    for table in sorted(tables, key=lambda t: t['size'], reverse=True):
+        smallest = sizes.index(min(sizes))
+        groups[smallest].append(table['name'])
+        sizes[smallest] += table['size']
+    return groups
+
+
+def dump_table_group(ssh, database, tables, paths, started,
+                     chunk_size=CHUNK_SIZE):
+    """
+    Dump a group of tables in one --single-transaction mysqldump and split
+    the stream into per-table files as it arrives. started is set once
+    the dump's transaction is open, or once the dump has failed.
+
+    :param ssh:
+    :param database:
+    :param tables:
+    :param paths: Local file path for each table name
+    :param started (threading.Event):
+    :param chunk_size:
+    :return (bool): True if every table was dumped
+    """
+
+    dump = 'set -o pipefail; mysqldump -v --single-transaction {0} {1} ' \
+           '| gzip -c'.format(shlex.quote(database),
+                              ' '.join(shlex.quote(t) for t in tables))
+    dump_cmd = 'sudo bash -c {0}'.format(shlex.quote(dump))
+    splitter = TableSplitter(paths)
+    try:
+        _, stdout, stderr = ssh.exec_command(dump_cmd)
+        messages = []
+        for line in stderr:
+            messages.append(line)
+            if line.startswith('-- Retrieving'):
+                break
+        started.set()
+
+        channel = stdout.channel
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            chunk = channel.recv(chunk_size)
+            if not chunk:
+                break
+            splitter.feed(decompressor.decompress(chunk))
+        splitter.feed(decompressor.flush())
+        exit_status = channel.recv_exit_status()
+        if exit_status > 0:
+            messages.extend(stderr.readlines())
+            LOG.error('Command exit status'
+                      ' {0} {1}'.format(exit_status, ''.join(messages)))
+            return False
+        return True
+    except (paramiko.ssh_exception.SSHException, OSError, zlib.error) as e:
+        LOG.error('Dump of {0} failed with error {1}'.format(tables, e))
+        return False
+    finally:
+        started.set()
+        splitter.close()
+
+
+def dump_views(ssh, database, views, path):
+    """
+    Dump the definitions of the views of a database into one file
+
+    :param ssh:
+    :param database:
+    :param views:
+    :param path:
+    :return (bool):
+    """
+
+    dump = 'set -o pipefail; mysqldump --no-data {0} {1} | gzip -c'.format(
+        shlex.quote(database), ' '.join(shlex.quote(v) for v in views))
+    dump_cmd = 'sudo bash -c {0}'.format(shlex.quote(dump))
+    return stream_command(ssh, dump_cmd, path)
+
+
+def table_filename(name):
+    """
+    Return the local file name used for a table's dump
+
+    :param name:
+    :return file_name:
+    """
+
+    return '{0}.sql.gz'.format(name.replace(os.sep, '_'))
+
+
+def dump_per_table(ssh, database, local_dir, jobs=PARALLEL_JOBS):
+    """
+    Dump every table of a database in parallel over jobs channels into
+    its own compressed file, from a single consistent snapshot. A
+    manifest.json recording table order and the snapshot point is written
+    last, so a backup directory without one is incomplete.
+
+    :param ssh:
+    :param database:
+    :param local_dir:
+    :param jobs: Number of concurrent mysqldump channels
+    :return backup_dir:
+    """
+
+    tables = list_tables(ssh, database)
+    if tables is None:
+        return None
+    base_tables = [t for t in tables if t['type'] == 'BASE TABLE']
+    views = [t['name'] for t in tables if t['type'] == 'VIEW']
+
+    backup_dir = os.path.join(local_dir, backup_filename(database)[:-4])
+    create_local_path(backup_dir)
+    paths = {t['name']: os.path.join(backup_dir, table_filename(t['name']))
+             for t in base_tables}
+
+    lock, snapshot = acquire_snapshot_lock(ssh)
+    if not lock:
+        return None
+    groups = table_groups(base_tables, jobs)
+    events = [threading.Event() for _ in groups]
+    with futures.ThreadPoolExecutor(max_workers=max(len(groups), 1)) as ex:
+        dumps = [ex.submit(dump_table_group, ssh, database, group, paths,
+                           event)
+                 for group, event in zip(groups, events)]
+        deadline = time.monotonic() + SNAPSHOT_TIMEOUT
+        for event in events:
+            event.wait(max(deadline - time.monotonic(), 0))
+        release_snapshot_lock(lock)
+        LOG.info('Snapshot lock released, {0} dumps running'.format(
+            len(dumps)))
+        ok = all(dump.result() for dump in dumps)
+
+    views_file = None
+    if ok and views:
+        views_file = 'views.sql.gz'
+        ok = dump_views(ssh, database, views,
+                        os.path.join(backup_dir, views_file))
+    if not ok:
+        LOG.error('Per-table backup of {0} failed, leaving incomplete '
+                  'directory {1}'.format(database, backup_dir))
+        return None
+
+    manifest = {
+        'database': database,
+        'snapshot': snapshot,
+        'tables': [{'name': t['name'], 'size': t['size'],
+                    'file': table_filename(t['name']),
+                    'sha256': read_checksum(paths[t['name']])}
+                   for t in base_tables],
+        'views': views_file,
+    }
+    manifest_path = os.path.join(backup_dir, MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.rename(manifest_path + '.tmp', manifest_path)
+    return backup_dir
+
+
+class RestoreProgress:
+    """
+    Count the bytes and tables of a restore across its loader threads
+    and log the progress and throughput at intervals
+    """
+
+    def __init__(self, name, interval=PROGRESS_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self.started = time.monotonic()
+        self.read = 0
+        self.sent = 0
+        self.tables = 0
+        self.loaded = 0
+        self._lock = threading.Lock()
+        self._next_log = self.started + interval
+
+    def add(self, read=0, sent=0, tables=0, loaded=0):
+        """
+        :param read: Uncompressed dump bytes read from the archive
+        :param sent: Bytes sent to the remote host
+        :param tables: Tables found in the archive
+        :param loaded: Tables loaded into the database
+        """
+
+        with self._lock:
+            self.read += read
+            self.sent += sent
+            self.tables += tables
+            self.loaded += loaded
+            now = time.monotonic()
+            if now < self._next_log:
+                return
+            self._next_log = now + self.interval
+        self.log()
+
+    def log(self, done=False):
+        elapsed = max(time.monotonic() - self.started, 0.001)
+        LOG.info('{0}: {1}{2:.1f} MB of dump read ({3:.1f} MB/s), '
+                 '{4:.1f} MB sent ({5:.1f} MB/s), {6}/{7} tables loaded, '
+                 '{8:.1f}s'.format(self.name, 'done, ' if done else '',
+                                   self.read / 1e6,
+                                   self.read / elapsed / 1e6,
+                                   self.sent / 1e6, self.sent / elapsed / 1e6,
+                                   self.loaded, self.tables, elapsed))
+
+
+def load_file(ssh, path, database, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Stream a local compressed dump into mysql on the remote host, letting
+    the remote side decompress it with the codec found in its header
+
+    :param ssh:
+    :param path:
+    :param database:
+    :param chunk_size:
+    :param progress (RestoreProgress): Counts the bytes sent when set
+    :return (bool):
+    """
+
+    load = 'set -o pipefail; {0} | mysql {1}'.format(
+        Codec.detect(path).decompress_command(), shlex.quote(database))
+    load_cmd = 'sudo bash -c {0}'.format(shlex.quote(load))
+    try:
+        stdin, stdout, stderr = ssh.exec_command(load_cmd)
+        with open(path, 'rb') as local_file:
+            while True:
+                chunk = local_file.read(chunk_size)
+                if not chunk:
+                    break
+                stdin.channel.sendall(chunk)
+                if progress:
+                    progress.add(sent=len(chunk))
+        stdin.channel.shutdown_write()
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status > 0:
+            LOG.error('Loading {0} failed with exit status {1} {2}'.format(
+                path, exit_status, stderr.read().decode()))
+            return False
+        if progress:
+            progress.add(loaded=1)
+        return True
+    except (paramiko.ssh_exception.SSHException, OSError) as e:
+        LOG.error('Loading {0} failed with error {1}'.format(path, e))
+        return False
+
+
+def create_database(ssh, database):
+    """
+    Create the database on the remote host unless it exists
+
+    :param ssh:
+    :param database:
+    :return (bool):
+    """
+
+    create_db = 'sudo mysql -e {0}'.format(shlex.quote(
+        'CREATE DATABASE IF NOT EXISTS {0}'.format(
+            sql_identifier(database))))
+    try:
+        _, stdout, stderr = ssh.exec_command(create_db)
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status > 0:
+            LOG.error('Command exit status'
+                      ' {0} {1}'.format(exit_status, stderr.read().decode()))
+            return False
+    except paramiko.ssh_exception.SSHException as e:
+        LOG.error('Connection to host failed with error'
+                  '{0}'.format(e))
+        return False
+    return True
+
+
+def restore_per_table(ssh, backup_dir, database=None, jobs=PARALLEL_JOBS):
+    """
+    Restore a per-table backup, loading tables concurrently and views
+    once every table is in place
+
+    :param ssh:
+    :param backup_dir:
+    :param database: Target database, defaults to the one backed up
+    :param jobs: Number of tables loaded at once
+    :return (bool):
+    """
+
+    with open(os.path.join(backup_dir, MANIFEST)) as manifest_file:
+        manifest = json.load(manifest_file)
+    database = database or manifest['database']
+    if not create_database(ssh, database):
+        return False
+
+    progress = RestoreProgress(database)
+    progress.add(tables=len(manifest['tables']))
+    # Biggest tables first so they don't end up running alone at the end
+    tables = sorted(manifest['tables'], key=lambda t: t['size'],
+                    reverse=True)
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        loads = [executor.submit(load_file, ssh,
+                                 os.path.join(backup_dir, table['file']),
+                                 database, progress=progress)
+                 for table in tables]
+        ok = all([load.result() for load in loads])
+
+    if ok and manifest['views']:
+        ok = load_file(ssh, os.path.join(backup_dir, manifest['views']),
+                       database, progress=progress)
+    progress.log(done=True)
+    return ok
+
+
+def archive_database(path):
+    """
+    Return the database a backup file was taken of, from its name
+
+    :param path:
+    :return database: or None when the name wasn't made by backup_filename
+    """
+
+    match = re.match(r'(.+)-\d{2}-\d{2}-\d{4}-\d{2}:\d{2}:\d{2}\.sql',
+                     os.path.basename(path))
+    return match.group(1) if match else None
+
+
+def restore_archive(ssh, path, database=None, jobs=PARALLEL_JOBS,
+                    spool_dir=None):
+    """
+    Restore a single-file backup. The archive is decompressed locally as
+    a stream and split into its table sections, each spooled to a fast
+    gzip file and loaded on its own channel as soon as it is complete,
+    so tables load concurrently while the rest of the archive is still
+    being read. At most twice jobs sections wait to be loaded. View,
+    routine and event definitions are loaded last.
+
+    :param ssh:
+    :param path: The backup file, in any codec
+    :param database: Target database, defaults to the one in the name
+    :param jobs: Number of tables loaded at once
+    :param spool_dir: Where table sections wait to be loaded, the
+                      system temporary directory when None
+    :return (bool):
+    """
+
+    database = database or archive_database(path)
+    if not database:
+        LOG.error('Cannot tell the database of {0} from its name, '
+                  'give it with --database'.format(path))
+        return False
+    if not create_database(ssh, database):
+        return False
+
+    spool = tempfile.mkdtemp(prefix='mysql-restore-', dir=spool_dir)
+    progress = RestoreProgress(database)
+    pending = threading.BoundedSemaphore(jobs * 2)
+    failed = threading.Event()
+    loads = []
+    tail = []
+
+    def load_section(section_path):
+        try:
+            if not load_file(ssh, section_path, database,
+                             progress=progress):
+                failed.set()
+                return False
+            return True
+        finally:
+            remove_backup(section_path)
+            pending.release()
+
+    def on_table(name, section_path):
+        if failed.is_set():
+            return
+        if name is None:
+            tail.append(section_path)
+            return
+        progress.add(tables=1)
+        pending.acquire()
+        loads.append(executor.submit(load_section, section_path))
+
+    splitter = TableSplitter({}, spool, level=1, on_table=on_table,
+                             tail_path=os.path.join(spool, 'tail.sql.gz'))
+    try:
+        with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            with open_backup(path) as dump:
+                while True:
+                    data = dump.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    splitter.feed(data)
+                    progress.add(read=len(data))
+                    if failed.is_set():
+                        break
+            splitter.close()
+            ok = all([load.result() for load in loads])
+
+        if not loads:
+            # No table sections to split, load the archive as it is
+            ok = load_file(ssh, path, database, progress=progress)
+        elif ok and tail:
+            ok = load_file(ssh, tail[0], database, progress=progress)
+    except (OSError, EOFError, zlib.error) as e:
+        LOG.error('Reading {0} failed with error {1}'.format(path, e))
+        ok = False
+    finally:
+        shutil.rmtree(spool)
+    progress.log(done=True)
+    return ok
+
+
+class Chunker:
+    """
+    Split a dump stream into content-defined chunks. Candidate boundaries
+    are the line breaks and row separators of mysqldump output and one is
+    taken when the checksum of the bytes before it matches the boundary
+    mask, so an inserted or deleted row only changes the chunks around
+    it rather than every chunk after it.
+    """
+
+    BOUNDARY = re.compile(rb'\n|\),\(')
+    WINDOW = 48
+
+    def __init__(self, min_size=CHUNK_MIN, max_size=CHUNK_MAX,
+                 mask=CHUNK_MASK):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask = mask
+        self._buf = b''
+
+    def feed(self, data):
+        """
+        Add data to the stream and yield every chunk it completes
+
+        :param data (bytes):
+        """
+
+        buf = self._buf + data
+        start = 0
+        pos = start + self.min_size
+        while True:
+            match = self.BOUNDARY.search(buf, pos, start + self.max_size)
+            if match:
+                end = match.end()
+                window = buf[max(end - self.WINDOW, start):end]
+                if zlib.crc32(window) & self.mask:
+                    pos = end
+                    continue
+            elif len(buf) - start >= self.max_size:
+                end = start + self.max_size
+            else:
+                break
+            yield buf[start:end]
+            start = end
+            pos = start + self.min_size
+        self._buf = buf[start:]
+
+    def flush(self):
+        """Yield whatever is left of the stream as the last chunk"""
+
+        if self._buf:
+            yield self._buf
+            self._buf = b''
+
+
+class ChunkStore:
+    """
+    A deduplicating backup repository. Dumps are split into content
+    defined chunks and each unique chunk is stored once, zlib compressed,
+    in append-only pack files. The index maps a chunk's SHA-256 to its
+    pack and offset, and each backup is a manifest listing its chunks.
+
+    Layout:
+        index             one "hash pack offset length" line per chunk
+        packs/<id>.pack   compressed chunks, one pack per backup written
+        backups/<name>.json
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self._lock = threading.Lock()
+        create_local_path(os.path.join(path, 'packs'))
+        create_local_path(os.path.join(path, 'backups'))
+        self.load_index()
+
+    def load_index(self):
+        """Read the chunk index from disk"""
+
+        index_path = os.path.join(self.path, 'index')
+        if not os.path.exists(index_path):
+            return
+        with open(index_path) as index_file:
+            for line in index_file:
+                digest, pack, offset, length = line.split()
+                self.index[digest] = (pack, int(offset), int(length))
+
+    def append_index(self, entries):
+        """
+        Append new chunk entries to the on-disk index
+
+        :param entries (dict): (pack, offset, length) for each digest
+        """
+
+        lines = ''.join('{0} {1} {2} {3}\n'.format(digest, *location)
+                        for digest, location in entries.items())
+        with self._lock:
+            with open(os.path.join(self.path, 'index'), 'a') as index_file:
+                fcntl.flock(index_file, fcntl.LOCK_EX)
+                index_file.write(lines)
+                index_file.flush()
+                os.fsync(index_file.fileno())
+            self.index.update(entries)
+
+    def writer(self, name, database):
+        """
+        Return a writer that stores a new backup under name
+
+        :param name:
+        :param database:
+        :return (ChunkWriter):
+        """
+
+        return ChunkWriter(self, name, database)
+
+    def backups(self):
+        """
+        List the backups in the repository
+
+        :return names (list):
+        """
+
+        return sorted(name[:-5] for name in
+                      os.listdir(os.path.join(self.path, 'backups'))
+                      if name.endswith('.json'))
+
+    def manifest(self, name):
+        """
+        Load the manifest of a backup
+
+        :param name:
+        :return manifest (dict):
+        """
+
+        path = os.path.join(self.path, 'backups', '{0}.json'.format(name))
+        with open(path) as manifest_file:
+            return json.load(manifest_file)
+
+    def read(self, name):
+        """
+        Rebuild a backup, yielding its uncompressed data chunk by chunk
+
+        :param name:
+        """
+
+        packs = {}
+        try:
+            for digest in self.manifest(name)['chunks']:
+                pack, offset, length = self.index[digest]
+                if pack not in packs:
+                    packs[pack] = open(os.path.join(self.path, 'packs',
+                                                    pack), 'rb')
+                packs[pack].seek(offset)
+                chunk = zlib.decompress(packs[pack].read(length))
+                if hashlib.sha256(chunk).hexdigest() != digest:
+                    raise IOError('Chunk {0} of {1} is corrupt'.format(
+                        digest, name))
+                yield chunk
+        finally:
+            for pack_file in packs.values():
+                pack_file.close()
+
+
+class ChunkWriter:
+    """
+    Write one backup into a ChunkStore. Chunks the store doesn't have yet
+    go to a pack file owned by this writer; the index and the manifest are
+    only updated by close(), so an aborted backup leaves nothing behind.
+    """
+
+    def __init__(self, store, name, database):
+        self.store = store
+        self.name = name
+        self.database = database
+        self.chunker = Chunker()
+        self.chunks = []
+        self.size = 0
+        self.new = {}
+        self.pack = '{0}.pack'.format(uuid.uuid4().hex)
+        self.pack_path = os.path.join(store.path, 'packs', self.pack)
+        self.pack_file = open(self.pack_path, 'wb')
+
+    def _add(self, chunk):
+        digest = hashlib.sha256(chunk).hexdigest()
+        self.chunks.append(digest)
+        self.size += len(chunk)
+        if digest in self.store.index or digest in self.new:
+            return
+        compressed = zlib.compress(chunk, 6)
+        self.new[digest] = (self.pack, self.pack_file.tell(), len(compressed))
+        self.pack_file.write(compressed)
+
+    def write(self, data):
+        """
+        Add uncompressed dump data to the backup
+
+        :param data (bytes):
+        """
+
+        for chunk in self.chunker.feed(data):
+            self._add(chunk)
+
+    def close(self):
+        """
+        Store the remaining data and publish the backup
+
+        :return manifest (dict):
+        """
+
+        for chunk in self.chunker.flush():
+            self._add(chunk)
+        self.pack_file.flush()
+        os.fsync(self.pack_file.fileno())
+        self.pack_file.close()
+        if self.new:
+            self.store.append_index(self.new)
+        else:
+            os.remove(self.pack_path)
+
+        manifest = {'name': self.name, 'database': self.database,
+                    'time': datetime.now().isoformat(), 'size': self.size,
+                    'chunks': self.chunks}
+        path = os.path.join(self.store.path, 'backups',
+                            '{0}.json'.format(self.name))
+        with open(path + '.tmp', 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.rename(path + '.tmp', path)
+        LOG.info('Stored {0}: {1} bytes in {2} chunks, {3} new'.format(
+            self.name, self.size, len(self.chunks), len(self.new)))
+        return manifest
+
+    def abort(self):
+        """Drop the backup and the pack data written for it"""
+
+        self.pack_file.close()
+        os.remove(self.pack_path)
+
+
+def stream_to_repository(ssh, database, repository, chunk_size=CHUNK_SIZE):
+    """
+    Run mysqldump on the remote host and store its output in a
+    deduplicating repository as it arrives
+
+    :param ssh:
+    :param database:
+    :param repository: Path of the ChunkStore
+    :param chunk_size:
+    :return name: The name of the backup in the repository
+    """
+
+    store = ChunkStore(repository)
+    writer = store.writer(backup_filename(database)[:-4], database)
+    stream_cmd = 'sudo bash -c {0}'.format(shlex.quote(
+        'set -o pipefail; mysqldump {0} | gzip -c'.format(
+            shlex.quote(database))))
+    try:
+        _, stdout, stderr = ssh.exec_command(stream_cmd)
+        channel = stdout.channel
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            chunk = channel.recv(chunk_size)
+            if not chunk:
+                break
+            writer.write(decompressor.decompress(chunk))
+        writer.write(decompressor.flush())
+        exit_status = channel.recv_exit_status()
+        if exit_status > 0:
+            LOG.error('Command exit status'
+                      ' {0} {1}'.format(exit_status, stderr.read().decode()))
+            writer.abort()
+            return None
+    except (paramiko.ssh_exception.SSHException, zlib.error) as e:
+        LOG.error('Backup of {0} failed with error {1}'.format(database, e))
+        writer.abort()
+        return None
+
+    writer.close()
+    return writer.name
+
+
+@contextmanager
+def open_catalog(catalog_path):
+    """
+    Open the local backup catalog, creating it when missing. The catalog
+    is an SQLite database indexed on database, server and time, so
+    lookups don't depend on how many backups there are.
+
+    :param catalog_path:
+    """
+
+    connection = sqlite3.connect(catalog_path, timeout=60)
+    try:
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS backups ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, db TEXT NOT NULL, '
+                'server TEXT, time TEXT NOT NULL, type TEXT NOT NULL, '
+                'path TEXT NOT NULL, size INTEGER, codec TEXT, '
+                'sha256 TEXT, entry TEXT NOT NULL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS backups_db_time '
+                'ON backups (db, server, time)')
+        yield connection
+    finally:
+        connection.close()
+
+
+def append_catalog(catalog_path, entry):
+    """
+    Record a backup in the local backup catalog. The entry is committed
+    in one transaction, so readers see all of it or none of it.
+
+    :param catalog_path:
+    :param entry (dict): Needs type, database and path
+    """
+
+    entry = dict(entry)
+    entry.setdefault('time', datetime.now().isoformat())
+    with _catalog_lock, open_catalog(catalog_path) as connection:
+        with connection:
+            connection.execute(
+                'INSERT INTO backups (db, server, time, type, path, size, '
+                'codec, sha256, entry) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (entry['database'], entry.get('server'), entry['time'],
+                 entry['type'], entry['path'], entry.get('size'),
+                 entry.get('codec'), entry.get('sha256'),
+                 json.dumps(entry, sort_keys=True)))
+
+
+def read_catalog(catalog_path, database=None, server=None, limit=None,
+                 newest_first=False):
+    """
+    Read entries of the local backup catalog, oldest first
+
+    :param catalog_path:
+    :param database: Only entries of this database when set
+    :param server: Only entries of this server when set
+    :param limit (int): Return at most this many entries
+    :param newest_first: Order the entries newest first instead
+    :return entries (list):
+    """
+
+    if not os.path.exists(catalog_path):
+        return []
+    query = 'SELECT id, entry FROM backups'
+    filters = [(column, value) for column, value in
+               (('db', database), ('server', server)) if value is not None]
+    if filters:
+        query += ' WHERE ' + ' AND '.join(
+            '{0} = ?'.format(column) for column, _ in filters)
+    query += ' ORDER BY time {0}, id {0}'.format(
+        'DESC' if newest_first else 'ASC')
+    if limit:
+        query += ' LIMIT {0:d}'.format(limit)
+    with open_catalog(catalog_path) as connection:
+        rows = connection.execute(
+            query, [value for _, value in filters]).fetchall()
+    return [dict(json.loads(entry), id=row_id) for row_id, entry in rows]
+
+
+def latest_backup(catalog_path, database, server=None):
+    """
+    Return the newest catalog entry of a database
+
+    :param catalog_path:
+    :param database:
+    :param server: Only consider backups of this server when set
+    :return entry (dict): or None when the database has no backups
+    """
+
+    entries = read_catalog(catalog_path, database, server, limit=1,
+                           newest_first=True)
+    return entries[0] if entries else None
+
+
+def catalog_entry(backup_type, database, server, path, codec=None):
+    """
+    Describe a finished backup for the catalog
+
+    :param backup_type: full or incremental
+    :param database:
+    :param server:
+    :param path: The backup file or directory
+    :param codec (Codec):
+    :return entry (dict):
+    """
+
+    return {'type': backup_type, 'database': database, 'server': server,
+            'path': path, 'time': datetime.now().isoformat(),
+            'size': path_size(path), 'codec': (codec or Codec()).name,
+            'sha256': None if os.path.isdir(path) else read_checksum(path)}
+
+
+def retained_backups(entries, keep_daily, keep_weekly):
+    """
+    Pick the backups a daily/weekly retention policy keeps: the newest
+    full backup of each of the keep_daily most recent days and of each
+    of the keep_weekly most recent ISO weeks, plus the increments built
+    on a kept full backup
+
+    :param entries (list): Catalog entries of one database, newest first
+    :param keep_daily (int):
+    :param keep_weekly (int):
+    :return kept (set): ids of the entries to keep
+    """
+
+    kept = set()
+    days = set()
+    weeks = set()
+    for entry in entries:
+        if entry['type'] != 'full':
+            continue
+        backup_time = datetime.fromisoformat(entry['time'])
+        day = backup_time.date()
+        week = backup_time.isocalendar()[:2]
+        if day not in days and len(days) < keep_daily:
+            days.add(day)
+            kept.add(entry['id'])
+        if week not in weeks and len(weeks) < keep_weekly:
+            weeks.add(week)
+            kept.add(entry['id'])
+    kept_paths = {entry['path'] for entry in entries if entry['id'] in kept}
+    kept.update(entry['id'] for entry in entries
+                if entry['type'] == 'incremental' and
+                entry.get('base') in kept_paths)
+    return kept
+
+
+def remove_backup(path):
+    """
+    Delete a backup file with its checksum file, or a backup directory
+
+    :param path:
+    """
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+        return
+    for name in (path, path + CHECKSUM_SUFFIX):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def prune_catalog(catalog_path, keep_daily, keep_weekly, database=None,
+                  dry_run=False):
+    """
+    Delete the backups the retention policy doesn't keep, along with
+    their catalog entries. Each database and server is pruned on its
+    own.
+
+    :param catalog_path:
+    :param keep_daily (int):
+    :param keep_weekly (int):
+    :param database: Only prune this database when set
+    :param dry_run: Only report what would be deleted
+    :return pruned (list): Catalog entries of the deleted backups
+    """
+
+    groups = {}
+    for entry in read_catalog(catalog_path, database, newest_first=True):
+        groups.setdefault((entry['database'], entry.get('server')),
+                          []).append(entry)
+
+    pruned = []
+    for entries in groups.values():
+        kept = retained_backups(entries, keep_daily, keep_weekly)
+        pruned.extend(entry for entry in entries if entry['id'] not in kept)
+    for entry in pruned:
+        LOG.info('{0} {1}'.format('Would delete' if dry_run else 'Deleting',
+                                  entry['path']))
+    if dry_run or not pruned:
+        return pruned
+
+    for entry in pruned:
+        remove_backup(entry['path'])
+    with _catalog_lock, open_catalog(catalog_path) as connection:
+        with connection:
+            connection.executemany('DELETE FROM backups WHERE id = ?',
+                                   [(entry['id'],) for entry in pruned])
+    return pruned
+
+
+def incremental_chain(catalog_path, database, server=None):
+    """
+    Return the latest full backup of a database that recorded binlog
+    coordinates, followed by the increments taken on top of it in order.
+    Restoring the full backup then replaying each increment's binlogs
+    from its start coordinates gives the state at the end of the chain.
+
+    :param catalog_path:
+    :param database:
+    :param server: Only consider backups of this server when set
+    :return chain (list): Catalog entries, empty if there is no base
+    """
+
+    chain = []
+    for entry in read_catalog(catalog_path, database, server):
+        if entry['type'] == 'full':
+            chain = [entry] if entry.get('end') else []
+        elif chain and entry['base'] == chain[0]['path']:
+            chain.append(entry)
+    return chain
+
+
+def list_binlogs(ssh):
+    """
+    Rotate the binary log and list the binlog files on the remote host.
+    Every file but the last one is closed after the rotation.
+
+    :param ssh:
+    :return (binlog_dir, names): or (None, None) on failure
+    """
+
+    query = 'FLUSH BINARY LOGS; SELECT @@log_bin_basename; SHOW BINARY LOGS'
+    list_cmd = 'sudo mysql -N -B -e {0}'.format(shlex.quote(query))
+    try:
+        _, stdout, stderr = ssh.exec_command(list_cmd)
+        output = stdout.read().decode().splitlines()
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status > 0 or not output:
+            LOG.error('Command exit status'
+                      ' {0} {1}'.format(exit_status, stderr.read().decode()))
+            return None, None
+    except paramiko.ssh_exception.SSHException as e:
+        LOG.error('Connection to host failed with error'
+                  '{0}'.format(e))
+        return None, None
+
+    binlog_dir = os.path.dirname(output[0])
+    return binlog_dir, [line.split('\t')[0] for line in output[1:]]
+
+
+def backup_binlogs(ssh, database, local_dir, previous, codec=None,
+                   compress_on='remote'):
+    """
+    Fetch and compress the binlog files written since the previous backup
+    in the chain. Binlogs cover the whole server, so the database filter
+    is applied when they are replayed.
+
+    :param ssh:
+    :param database:
+    :param local_dir:
+    :param previous (dict): Latest catalog entry of the chain
+    :param codec (Codec): gzip with default settings when None
+    :param compress_on: Compress on the remote or the local host
+    :return entry (dict): Catalog entry for the increment, or None
+    """
+
+    start = previous['end']
+    binlog_dir, names = list_binlogs(ssh)
+    if names is None:
+        return None
+    if start['binlog_file'] not in names:
+        LOG.error('Binlog {0} is no longer on the server, a new full '
+                  'backup is needed'.format(start['binlog_file']))
+        return None
+
+    backup_dir = os.path.join(local_dir,
+                              backup_filename(database)[:-4] + '-binlog')
+    create_local_path(backup_dir)
+    codec = codec or Codec()
+    local_codec = codec if compress_on == 'local' else None
+    files = []
+    for name in names[names.index(start['binlog_file']):-1]:
+        binlog_cmd = remote_pipeline('cat {0}'.format(
+            shlex.quote(os.path.join(binlog_dir, name))), codec, compress_on)
+        local_path = os.path.join(backup_dir, name + codec.suffix)
+        if not stream_command(ssh, binlog_cmd, local_path,
+                              codec=local_codec):
+            return None
+        files.append(os.path.basename(local_path))
+
+    return {'type': 'incremental', 'database': database, 'path': backup_dir,
+            'time': datetime.now().isoformat(),
+            'base': previous.get('base', previous['path']),
+            'files': files, 'start': start,
+            'end': {'binlog_file': names[-1], 'binlog_position': 4}}
+
+
+def run_incremental(ssh, database, local_dir, remote_dir, catalog_path,
+                    server=None, **backup_options):
+    """
+    Fetch the binlogs written since the last backup of the database, or
+    take a full backup recording binlog coordinates when there is no
+    base to build on yet
+
+    :param ssh:
+    :param database:
+    :param local_dir:
+    :param remote_dir:
+    :param catalog_path: The catalog holding the chain to build on
+    :param server: The server the database is on, recorded in the catalog
+    :param backup_options: Keyword arguments passed to take_backup
+    :return local_backup:
+    """
+
+    codec = backup_options.get('codec')
+    chain = incremental_chain(catalog_path, database, server)
+    if chain:
+        metrics = backup_options.get('metrics') or \
+            BackupMetrics(server, database)
+        with metrics.stage('binlogs') as stage:
+            entry = backup_binlogs(ssh, database, local_dir, chain[-1],
+                                   codec,
+                                   backup_options.get('compress_on',
+                                                      'remote'))
+            if entry:
+                stage['bytes_out'] = path_size(entry['path'])
+        if not entry:
+            return None
+        entry.update(server=server, size=path_size(entry['path']),
+                     codec=(codec or Codec()).name)
+        append_catalog(catalog_path, entry)
+        return entry['path']
+
+    LOG.info('No full backup of {0} with binlog coordinates, taking '
+             'one'.format(database))
+    local_backup = take_backup(ssh, database, local_dir, remote_dir,
+                               master_data=True, **backup_options)
+    if not local_backup:
+        return None
+    if backup_options.get('per_table'):
+        with open(os.path.join(local_backup, MANIFEST)) as manifest_file:
+            snapshot = json.load(manifest_file)['snapshot']
+        end = {'binlog_file': snapshot['binlog_file'],
+               'binlog_position': snapshot['binlog_position']}
+        if not end['binlog_file']:
+            end = None
+        codec = None
+    else:
+        end = read_dump_coordinates(local_backup)
+    if not end:
+        LOG.warning('No binlog coordinates in {0}, is binary logging '
+                    'enabled?'.format(local_backup))
+    entry = catalog_entry('full', database, server, local_backup, codec)
+    entry['end'] = end
+    append_catalog(catalog_path, entry)
+    return local_backup
+
+
+def take_backup(ssh, database, local_dir, remote_dir, stream=False,
+                per_table=False, jobs=PARALLEL_JOBS, master_data=False,
+                codec=None, compress_on='remote', metrics=None):
+    """
+    Take a full backup of one database into local_dir
+
+    :param ssh:
+    :param database:
+    :param local_dir:
+    :param remote_dir:
+    :param stream:
+    :param per_table: Dump tables in parallel into a backup directory
+    :param jobs: Number of parallel dump channels with per_table
+    :param master_data: Record the binlog coordinates in the dump header
+    :param codec (Codec): gzip with default settings when None
+    :param compress_on: Compress on the remote or the local host
+    :param metrics (BackupMetrics):
+    :return local_backup:
+    """
+
+    metrics = metrics or BackupMetrics(None, database)
+    if per_table:
+        with metrics.stage('dump_per_table') as stage:
+            backup_dir = dump_per_table(ssh, database, local_dir, jobs)
+            if backup_dir:
+                stage['bytes_out'] = path_size(backup_dir)
+        return backup_dir
+
+    if stream:
+        with metrics.stage('stream') as stage:
+            db_backup = stream_backup(ssh, database, local_dir,
+                                      master_data=master_data, codec=codec,
+                                      compress_on=compress_on)
+            if db_backup:
+                stage['bytes_out'] = path_size(db_backup)
+        LOG.debug('Streamed backup written to {0}'.format(db_backup))
+        return db_backup
+
+    codec = codec or Codec()
+    local_backup, _ = run_remote_backup(ssh, database, local_dir, remote_dir,
+                                        master_data, codec, compress_on,
+                                        metrics)
+    if local_backup and compress_on == 'local' and codec.compress_command():
+        with metrics.stage('compress') as stage:
+            stage['bytes_in'] = path_size(local_backup)
+            local_backup = compress_local_file(local_backup, codec)
+            if local_backup:
+                stage['bytes_out'] = path_size(local_backup)
+    return local_backup
+
+
+def run_backup(ssh, database, local_dir, remote_dir, stream=False,
+               per_table=False, jobs=PARALLEL_JOBS, incremental=False,
+               master_data=False, repository=None, codec=None,
+               compress_on='remote', metrics=None, catalog=None):
+    """
+    Run a complete backup of one database over an open connection and
+    record it in the catalog
+
+    :param ssh:
+    :param database:
+    :param local_dir:
+    :param remote_dir:
+    :param stream:
+    :param per_table: Dump tables in parallel into a backup directory
+    :param jobs: Number of parallel dump channels with per_table
+    :param incremental: Only fetch binlogs since the last backup when
+                        the catalog holds a base for them
+    :param master_data: Record the binlog coordinates in the dump header
+    :param repository: Store the dump in this deduplicating repository
+                       instead of a file in local_dir
+    :param codec (Codec): gzip with default settings when None
+    :param compress_on: Compress on the remote or the local host
+    :param metrics (BackupMetrics): Records the time and bytes of each
+                                    stage when set
+    :param catalog: The catalog to record the backup in, CATALOG in
+                    local_dir when None
+    :return local_backup:
+    """
+
+    metrics = metrics or BackupMetrics(None, database)
+    if repository:
+        with metrics.stage('repository'):
+            return stream_to_repository(ssh, database, repository)
+
+    create_local_path(local_dir)
+    catalog_path = catalog or os.path.join(local_dir, CATALOG)
+    backup_options = {'stream': stream, 'per_table': per_table,
+                      'jobs': jobs, 'codec': codec,
+                      'compress_on': compress_on, 'metrics': metrics}
+
+    if incremental:
+        return run_incremental(ssh, database, local_dir, remote_dir,
+                               catalog_path, metrics.server,
+                               **backup_options)
+
+    local_backup = take_backup(ssh, database, local_dir, remote_dir,
+                               master_data=master_data, **backup_options)
+    if local_backup:
+        append_catalog(catalog_path, catalog_entry(
+            'full', database, metrics.server, local_backup,
+            None if per_table else codec))
+    return local_backup
+
+
+def load_inventory(path):
+    """
+    Read a fleet inventory file. Each line holds a server followed by one
+    or more of its databases, separated by whitespace. Blank lines and
+    lines starting with # are ignored.
+
+    :param path:
+    :return jobs: list of (server, database) tuples
+    """
+
+    jobs = []
+    with open(path) as inventory:
+        for line in inventory:
+            fields = line.split('#', 1)[0].split()
+            if len(fields) < 2:
+                continue
+            server = fields[0]
+            for database in fields[1:]:
+                jobs.append((server, database))
+    return jobs
+
+
+def run_fleet_job(pool, server, database, local_dir, remote_dir,
+                  **backup_options):
+    """
+    Back up one database of the fleet, holding one of its host's slots
+    for the duration of the job
+
+    :param pool:
+    :param server:
+    :param database:
+    :param local_dir:
+    :param remote_dir:
+    :param backup_options: Keyword arguments passed to run_backup
+    :return result (dict): job outcome and duration
+    """
+
+    metrics = BackupMetrics(server, database)
+    result = {'server': server, 'database': database, 'path': None,
+              'error': None, 'metrics': metrics}
+    with pool.slot(server):
+        start = time.monotonic()
+        try:
+            with metrics.stage('connect'):
+                ssh = pool.get(server)
+            result['path'] = run_backup(
+                ssh, database, os.path.join(local_dir, server), remote_dir,
+                metrics=metrics, catalog=os.path.join(local_dir, CATALOG),
+                **backup_options)
+            if not result['path']:
+                result['error'] = 'backup failed'
+        except (paramiko.ssh_exception.SSHException, OSError) as e:
+            LOG.error('Backup of {0} on {1} failed with error '
+                      '{2}'.format(database, server, e))
+            result['error'] = str(e) or e.__class__.__name__
+        result['duration'] = time.monotonic() - start
+        metrics.success = not result['error']
+    return result
+
+
+def run_fleet(jobs, local_dir, remote_dir, workers=8, per_host=2,
+              username=SSH_USER, tuner=None, **backup_options):
+    """
+    Run every (server, database) job on a worker pool, sharing one
+    connection per host
+
+    :param jobs:
+    :param local_dir:
+    :param remote_dir:
+    :param workers: Maximum number of jobs running at once
+    :param per_host: Maximum number of jobs running against one host
+    :param username:
+    :param tuner (TransportTuner): Chooses the transport settings of each
+                                   host when set
+    :param backup_options: Keyword arguments passed to run_backup
+    :return results (list): One result dict per job, in job order
+    """
+
+    pool = ConnectionPool(username, per_host, tuner=tuner)
+    try:
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            jobs_futures = [executor.submit(run_fleet_job, pool, server,
+                                            database, local_dir, remote_dir,
+                                            **backup_options)
+                            for server, database in jobs]
+            return [future.result() for future in jobs_futures]
+    finally:
+        pool.close_all()
+
+
+def log_fleet_summary(results):
+    """
+    Log the duration and outcome of every fleet job
+
+    :param results:
+    :return failures (int): Number of failed jobs
+    """
+
+    failures = [result for result in results if result['error']]
+    LOG.info('Fleet summary: {0} jobs, {1} failed'.format(
+        len(results), len(failures)))
+    for result in results:
+        status = 'FAILED ({0})'.format(result['error']) \
+            if result['error'] else 'ok'
+        LOG.info('{0:<30} {1:<30} {2:>9.1f}s {3}'.format(
+            result['server'], result['database'], result['duration'],
+            status))
+    return len(failures)
+
+
+def load_schedule(path):
+    """
+    Read a daemon schedule. The JSON file holds a list of jobs, each with
+    a server and database, either a daily "at" time (HH:MM) or an
+    "interval" in seconds, and any of the backup options in
+    SCHEDULE_OPTIONS. Settings under "defaults" apply to every job.
+
+    {"defaults": {"codec": "zstd"},
+     "jobs": [{"server": "db1", "database": "app", "at": "01:30"},
+              {"server": "db2", "database": "logs", "interval": 3600,
+               "incremental": true}]}
+
+    :param path:
+    :return jobs (list): dicts of server, database, at, interval and
+                         the run_backup options
+    """
+
+    with open(path) as schedule_file:
+        schedule = json.load(schedule_file)
+
+    jobs = []
+    for settings in schedule.get('jobs', []):
+        settings = dict(schedule.get('defaults', {}), **settings)
+        unknown = set(settings) - set(SCHEDULE_OPTIONS) - \
+            {'server', 'database', 'at', 'interval'}
+        if unknown:
+            raise ValueError('Unknown schedule settings {0}'.format(
+                ', '.join(sorted(unknown))))
+        if 'server' not in settings or 'database' not in settings:
+            raise ValueError('Every scheduled job needs a server and '
+                             'a database')
+        at = settings.get('at')
+        if at is not None:
+            at = tuple(int(part) for part in at.split(':'))
+        options = {name: settings[name] for name in SCHEDULE_OPTIONS
+                   if name in settings and
+                   name not in ('codec', 'level', 'threads')}
+        options['codec'] = Codec(settings.get('codec', 'gzip'),
+                                 settings.get('level'),
+                                 settings.get('threads', 0))
+        jobs.append({'server': settings['server'],
+                     'database': settings['database'], 'at': at,
+                     'interval': settings.get('interval', 86400),
+                     'options': options})
+    return jobs
+
+
+def next_run(job, previous, now, jitter=0):
+    """
+    Work out when a scheduled job runs next. Jobs with an "at" time run
+    at its next occurrence, the others an interval after their previous
+    run, or right away the first time. A random delay of up to jitter
+    seconds is added so jobs sharing a time don't all start at once.
+
+    :param job (dict): A job from load_schedule
+    :param previous: Scheduled time of the previous run without its
+                     jitter, None before the first run
+    :param now: The current time, in seconds since the epoch
+    :param jitter: Longest random delay in seconds
+    :return (base, due): The run time without and with jitter
+    """
+
+    if job['at']:
+        after = max(previous or now, now)
+        base_time = datetime.fromtimestamp(after).replace(
+            hour=job['at'][0], minute=job['at'][1], second=0, microsecond=0)
+        if base_time.timestamp() <= after:
+            base_time += timedelta(days=1)
+        base = base_time.timestamp()
+    else:
+        jitter = min(jitter, job['interval'])
+        base = now if previous is None else \
+            max(previous + job['interval'], now)
+    return base, base + random.uniform(0, jitter)
+
+
+class TriggerHandler(socketserver.StreamRequestHandler):
+    """Answer one request line on the daemon's control socket"""
+
+    def handle(self):
+        request = self.rfile.readline().decode().split()
+        reply = self.server.backup_daemon.handle_request(request)
+        self.wfile.write((json.dumps(reply, sort_keys=True) +
+                          '\n').encode())
+
+
+class BackupDaemon:
+    """
+    Run the jobs of a schedule until stopped, sharing a pool of kept
+    alive connections between them. Ad-hoc backups and status requests
+    come in on a Unix socket, one request line per connection:
+
+    backup <server> <database>
+    status
+    """
+
+    def __init__(self, jobs, local_dir, remote_dir, socket_path,
+                 workers=8, per_host=2, username=SSH_USER, jitter=600,
+                 keepalive=30, connect_timeout=30, metrics_path=None,
+                 prometheus_path=None, tuner=None):
+        self.jobs = {(job['server'], job['database']): job for job in jobs}
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        self.socket_path = socket_path
+        self.jitter = jitter
+        self.metrics_path = metrics_path
+        self.prometheus_path = prometheus_path
+        self.pool = ConnectionPool(username, per_host, keepalive,
+                                   RECONNECT_BACKOFF, connect_timeout, tuner)
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._queue = []
+        self._sequence = 0
+        self._due = {}
+        self._running = {}
+        self._last = {}
+        self._metrics = {}
+
+    def schedule(self, job, previous=None):
+        """
+        Queue the next run of a job
+
+        :param job:
+        :param previous: Unjittered time of the run just started
+        """
+
+        base, due = next_run(job, previous, time.time(), self.jitter)
+        key = (job['server'], job['database'])
+        with self._lock:
+            self._sequence += 1
+            heapq.heappush(self._queue, (due, self._sequence, base, key))
+            self._due[key] = due
+        LOG.info('Next backup of {0} on {1} at {2}'.format(
+            key[1], key[0], datetime.fromtimestamp(due).isoformat()))
+        self._wakeup.set()
+
+    def submit(self, key, options):
+        """
+        Start a backup on the worker pool unless the same job is still
+        running
+
+        :param key: (server, database)
+        :param options: Keyword arguments passed to run_backup
+        :return started (bool):
+        """
+
+        with self._lock:
+            running = self._running.get(key)
+            if running and not running.done():
+                LOG.warning('Backup of {0} on {1} is still running, '
+                            'skipping this run'.format(key[1], key[0]))
+                return False
+            future = self.executor.submit(run_fleet_job, self.pool, key[0],
+                                          key[1], self.local_dir,
+                                          self.remote_dir, **options)
+            self._running[key] = future
+        future.add_done_callback(lambda done: self.finished(key, done))
+        return True
+
+    def finished(self, key, future):
+        """
+        Log a finished job and write out its metrics
+
+        :param key: (server, database)
+        :param future:
+        """
+
+        result = future.result()
+        status = 'failed ({0})'.format(result['error']) \
+            if result['error'] else 'ok'
+        LOG.info('Backup of {0} on {1} {2} in {3:.1f}s'.format(
+            key[1], key[0], status, result['duration']))
+        with self._lock:
+            self._last[key] = {'time': datetime.now().isoformat(),
+                               'path': result['path'],
+                               'error': result['error'],
+                               'duration': round(result['duration'], 3)}
+            self._metrics[key] = result['metrics']
+            if self.metrics_path:
+                write_metrics(self.metrics_path, [result['metrics']])
+            if self.prometheus_path:
+                write_prometheus(self.prometheus_path,
+                                 list(self._metrics.values()))
+
+    def handle_request(self, request):
+        """
+        Act on a control socket request
+
+        :param request (list): The words of the request line
+        :return reply (dict):
+        """
+
+        if request == ['status']:
+            with self._lock:
+                keys = sorted(set(self.jobs) | set(self._running))
+                jobs = [{'server': key[0], 'database': key[1],
+                         'next': datetime.fromtimestamp(
+                             self._due[key]).isoformat()
+                         if key in self._due else None,
+                         'running': bool(self._running.get(key) and
+                                         not self._running[key].done()),
+                         'last': self._last.get(key)} for key in keys]
+            return {'ok': True, 'jobs': jobs}
+        if len(request) == 3 and request[0] == 'backup':
+            key = (request[1], request[2])
+            job = self.jobs.get(key)
+            options = job['options'] if job else {'codec': Codec()}
+            LOG.info('Backup of {0} on {1} requested'.format(key[1],
+                                                             key[0]))
+            if not self.submit(key, options):
+                return {'ok': False, 'error': 'already running'}
+            return {'ok': True}
+        return {'ok': False, 'error': 'expected "backup <server> '
+                                      '<database>" or "status"'}
+
+    def open_socket(self):
+        """
+        Listen on the control socket, replacing a stale socket file left
+        by a daemon that is no longer running
+
+        :return server:
+        """
+
+        if os.path.exists(self.socket_path):
+            try:
+                send_request(self.socket_path, ['status'])
+            except OSError:
+                os.remove(self.socket_path)
+            else:
+                raise OSError('A daemon is already listening on '
+                              '{0}'.format(self.socket_path))
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path,
+                                                        TriggerHandler)
+        os.chmod(self.socket_path, 0o600)
+        server.daemon_threads = True
+        server.backup_daemon = self
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def stop(self, *args):
+        """Stop after the running jobs finish"""
+
+        self._stopping = True
+        self._wakeup.set()
+
+    def run(self):
+        """Run scheduled jobs until stop is called or SIGTERM arrives"""
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        server = self.open_socket()
+        for job in self.jobs.values():
+            self.schedule(job)
+        try:
+            while not self._stopping:
+                self._wakeup.clear()
+                now = time.time()
+                with self._lock:
+                    ready = []
+                    while self._queue and self._queue[0][0] <= now:
+                        ready.append(heapq.heappop(self._queue))
+                    timeout = self._queue[0][0] - now if self._queue \
+                        else None
+                for _, _, base, key in ready:
+                    job = self.jobs[key]
+                    self.submit(key, job['options'])
+                    self.schedule(job, base)
+                if not ready:
+                    self._wakeup.wait(timeout)
+        finally:
+            LOG.info('Stopping, waiting for running backups')
+            server.shutdown()
+            server.server_close()
+            os.remove(self.socket_path)
+            self.executor.shutdown(wait=True)
+            self.pool.close_all()
+
+
+def send_request(socket_path, request):
+    """
+    Send a request to a running daemon and return its reply
+
+    :param socket_path:
+    :param request (list): The words of the request
+    :return reply (dict):
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(30)
+        client.connect(socket_path)
+        client.sendall((' '.join(request) + '\n').encode())
+        reply = client.makefile('rb').readline()
+    return json.loads(reply.decode())
+
+
+def save_metrics(args, metrics):
+    """
+    Write the run's metrics to the files named on the command line
+
+    :param args:
+    :param metrics (list): BackupMetrics of each job
+    """
+
+    if args.metrics:
+        write_metrics(args.metrics, metrics)
+    if args.prometheus:
+        write_prometheus(args.prometheus, metrics)
+
+
+def transport_tuner(args):
+    """
+    Build the TransportTuner of the transport options on the command line
+
+    :param args:
+    :return tuner (TransportTuner):
+    """
+
+    overrides = {}
+    if args.ciphers:
+        overrides['ciphers'] = args.ciphers.split(',')
+    if args.macs:
+        overrides['macs'] = args.macs.split(',')
+    if args.window_size:
+        overrides['window_size'] = args.window_size
+    if args.max_packet_size:
+        overrides['max_packet_size'] = args.max_packet_size
+    if args.ssh_compression:
+        overrides['compress'] = args.ssh_compression == 'on'
+    return TransportTuner(args.tune_cache, SSH_USER, overrides,
+                          args.auto_tune)
+
+
+def main(argv=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="Increase verbosity (specify multiple times for more)")
+
+    transport = argparse.ArgumentParser(add_help=False)
+    transport.add_argument(
+        '--ciphers', action='store',
+        help="Comma separated SSH ciphers to prefer, in order")
+    transport.add_argument(
+        '--macs', action='store',
+        help="Comma separated SSH MACs to prefer, in order")
+    transport.add_argument(
+        '--window-size', action='store',
+        type=int,
+        help="SSH channel window in bytes, raise it for links with a "
+             "high bandwidth-delay product")
+    transport.add_argument(
+        '--max-packet-size', action='store',
+        type=int,
+        help="Largest SSH channel packet in bytes")
+    transport.add_argument(
+        '--ssh-compression', action='store',
+        choices=['on', 'off'],
+        help="Compress the SSH transport, the tuned or default setting "
+             "when not set")
+    transport.add_argument(
+        '--auto-tune', action='store_true',
+        default=False,
+        help="Probe hosts without a cached transport profile and use the "
+             "fastest one")
+    transport.add_argument(
+        '--tune-cache', action='store',
+        default=TUNE_CACHE,
+        help="File the tuned transport profile of each host is cached in")
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+
+    backup_parser = subparsers.add_parser(
+        'backup', parents=[common, transport],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Back up databases (the default command)")
+    backup_parser.add_argument(
+        '--local-dir', action='store',
+        default='/tmp',
+        help="The backup directory on the local host")
+    backup_parser.add_argument(
+        '--remote-dir', action='store',
+        default='/tmp',
+        help="The backup directory on the remote database host")
+    backup_parser.add_argument(
+        '--database', action='store',
+        help="The database you want to backup")
+    backup_parser.add_argument(
+        '--server', action='store',
+        help="The database server ip/hostname")
+    backup_parser.add_argument(
+        '--inventory', action='store',
+        help="File listing a server and its databases on each line; "
+             "backs up all of them instead of --server/--database")
+    backup_parser.add_argument(
+        '--workers', action='store',
+        default=8,
+        type=int,
+        help="Maximum number of concurrent backups with --inventory")
+    backup_parser.add_argument(
+        '--per-host', action='store',
+        default=2,
+        type=int,
+        help="Maximum number of concurrent backups per server "
+             "with --inventory")
+    backup_parser.add_argument(
+        '--stream', action='store_true',
+        default=False,
+        help="Stream the compressed dump straight to the local host "
+             "without writing it to the remote disk")
+    backup_parser.add_argument(
+        '--per-table', action='store_true',
+        default=False,
+        help="Dump each table to its own file in parallel from one "
+             "consistent snapshot")
+    backup_parser.add_argument(
+        '--jobs', action='store',
+        default=PARALLEL_JOBS,
+        type=int,
+        help="Number of parallel dump channels with --per-table")
+    backup_parser.add_argument(
+        '--codec', action='store',
+        default='gzip',
+        choices=sorted(CODECS),
+        help="Compression program used for the backup")
+    backup_parser.add_argument(
+        '--level', action='store',
+        type=int,
+        help="Compression level, the codec's default when not set")
+    backup_parser.add_argument(
+        '--threads', action='store',
+        default=0,
+        type=int,
+        help="Compression threads for pigz and zstd, 0 for all cores")
+    backup_parser.add_argument(
+        '--compress-on', action='store',
+        default='remote',
+        choices=['remote', 'local'],
+        help="Compress on the database host or on this host")
+    backup_parser.add_argument(
+        '--metrics', action='store',
+        help="Append per-stage timing and throughput of each backup to "
+             "this JSON lines file")
+    backup_parser.add_argument(
+        '--prometheus', action='store',
+        help="Write the metrics of this run to this node_exporter "
+             "textfile collector file")
+    backup_parser.add_argument(
+        '--repository', action='store',
+        help="Store backups in this deduplicating repository instead "
+             "of as files in --local-dir")
+    backup_parser.add_argument(
+        '--incremental', action='store_true',
+        default=False,
+        help="Fetch only the binlogs written since the last backup, "
+             "taking a full backup first if there is none to build on")
+
+    restore_parser = subparsers.add_parser(
+        'restore', parents=[common, transport],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Restore a backup file or a per-table backup directory")
+    restore_parser.add_argument(
+        'backup', action='store',
+        help="The backup file, or the per-table backup directory holding "
+             "a manifest.json")
+    restore_parser.add_argument(
+        '--server', action='store',
+        required=True,
+        help="The database server ip/hostname to restore to")
+    restore_parser.add_argument(
+        '--database', action='store',
+        help="The database to restore into, defaults to the one "
+             "in the manifest or the backup file name")
+    restore_parser.add_argument(
+        '--jobs', action='store',
+        default=PARALLEL_JOBS,
+        type=int,
+        help="Number of tables loaded concurrently")
+    restore_parser.add_argument(
+        '--spool-dir', action='store',
+        help="Where the table sections of a backup file wait to be "
+             "loaded, the system temporary directory if not set")
+    restore_parser.add_argument(
+        '--metrics', action='store',
+        help="Append the timing and throughput of the restore to this "
+             "JSON lines file")
+
+    extract_parser = subparsers.add_parser(
+        'extract', parents=[common],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Rebuild a dump from a deduplicating repository")
+    extract_parser.add_argument(
+        'name', action='store',
+        help="The name of the backup in the repository")
+    extract_parser.add_argument(
+        '--repository', action='store',
+        required=True,
+        help="The deduplicating repository holding the backup")
+    extract_parser.add_argument(
+        '--output', action='store',
+        default='-',
+        help="File to write the dump to, - for stdout")
+
+    verify_parser = subparsers.add_parser(
+        'verify', parents=[common],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Check backup files against their .sha256 checksum files")
+    verify_parser.add_argument(
+        'directory', action='store',
+        help="The backup directory to check, searched recursively")
+    verify_parser.add_argument(
+        '--jobs', action='store',
+        type=int,
+        help="Number of files checked at once, one per core if not set")
+
+    catalog_parent = argparse.ArgumentParser(add_help=False)
+    catalog_parent.add_argument(
+        '--local-dir', action='store',
+        default='/tmp',
+        help="The backup directory on the local host holding the catalog")
+    catalog_parent.add_argument(
+        '--database', action='store',
+        help="Only consider backups of this database")
+
+    list_parser = subparsers.add_parser(
+        'list', parents=[common, catalog_parent],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="List the backups in the catalog, oldest first")
+    list_parser.add_argument(
+        '--server', action='store',
+        help="Only list backups of this server")
+
+    latest_parser = subparsers.add_parser(
+        'latest', parents=[common, catalog_parent],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Print the path of the newest backup of a database")
+    latest_parser.add_argument(
+        '--server', action='store',
+        help="Only consider backups of this server")
+
+    prune_parser = subparsers.add_parser(
+        'prune', parents=[common, catalog_parent],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Delete the backups a daily/weekly retention policy drops")
+    prune_parser.add_argument(
+        '--keep-daily', action='store',
+        default=7,
+        type=int,
+        help="Keep the newest full backup of this many recent days")
+    prune_parser.add_argument(
+        '--keep-weekly', action='store',
+        default=4,
+        type=int,
+        help="Keep the newest full backup of this many recent weeks")
+    prune_parser.add_argument(
+        '--dry-run', action='store_true',
+        default=False,
+        help="Only list the backups that would be deleted")
+
+    socket_parent = argparse.ArgumentParser(add_help=False)
+    socket_parent.add_argument(
+        '--socket', action='store',
+        default=DAEMON_SOCKET,
+        help="The daemon's control socket")
+
+    daemon_parser = subparsers.add_parser(
+        'daemon', parents=[common, socket_parent, transport],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Run the backups of a schedule until stopped")
+    daemon_parser.add_argument(
+        '--schedule', action='store',
+        required=True,
+        help="JSON file listing the jobs and when to run them")
+    daemon_parser.add_argument(
+        '--local-dir', action='store',
+        default='/tmp',
+        help="The backup directory on the local host")
+    daemon_parser.add_argument(
+        '--remote-dir', action='store',
+        default='/tmp',
+        help="The backup directory on the remote database host")
+    daemon_parser.add_argument(
+        '--workers', action='store',
+        default=8,
+        type=int,
+        help="Maximum number of concurrent backups")
+    daemon_parser.add_argument(
+        '--per-host', action='store',
+        default=2,
+        type=int,
+        help="Maximum number of concurrent backups per server")
+    daemon_parser.add_argument(
+        '--jitter', action='store',
+        default=600,
+        type=int,
+        help="Longest random delay in seconds added to each scheduled run")
+    daemon_parser.add_argument(
+        '--keepalive', action='store',
+        default=30,
+        type=int,
+        help="Seconds between SSH keep-alive packets on idle connections")
+    daemon_parser.add_argument(
+        '--connect-timeout', action='store',
+        default=30,
+        type=int,
+        help="Seconds to wait for a server before backing off")
+    daemon_parser.add_argument(
+        '--metrics', action='store',
+        help="Append per-stage timing and throughput of each backup to "
+             "this JSON lines file")
+    daemon_parser.add_argument(
+        '--prometheus', action='store',
+        help="Keep the metrics of the latest backup of each job in this "
+             "node_exporter textfile collector file")
+
+    trigger_parser = subparsers.add_parser(
+        'trigger', parents=[common, socket_parent],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Ask a running daemon to back up a database now")
+    trigger_parser.add_argument(
+        'server', action='store',
+        help="The database server ip/hostname")
+    trigger_parser.add_argument(
+        'database', action='store',
+        help="The database to back up")
+
+    subparsers.add_parser(
+        'status', parents=[common, socket_parent],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Show the jobs of a running daemon")
+
+    tune_parser = subparsers.add_parser(
+        'tune', parents=[common, transport],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Measure the SSH transport profiles against a server and "
+             "cache the fastest")
+    tune_parser.add_argument(
+        'server', action='store',
+        help="The database server ip/hostname")
+    tune_parser.add_argument(
+        '--probe-size', action='store',
+        default=TUNE_BYTES,
+        type=int,
+        help="Random bytes each profile's probe transfers")
+
+    # Keep plain "mysql_backup.py --server ... --database ..." working
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] not in COMMANDS + ('-h', '--help'):
+        argv.insert(0, 'backup')
+    args = parser.parse_args(argv)
+    if args.command == 'backup' and not args.inventory and \
+            not (args.server and args.database):
+        parser.error('--server and --database are required '
+                     'without --inventory')
+    if args.command == 'backup' and args.repository and \
+            (args.per_table or args.incremental):
+        parser.error('--repository cannot be combined with --per-table '
+                     'or --incremental')
+    if args.command == 'latest' and not args.database:
+        parser.error('latest needs --database')
+    if args.command == 'prune' and args.keep_daily < 1 and \
+            args.keep_weekly < 1:
+        parser.error('prune needs --keep-daily or --keep-weekly above 0')
+
+    log_level = logging.INFO
+    if args.verbose >= 1:
+        log_level = logging.DEBUG
+
+    format = '%(asctime)s - %(levelname)s - %(message)s'
+    logging.basicConfig(format=format, datefmt='%m-%d %H:%M', level=log_level)
+
+    if args.command == 'tune':
+        tuner = transport_tuner(args)
+        tuner.probe_size = args.probe_size
+        entry = tuner.tune(args.server)
+        if not entry:
+            sys.exit(1)
+        for name, rate in sorted(entry['rates'].items(),
+                                 key=lambda item: -item[1]):
+            print('{0:<20} {1:>8.1f} MB/s'.format(name, rate / 1e6))
+        return
+
+    if args.command == 'restore':
+        metrics = BackupMetrics(args.server, args.database)
+        with metrics.stage('connect'):
+            ssh = create_connection(
+                args.server, SSH_USER,
+                transport=transport_tuner(args).options(args.server))
+        with metrics.stage('restore') as stage:
+            stage['bytes_in'] = path_size(args.backup)
+            if os.path.isdir(args.backup):
+                metrics.success = restore_per_table(
+                    ssh, args.backup, args.database, args.jobs)
+            else:
+                metrics.success = restore_archive(
+                    ssh, args.backup, args.database, args.jobs,
+                    args.spool_dir)
+        if args.metrics:
+            write_metrics(args.metrics, [metrics])
+        if not metrics.success:
+            sys.exit(1)
+        return
+
+    if args.command == 'verify':
+        results = verify_backups(args.directory, args.jobs)
+        if any(error for _, error in results):
+            sys.exit(1)
+        return
+
+    if args.command == 'daemon':
+        try:
+            jobs = load_schedule(args.schedule)
+        except (OSError, ValueError) as e:
+            parser.error('Cannot load schedule {0}: {1}'.format(
+                args.schedule, e))
+        BackupDaemon(jobs, args.local_dir, args.remote_dir, args.socket,
+                     args.workers, args.per_host, SSH_USER, args.jitter,
+                     args.keepalive, args.connect_timeout, args.metrics,
+                     args.prometheus, transport_tuner(args)).run()
+        return
+
+    if args.command in ('trigger', 'status'):
+        request = ['status'] if args.command == 'status' else \
+            ['backup', args.server, args.database]
+        try:
+            reply = send_request(args.socket, request)
+        except OSError as e:
+            LOG.error('Cannot reach the daemon on {0}: {1}'.format(
+                args.socket, e))
+            sys.exit(1)
+        print(json.dumps(reply, indent=2, sort_keys=True))
+        if not reply['ok']:
+            sys.exit(1)
+        return
+
+    catalog_path = os.path.join(args.local_dir, CATALOG) \
+        if args.command in ('list', 'latest', 'prune') else None
+    if args.command == 'list':
+        for entry in read_catalog(catalog_path, args.database, args.server):
+            print('{0:<26} {1:<20} {2:<20} {3:<11} {4:>12} {5:<5} '
+                  '{6}'.format(entry['time'], entry['database'],
+                               entry.get('server') or '-', entry['type'],
+                               entry.get('size') or '-',
+                               entry.get('codec') or '-', entry['path']))
+        return
+
+    if args.command == 'latest':
+        entry = latest_backup(catalog_path, args.database, args.server)
+        if not entry:
+            LOG.error('No backup of {0} in {1}'.format(args.database,
+                                                       catalog_path))
+            sys.exit(1)
+        print(entry['path'])
+        return
+
+    if args.command == 'prune':
+        pruned = prune_catalog(catalog_path, args.keep_daily,
+                               args.keep_weekly, args.database, args.dry_run)
+        LOG.info('{0} {1} backups'.format(
+            'Would prune' if args.dry_run else 'Pruned', len(pruned)))
+        return
+
+    if args.command == 'extract':
+        store = ChunkStore(args.repository)
+        if args.output == '-':
+            output = sys.stdout.buffer
+        else:
+            output = open(args.output, 'wb')
+        with output:
+            for chunk in store.read(args.name):
+                output.write(chunk)
+        return
+
+    backup_options = {'stream': args.stream, 'per_table': args.per_table,
+                      'jobs': args.jobs, 'incremental': args.incremental,
+                      'repository': args.repository,
+                      'codec': Codec(args.codec, args.level, args.threads),
+                      'compress_on': args.compress_on}
+    if args.inventory:
+        jobs = load_inventory(args.inventory)
+        results = run_fleet(jobs, args.local_dir, args.remote_dir,
+                            args.workers, args.per_host, SSH_USER,
+                            transport_tuner(args), **backup_options)
+        failures = log_fleet_summary(results)
+        save_metrics(args, [result['metrics'] for result in results])
+        if failures:
+            sys.exit(1)
+        return
 
-    ssh = create_connection(args.server, SSH_USER)
-    create_local_path(args.local_dir)
-    create_remote_path(ssh, args.remote_dir)
-    db_backup = backup_database(ssh, args.database, args.remote_dir)
-
-    if db_backup:
-        compressed_db_backup = compress_db_backup(ssh, db_backup)
-        if compressed_db_backup:
-            get_backup_file(ssh, args.local_dir, compressed_db_backup)
-            cleanup = remote_cleanup(ssh, compressed_db_backup)
-            LOG.debug('Cleanup finished with a status of {0}'.format(cleanup))
+    metrics = BackupMetrics(args.server, args.database)
+    with metrics.stage('connect'):
+        ssh = create_connection(
+            args.server, SSH_USER,
+            transport=transport_tuner(args).options(args.server))
+    metrics.success = bool(run_backup(ssh, args.database, args.local_dir,
+                                      args.remote_dir, metrics=metrics,
+                                      **backup_options))
+    save_metrics(args, [metrics])
+    if not metrics.success:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
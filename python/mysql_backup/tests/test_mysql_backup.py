@@ -1,7 +1,15 @@
 import filecmp
+import gzip
+import hashlib
+import inspect
+import json
 import os
 import paramiko
 import re
+import shlex
+import shutil
+import socket
+import threading
 import unittest
 
 # Local imports
@@ -10,6 +18,18 @@ import mysql_backup
 from unittest import mock
 
 
+DUMP = (b'-- MySQL dump 10.13\n'
+        b'/*!40101 SET NAMES utf8 */;\n'
+        b"SET @@GLOBAL.GTID_PURGED='3E11FA47-71CA-11E1:1-5';\n"
+        b'\n--\n-- Table structure for table `users`\n--\n\n'
+        b'CREATE TABLE `users` (`id` int);\n'
+        b"INSERT INTO `users` VALUES (1),"
+        b"('-- Table structure for table `x`');\n"
+        b'--\n-- Table structure for table `odd``name`\n--\n\n'
+        b'CREATE TABLE `odd``name` (`id` int);\n'
+        b'-- Dump completed\n')
+
+
 class TestMySQLBackup(unittest.TestCase):
     """
     This unittest tests the functions for the mysql_backup.py script.
@@ -89,6 +109,22 @@ class TestMySQLBackup(unittest.TestCase):
                                                  remote_path)
         self.assertIsNone(db_backup)
 
+    def _mock_sftp(self):
+        """Return a mock ssh client whose sftp serves self.remote_path"""
+
+        def readv(chunks):
+            with open(self.remote_path, mode='rb') as remote_test_file:
+                for offset, size in chunks:
+                    remote_test_file.seek(offset)
+                    yield remote_test_file.read(size)
+
+        ssh = mock.MagicMock()
+        sftp = ssh.open_sftp.return_value
+        sftp.stat.return_value.st_size = os.path.getsize(self.remote_path)
+        remote_file = sftp.open.return_value.__enter__.return_value
+        remote_file.readv.side_effect = readv
+        return ssh
+
     def test_get_backup_file(self):
         """
         Test that we get the database backup file via a
@@ -97,14 +133,67 @@ class TestMySQLBackup(unittest.TestCase):
         """
 
         mysql_backup.create_local_path(self.local_backup_dir)
-        remote_test_file = open(self.remote_path, mode='rb')
-        self.ssh = mock.MagicMock()
-        self.ssh.open_sftp.return_value.open.return_value = remote_test_file
+        self.ssh = self._mock_sftp()
+        local_path = mysql_backup.get_backup_file(self.ssh,
+                                                  self.local_backup_dir,
+                                                  self.remote_path,
+                                                  chunk_size=64, window=4)
+        self.assertEqual(self.local_path, local_path)
+        self.assertTrue(filecmp.cmp(self.remote_path, self.local_path,
+                                    shallow=False))
+        self.ssh.open_sftp.return_value.close.assert_called_once_with()
+
+    def test_get_backup_file_resume(self):
+        """
+        Test that an existing partial download is resumed from where
+        it stopped instead of being fetched again
+        """
+
+        mysql_backup.create_local_path(self.local_backup_dir)
+        with open(self.remote_path, mode='rb') as remote_test_file:
+            head = remote_test_file.read(100)
+        with open('{0}.part'.format(self.local_path), 'wb') as partial:
+            partial.write(head)
+        self.ssh = self._mock_sftp()
         mysql_backup.get_backup_file(self.ssh, self.local_backup_dir,
-                                     self.remote_path)
+                                     self.remote_path, chunk_size=64)
+        remote_file = self.ssh.open_sftp.return_value.open.return_value
+        chunks = remote_file.__enter__.return_value.readv.call_args[0][0]
+        self.assertEqual(100, chunks[0][0])
         self.assertTrue(filecmp.cmp(self.remote_path, self.local_path,
                                     shallow=False))
 
+    def test_stream_backup(self):
+        """
+        Test that the streamed dump is written to the local backup
+        directory chunk by chunk
+        """
+
+        mysql_backup.create_local_path(self.local_backup_dir)
+        chunks = [b'first chunk', b'second chunk', b'']
+        self.stdout.channel.recv.side_effect = chunks
+        self.stdout.channel.recv_exit_status.return_value = 0
+        db_backup = mysql_backup.stream_backup(self.ssh, 'test_database',
+                                               self.local_backup_dir)
+        with open(db_backup, 'rb') as backup_file:
+            self.assertEqual(b'first chunksecond chunk', backup_file.read())
+        self.assertEqual(
+            hashlib.sha256(b'first chunksecond chunk').hexdigest(),
+            mysql_backup.read_checksum(db_backup))
+
+    def test_stream_backup_negative(self):
+        """Test that a failed streamed dump leaves no partial local file"""
+
+        mysql_backup.create_local_path(self.local_backup_dir)
+        self.stdout.channel.recv.side_effect = [b'partial', b'']
+        self.stdout.channel.recv_exit_status.return_value = 2
+        error_msg = "mysqldump: Got error: 1049: Unknown database"
+        self.stderr.read.return_value.decode.return_value = error_msg
+        db_backup = mysql_backup.stream_backup(self.ssh, 'test_database',
+                                               self.local_backup_dir)
+        self.assertIsNone(db_backup)
+        self.assertEqual([], os.listdir(self.local_backup_dir))
+
     def test_remote_cleanup(self):
         """Test remote host cleanup with a mock object"""
 
@@ -123,13 +212,750 @@ class TestMySQLBackup(unittest.TestCase):
                                               self.remote_backup_dir)
         self.assertFalse(cleanup)
 
+    def test_load_inventory(self):
+        """Test that inventory lines expand to one job per database"""
+
+        inventory_path = os.path.join(os.getcwd(), 'tests', 'inventory')
+        with open(inventory_path, 'w') as inventory:
+            inventory.write('# server databases\n'
+                            'db1.example.com app_db audit_db\n'
+                            '\n'
+                            'db2.example.com  billing  # nightly\n')
+        try:
+            jobs = mysql_backup.load_inventory(inventory_path)
+        finally:
+            os.remove(inventory_path)
+        self.assertEqual([('db1.example.com', 'app_db'),
+                          ('db1.example.com', 'audit_db'),
+                          ('db2.example.com', 'billing')], jobs)
+
+    @mock.patch('mysql_backup.run_backup')
+    @mock.patch('mysql_backup.create_connection')
+    def test_run_fleet(self, create_connection, run_backup):
+        """
+        Test that a fleet run connects once per host and reports a result
+        for every job, including connection failures
+        """
+
+        def connect(hostname, username):
+            if hostname == 'down.example.com':
+                raise paramiko.ssh_exception.SSHException('timed out')
+            return mock.MagicMock()
+
+        create_connection.side_effect = connect
+        run_backup.side_effect = lambda ssh, db, *args, **kwargs: \
+            '/backups/' + db
+        jobs = [('db1.example.com', 'app_db'),
+                ('db1.example.com', 'audit_db'),
+                ('down.example.com', 'billing'),
+                ('down.example.com', 'orders')]
+        results = mysql_backup.run_fleet(jobs, self.local_backup_dir,
+                                         self.remote_backup_dir, workers=4)
+        self.assertEqual(2, create_connection.call_count)
+        self.assertEqual(['/backups/app_db', '/backups/audit_db', None, None],
+                         [result['path'] for result in results])
+        self.assertEqual(2, mysql_backup.log_fleet_summary(results))
+
+    @mock.patch('mysql_backup.create_connection')
+    def test_connection_pool_backoff(self, create_connection):
+        """
+        Test that a failed host is retried once its backoff has passed
+        and that a lost connection is replaced
+        """
+
+        lost = mock.MagicMock()
+        lost.get_transport.return_value.is_active.return_value = False
+        fresh = mock.MagicMock()
+        create_connection.side_effect = [
+            paramiko.ssh_exception.SSHException('timed out'), lost, fresh]
+        pool = mysql_backup.ConnectionPool('centos', keepalive=30,
+                                           backoff=(60, 600), timeout=5)
+        with mock.patch('time.monotonic', return_value=1000):
+            self.assertRaises(paramiko.ssh_exception.SSHException,
+                              pool.get, 'db1')
+            self.assertRaises(paramiko.ssh_exception.SSHException,
+                              pool.get, 'db1')
+        with mock.patch('time.monotonic', return_value=1061):
+            self.assertIs(lost, pool.get('db1'))
+            self.assertIs(fresh, pool.get('db1'))
+        self.assertEqual(3, create_connection.call_count)
+        create_connection.assert_called_with('db1', 'centos', 5)
+        fresh.get_transport.return_value.set_keepalive.assert_called_with(30)
+        lost.close.assert_called_once_with()
+
+    @mock.patch('mysql_backup.probe_transport')
+    @mock.patch('mysql_backup.create_connection')
+    def test_transport_tuner(self, create_connection, probe_transport):
+        """
+        Test that the fastest profile is cached per host and used with
+        the explicit settings on top
+        """
+
+        rates = {'default': 10e6, 'wide': 40e6, 'gcm-wide': 30e6,
+                 'compressed-wide': 20e6}
+        create_connection.side_effect = \
+            lambda hostname, username, timeout, transport: mock.MagicMock(
+                profile=transport)
+        probe_transport.side_effect = lambda ssh, size: rates[
+            [name for name, profile in mysql_backup.TUNE_PROFILES.items()
+             if profile == ssh.profile][0]]
+        mysql_backup.create_local_path(self.local_backup_dir)
+        cache_path = os.path.join(self.local_backup_dir, 'transport.json')
+        tuner = mysql_backup.TransportTuner(
+            cache_path, overrides={'compress': True}, auto_tune=True)
+        self.assertEqual(dict(mysql_backup.TUNE_PROFILES['wide'],
+                              compress=True), tuner.options('db1'))
+        self.assertEqual(4, create_connection.call_count)
+        self.assertEqual(
+            'wide', mysql_backup.load_transport_cache(cache_path)['db1']
+            ['profile'])
+        tuner.options('db1')
+        self.assertEqual(4, create_connection.call_count)
+        self.assertEqual({}, mysql_backup.TransportTuner(
+            cache_path).options('db2'))
+
+    def test_connect_options(self):
+        """Test that the transport prefers the given cipher and window"""
+
+        left, right = socket.socketpair()
+        try:
+            options = mysql_backup.connect_options(
+                {'ciphers': ['aes256-ctr', 'no-such-cipher'],
+                 'window_size': 16 * 1024 * 1024, 'compress': True})
+            transport = options['transport_factory'](left)
+            self.assertTrue(options['compress'])
+            self.assertEqual('aes256-ctr',
+                             transport.get_security_options().ciphers[0])
+            self.assertEqual(16 * 1024 * 1024,
+                             transport.default_window_size)
+        finally:
+            left.close()
+            right.close()
+
+    def test_connect_options_signature(self):
+        """
+        Test that SSHClient.connect of the installed paramiko accepts every
+        option connect_options returns
+        """
+
+        parameters = inspect.signature(paramiko.SSHClient.connect).parameters
+        for key in mysql_backup.connect_options({'compress': True}):
+            self.assertIn(key, parameters)
+
+    def test_next_run(self):
+        """
+        Test that daily jobs run at their next "at" time and interval
+        jobs an interval after their previous run
+        """
+
+        daily = {'at': (1, 30), 'interval': 86400}
+        hourly = {'at': None, 'interval': 3600}
+        now = mysql_backup.datetime(2024, 1, 1, 12, 0).timestamp()
+        base, due = mysql_backup.next_run(daily, None, now)
+        self.assertEqual(mysql_backup.datetime(2024, 1, 2, 1, 30),
+                         mysql_backup.datetime.fromtimestamp(base))
+        self.assertEqual((now, now),
+                         mysql_backup.next_run(hourly, None, now))
+        self.assertEqual((now + 3600, now + 3600),
+                         mysql_backup.next_run(hourly, now, now + 10))
+        base, due = mysql_backup.next_run(hourly, now, now, jitter=60)
+        self.assertTrue(base <= due <= base + 60)
+
+    @mock.patch('mysql_backup.run_fleet_job')
+    def test_daemon_requests(self, run_fleet_job):
+        """
+        Test that the control socket starts ad-hoc backups with the
+        scheduled job's options and reports their outcome
+        """
+
+        mysql_backup.create_local_path(self.local_backup_dir)
+        schedule_path = os.path.join(self.local_backup_dir, 'schedule.json')
+        socket_path = os.path.join(self.local_backup_dir, 'daemon.sock')
+        with open(schedule_path, 'w') as schedule_file:
+            json.dump({'defaults': {'codec': 'zstd'},
+                       'jobs': [{'server': 'db1', 'database': 'app',
+                                 'at': '01:30', 'stream': True}]},
+                      schedule_file)
+        run_fleet_job.return_value = {'path': '/backups/app', 'error': None,
+                                      'duration': 1.0, 'metrics': None}
+        daemon = mysql_backup.BackupDaemon(
+            mysql_backup.load_schedule(schedule_path), self.local_backup_dir,
+            self.remote_backup_dir, socket_path)
+        server = daemon.open_socket()
+        try:
+            started = mysql_backup.send_request(socket_path,
+                                                ['backup', 'db1', 'app'])
+            daemon.executor.shutdown(wait=True)
+            status = mysql_backup.send_request(socket_path, ['status'])
+            invalid = mysql_backup.send_request(socket_path, ['restore'])
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertTrue(started['ok'])
+        options = run_fleet_job.call_args[1]
+        self.assertTrue(options['stream'])
+        self.assertEqual('zstd', options['codec'].name)
+        self.assertEqual('/backups/app', status['jobs'][0]['last']['path'])
+        self.assertFalse(invalid['ok'])
+
+    def _per_table_paths(self):
+        mysql_backup.create_local_path(self.local_backup_dir)
+        return {name: os.path.join(self.local_backup_dir,
+                                   mysql_backup.table_filename(name))
+                for name in ('users', 'odd`name')}
+
+    def _read_tables(self, paths):
+        contents = {}
+        for name, path in paths.items():
+            with gzip.open(path, 'rb') as table_file:
+                contents[name] = table_file.read()
+            os.remove(path)
+        return contents
+
+    def test_table_splitter(self):
+        """
+        Test that a dump fed in small pieces is split into one file per
+        table, each starting with the dump header
+        """
+
+        paths = self._per_table_paths()
+        splitter = mysql_backup.TableSplitter(paths)
+        for i in range(0, len(DUMP), 7):
+            splitter.feed(DUMP[i:i + 7])
+        splitter.close()
+        contents = self._read_tables(paths)
+
+        header = b'-- MySQL dump 10.13\n/*!40101 SET NAMES utf8 */;\n\n--\n'
+        self.assertTrue(contents['users'].startswith(
+            header + b'-- Table structure for table `users`'))
+        self.assertIn(b"('-- Table structure for table `x`')",
+                      contents['users'])
+        self.assertTrue(contents['odd`name'].startswith(
+            header + b'-- Table structure for table `odd``name`'))
+        self.assertTrue(contents['odd`name'].endswith(b'-- Dump completed\n'))
+
+    def test_restore_archive(self):
+        """
+        Test that a backup file is split into its tables, each loaded on
+        its own channel, with the view definitions loaded last
+        """
+
+        mysql_backup.create_local_path(self.local_backup_dir)
+        path = os.path.join(self.local_backup_dir,
+                            'app-01-02-2024-03:04:05.sql.gz')
+        with gzip.open(path, 'wb') as archive:
+            archive.write(DUMP + b'\n--\n-- Final view structure for view '
+                                 b'`v`\n--\n\nCREATE VIEW `v` AS SELECT 1;\n')
+        lock = threading.Lock()
+        loads = []
+
+        def exec_command(command):
+            stdin, stdout = mock.MagicMock(), mock.MagicMock()
+            stdout.channel.recv_exit_status.return_value = 0
+            sent = bytearray()
+            stdin.channel.sendall.side_effect = sent.extend
+            with lock:
+                loads.append((command, sent))
+            return stdin, stdout, mock.MagicMock()
+
+        self.ssh.exec_command = mock.MagicMock(side_effect=exec_command)
+        self.assertTrue(mysql_backup.restore_archive(
+            self.ssh, path, jobs=2, spool_dir=self.local_backup_dir))
+        self.assertIn('CREATE DATABASE IF NOT EXISTS `app`', loads[0][0])
+        self.assertIn('gzip -dc | mysql app', loads[1][0])
+        sections = [gzip.decompress(bytes(sent)) for _, sent in loads[1:]]
+        self.assertEqual(3, len(sections))
+        self.assertIn(b'CREATE VIEW `v`', sections[-1])
+        tables = re.findall(rb'CREATE TABLE `[^(]+`', b''.join(sections[:2]))
+        self.assertEqual([b'CREATE TABLE `odd``name`',
+                          b'CREATE TABLE `users`'], sorted(tables))
+        for section in sections:
+            self.assertTrue(section.startswith(b'-- MySQL dump'))
+            self.assertNotIn(b'GTID_PURGED', section)
+        self.assertEqual([os.path.basename(path)],
+                         os.listdir(self.local_backup_dir))
+
+        del loads[:]
+        self.assertTrue(mysql_backup.restore_archive(
+            self.ssh, path, database='app`; DROP DATABASE x; --', jobs=2,
+            spool_dir=self.local_backup_dir))
+        self.assertEqual(['mysql', '-e', 'CREATE DATABASE IF NOT EXISTS '
+                          '`app``; DROP DATABASE x; --`'],
+                         shlex.split(loads[0][0])[1:])
+
+    def test_table_groups(self):
+        """Test that tables are balanced across groups by size"""
+
+        tables = [{'name': 'big', 'size': 100},
+                  {'name': 'medium', 'size': 60},
+                  {'name': 'small', 'size': 30},
+                  {'name': 'tiny', 'size': 10}]
+        groups = mysql_backup.table_groups(tables, 2)
+        self.assertEqual([['big'], ['medium', 'small', 'tiny']], groups)
+        self.assertEqual(1, len(mysql_backup.table_groups(tables[:1], 4)))
+
+    def test_dump_table_group(self):
+        """
+        Test that a grouped dump signals its transaction start and lands
+        in per-table files
+        """
+
+        paths = self._per_table_paths()
+        compressed = gzip.compress(DUMP)
+        self.stderr.__iter__.return_value = iter([
+            '-- Connecting to localhost...\n',
+            '-- Starting transaction...\n',
+            '-- Retrieving table structure for table users...\n'])
+        self.stdout.channel.recv.side_effect = [compressed[:50],
+                                                compressed[50:], b'']
+        self.stdout.channel.recv_exit_status.return_value = 0
+        started = threading.Event()
+        self.assertTrue(mysql_backup.dump_table_group(
+            self.ssh, 'test_database', ['users', 'odd`name'], paths,
+            started))
+        self.assertTrue(started.is_set())
+        self.assertIn("'odd`name'", self.ssh.exec_command.call_args[0][0])
+        contents = self._read_tables(paths)
+        self.assertIn(b'CREATE TABLE `users`', contents['users'])
+
+    def test_main_defaults_to_backup(self):
+        """Test that the original command line still runs a backup"""
+
+        with mock.patch('mysql_backup.create_connection') as connect, \
+                mock.patch('mysql_backup.run_backup') as run_backup:
+            mysql_backup.main(['--server', 'db1', '--database', 'app_db'])
+        self.assertEqual(('db1', mysql_backup.SSH_USER),
+                         connect.call_args[0])
+        self.assertEqual('app_db', run_backup.call_args[0][1])
+
+    def test_read_dump_coordinates(self):
+        """Test that binlog coordinates are read from the dump header"""
+
+        mysql_backup.create_local_path(self.local_backup_dir)
+        with gzip.open(self.local_path, 'wb') as dump:
+            dump.write(b"-- MySQL dump 10.13\n--\n"
+                       b"-- CHANGE MASTER TO MASTER_LOG_FILE='mysql-bin."
+                       b"000042', MASTER_LOG_POS=1337;\n")
+        coordinates = mysql_backup.read_dump_coordinates(self.local_path)
+        self.assertEqual({'binlog_file': 'mysql-bin.000042',
+                          'binlog_position': 1337}, coordinates)
+
+    def test_incremental_chain(self):
+        """
+        Test that the chain starts at the latest usable full backup and
+        only holds increments taken on top of it
+        """
+
+        mysql_backup.create_local_path(self.local_backup_dir)
+        catalog_path = os.path.join(self.local_backup_dir,
+                                    mysql_backup.CATALOG)
+        end = {'binlog_file': 'mysql-bin.000001', 'binlog_position': 4}
+        entries = [
+            {'type': 'full', 'database': 'app', 'path': 'full-1', 'end': end},
+            {'type': 'incremental', 'database': 'app', 'path': 'inc-1',
+             'base': 'full-1', 'end': end},
+            {'type': 'full', 'database': 'app', 'path': 'full-2', 'end': end},
+            {'type': 'full', 'database': 'other', 'path': 'full-3',
+             'end': end},
+            {'type': 'incremental', 'database': 'app', 'path': 'inc-2',
+             'base': 'full-2', 'end': end},
+        ]
+        for entry in entries:
+            mysql_backup.append_catalog(catalog_path, entry)
+        chain = mysql_backup.incremental_chain(catalog_path, 'app')
+        os.remove(catalog_path)
+        self.assertEqual(['full-2', 'inc-2'],
+                         [entry['path'] for entry in chain])
+
+    def test_latest_backup(self):
+        """
+        Test that the newest backup of the database and server is found
+        """
+
+        mysql_backup.create_local_path(self.local_backup_dir)
+        catalog_path = os.path.join(self.local_backup_dir,
+                                    mysql_backup.CATALOG)
+        for time, server, path in (('2024-01-02T00:00:00', 'db1', 'new'),
+                                   ('2024-01-01T00:00:00', 'db1', 'old'),
+                                   ('2024-01-03T00:00:00', 'db2', 'other')):
+            mysql_backup.append_catalog(catalog_path, {
+                'type': 'full', 'database': 'app', 'server': server,
+                'path': path, 'time': time})
+        latest = mysql_backup.latest_backup(catalog_path, 'app', 'db1')
+        missing = mysql_backup.latest_backup(catalog_path, 'missing')
+        self.assertEqual('new', latest['path'])
+        self.assertIsNone(missing)
+
+    def test_prune_catalog(self):
+        """
+        Test that pruning keeps the newest backup of the recent days and
+        weeks, with their increments, and deletes the rest
+        """
+
+        mysql_backup.create_local_path(self.local_backup_dir)
+        catalog_path = os.path.join(self.local_backup_dir,
+                                    mysql_backup.CATALOG)
+        backups = [('2024-01-01T01:00:00', 'full', None),
+                   ('2024-01-08T01:00:00', 'full', None),
+                   ('2024-01-09T01:00:00', 'full', None),
+                   ('2024-01-10T01:00:00', 'full', None),
+                   ('2024-01-10T02:00:00', 'incremental', 3),
+                   ('2024-01-10T03:00:00', 'full', None),
+                   ('2024-01-10T04:00:00', 'incremental', 5)]
+        paths = []
+        for time, backup_type, base in backups:
+            path = os.path.join(self.local_backup_dir, time)
+            with open(path, 'w') as backup:
+                backup.write(time)
+            paths.append(path)
+            entry = {'type': backup_type, 'database': 'app', 'path': path,
+                     'time': time}
+            if base is not None:
+                entry['base'] = paths[base]
+            mysql_backup.append_catalog(catalog_path, entry)
+
+        pruned = mysql_backup.prune_catalog(catalog_path, 2, 2)
+        kept = [entry['path'] for entry in
+                mysql_backup.read_catalog(catalog_path)]
+        self.assertEqual([paths[1], paths[3], paths[4]],
+                         sorted(entry['path'] for entry in pruned))
+        self.assertEqual([paths[0], paths[2], paths[5], paths[6]], kept)
+        self.assertEqual([os.path.basename(path) for path in kept],
+                         sorted(name for name in
+                                os.listdir(self.local_backup_dir)
+                                if name.startswith('2024')))
+
+    def test_run_incremental(self):
+        """
+        Test that an incremental run fetches the closed binlogs from the
+        previous end coordinates and records the increment
+        """
+
+        mysql_backup.create_local_path(self.local_backup_dir)
+        catalog_path = os.path.join(self.local_backup_dir,
+                                    mysql_backup.CATALOG)
+        mysql_backup.append_catalog(catalog_path, {
+            'type': 'full', 'database': 'app', 'path': 'full-1',
+            'end': {'binlog_file': 'mysql-bin.000002',
+                    'binlog_position': 120}})
+        self.stdout.read.return_value = (b'/var/lib/mysql/mysql-bin\n'
+                                         b'mysql-bin.000001\t177\n'
+                                         b'mysql-bin.000002\t4096\n'
+                                         b'mysql-bin.000003\t8192\n'
+                                         b'mysql-bin.000004\t155\n')
+        self.stdout.channel.recv_exit_status.return_value = 0
+
+        with mock.patch('mysql_backup.stream_command') as stream_command:
+            stream_command.return_value = True
+            backup_dir = mysql_backup.run_backup(
+                self.ssh, 'app', self.local_backup_dir, self.remote_backup_dir,
+                incremental=True)
+        chain = mysql_backup.incremental_chain(catalog_path, 'app')
+        os.remove(catalog_path)
+        os.rmdir(backup_dir)
+        fetched = [call[0][1] for call in stream_command.call_args_list]
+        self.assertEqual(
+            ["sudo bash -c 'set -o pipefail; cat /var/lib/mysql/"
+             "mysql-bin.000002 | gzip -c'",
+             "sudo bash -c 'set -o pipefail; cat /var/lib/mysql/"
+             "mysql-bin.000003 | gzip -c'"], fetched)
+        self.assertEqual(backup_dir, chain[-1]['path'])
+        self.assertEqual('full-1', chain[-1]['base'])
+        self.assertEqual(120, chain[-1]['start']['binlog_position'])
+        self.assertEqual('mysql-bin.000004', chain[-1]['end']['binlog_file'])
+
+    def _synthetic_dump(self, rows):
+        statements = []
+        for i in range(0, len(rows), 500):
+            statements.append(b'INSERT INTO `t` VALUES ' +
+                              b','.join(rows[i:i + 500]) + b';\n')
+        return b''.join(statements)
+
+    def test_chunker(self):
+        """
+        Test that chunking is lossless and that inserting a row only
+        changes the chunks around it
+        """
+
+        rows = [b"(%d,'user-%d')" % (i, i * 7919 % 100003)
+                for i in range(50000)]
+        original = self._synthetic_dump(rows)
+        rows.insert(100, b"(0,'inserted')")
+        changed = self._synthetic_dump(rows)
+
+        def chunks(data):
+            chunker = mysql_backup.Chunker(min_size=1024, max_size=16384)
+            result = []
+            for i in range(0, len(data), 10000):
+                result.extend(chunker.feed(data[i:i + 10000]))
+            result.extend(chunker.flush())
+            return result
+
+        original_chunks = chunks(original)
+        changed_chunks = chunks(changed)
+        self.assertEqual(original, b''.join(original_chunks))
+        self.assertEqual(changed, b''.join(changed_chunks))
+        self.assertTrue(all(len(chunk) <= 16384 for chunk in changed_chunks))
+        new = set(changed_chunks) - set(original_chunks)
+        self.assertLess(len(new), len(changed_chunks) / 4)
+
+    def test_chunk_store(self):
+        """
+        Test that a backup is rebuilt from the repository and that storing
+        the same dump again adds no new chunks
+        """
+
+        repository = os.path.join(os.getcwd(), 'tests', 'repository')
+        self.addCleanup(shutil.rmtree, repository)
+        dump = self._synthetic_dump([b"(%d,'row')" % i for i in range(20000)])
+        store = mysql_backup.ChunkStore(repository)
+        for name in ('app-1', 'app-2'):
+            writer = store.writer(name, 'app')
+            writer.write(dump[:12345])
+            writer.write(dump[12345:])
+            writer.close()
+
+        store = mysql_backup.ChunkStore(repository)
+        self.assertEqual(['app-1', 'app-2'], store.backups())
+        self.assertEqual(dump, b''.join(store.read('app-2')))
+        packs = os.listdir(os.path.join(repository, 'packs'))
+        self.assertEqual(1, len(packs))
+
+    def test_stream_to_repository_negative(self):
+        """Test that a failed dump leaves no backup in the repository"""
+
+        repository = os.path.join(os.getcwd(), 'tests', 'repository')
+        self.addCleanup(shutil.rmtree, repository)
+        self.stdout.channel.recv.side_effect = [gzip.compress(b'partial'),
+                                                b'']
+        self.stdout.channel.recv_exit_status.return_value = 2
+        self.stderr.read.return_value.decode.return_value = 'access denied'
+        name = mysql_backup.stream_to_repository(self.ssh, 'app', repository)
+        self.assertIsNone(name)
+        self.assertEqual([], os.listdir(os.path.join(repository, 'packs')))
+        self.assertEqual([], mysql_backup.ChunkStore(repository).backups())
+
+    def test_dump_commands_quote_database(self):
+        """
+        Test that the database name reaches the remote mysqldump as one
+        argument
+        """
+
+        repository = os.path.join(os.getcwd(), 'tests', 'repository')
+        self.addCleanup(shutil.rmtree, repository)
+        mysql_backup.create_local_path(self.local_backup_dir)
+        self.stdout.channel.recv.return_value = b''
+        self.stdout.channel.recv_exit_status.return_value = 2
+        self.stderr.read.return_value.decode.return_value = 'unknown database'
+        mysql_backup.stream_backup(self.ssh, 'app; id', self.local_backup_dir)
+        mysql_backup.stream_to_repository(self.ssh, 'app; id', repository)
+        for call in self.ssh.exec_command.call_args_list:
+            script = shlex.split(call[0][0])[-1]
+            self.assertIn("mysqldump 'app; id'", script)
+
+    def test_list_tables(self):
+        """Test that the database name is quoted in the table query"""
+
+        self.stdout.read.return_value = b'orders\tBASE TABLE\t16384\n'
+        self.stdout.channel.recv_exit_status.return_value = 0
+        tables = mysql_backup.list_tables(self.ssh, "o'brien\\db")
+        self.assertEqual([{'name': 'orders', 'type': 'BASE TABLE',
+                           'size': 16384}], tables)
+        query = shlex.split(self.ssh.exec_command.call_args[0][0])[-1]
+        self.assertIn("table_schema = 'o''brien\\\\db' ", query)
+
+    def test_codec_commands(self):
+        """Test the command lines built for each codec"""
+
+        self.assertEqual('gzip -c', mysql_backup.Codec().compress_command())
+        self.assertEqual('pigz -9 -p 4 -c', mysql_backup.Codec(
+            'pigz', 9, 4).compress_command())
+        self.assertEqual('zstd -q -3 -T0 -c', mysql_backup.Codec(
+            'zstd', 3).compress_command())
+        self.assertIsNone(mysql_backup.Codec('none').compress_command())
+        self.assertEqual('lz4 -q -dc',
+                         mysql_backup.Codec('lz4').decompress_command())
+
+    def test_codec_detect(self):
+        """Test that the codec is detected from the file header"""
+
+        self.assertEqual('gzip',
+                         mysql_backup.Codec.detect(self.remote_path).name)
+        plain = os.path.join(os.getcwd(), 'tests', 'sql-files',
+                             'test-backup.sql')
+        self.assertEqual('none', mysql_backup.Codec.detect(plain).name)
+
+    def test_stream_backup_compress_local(self):
+        """
+        Test that with compression on the local host the remote dump is
+        sent uncompressed and compressed before it is written
+        """
+
+        mysql_backup.create_local_path(self.local_backup_dir)
+        self.stdout.channel.recv.side_effect = [b'CREATE TABLE t;\n', b'']
+        self.stdout.channel.recv_exit_status.return_value = 0
+        db_backup = mysql_backup.stream_backup(
+            self.ssh, 'test_database', self.local_backup_dir,
+            codec=mysql_backup.Codec('gzip', 1), compress_on='local')
+        with gzip.open(db_backup, 'rb') as backup_file:
+            self.assertEqual(b'CREATE TABLE t;\n', backup_file.read())
+        self.assertIsNone(mysql_backup.verify_file(
+            db_backup + mysql_backup.CHECKSUM_SUFFIX)[1])
+        self.assertNotIn('gzip', self.ssh.exec_command.call_args[0][0])
+
+    def test_backup_script(self):
+        """
+        Test that compression is part of the remote script only when it
+        runs on the remote host
+        """
+
+        script, path = mysql_backup.backup_script('app', '/tmp/backups')
+        self.assertIn('run compress', script)
+        self.assertTrue(path.endswith('.sql.gz'))
+        script, path = mysql_backup.backup_script('app', '/tmp/backups',
+                                                  compress_on='local')
+        self.assertNotIn('run compress', script)
+        self.assertTrue(path.endswith('.sql'))
+
+    @mock.patch('mysql_backup.get_backup_file')
+    def test_run_remote_backup(self, get_backup_file):
+        """
+        Test that one channel carries every remote step and that the
+        file is only cleaned up after a successful download
+        """
+
+        self.stdin = mock.MagicMock()
+        self.ssh.exec_command.return_value = (self.stdin, self.stdout,
+                                              self.stderr)
+        self.stdout.__iter__.return_value = iter([
+            'STEP mkdir 0 3 4096\n', 'STEP dump 0 1500 2048000\n',
+            'STEP compress 0 900 512000\n', 'DIGEST 5e2bf57d\n',
+            'READY /tmp/x.sql.gz\n', 'STEP cleanup 0 2 0\n'])
+        self.stdout.channel.recv_exit_status.return_value = 0
+        get_backup_file.return_value = '/backups/x.sql.gz'
+
+        with mock.patch('mysql_backup.read_checksum') as read_checksum:
+            read_checksum.return_value = '5e2bf57d'
+            local_backup, steps = mysql_backup.run_remote_backup(
+                self.ssh, 'app', '/backups', self.remote_backup_dir)
+        self.assertEqual('/backups/x.sql.gz', local_backup)
+        self.assertEqual(1, self.ssh.exec_command.call_count)
+        self.stdin.write.assert_called_once_with('cleanup\n')
+        self.assertEqual(['mkdir', 'dump', 'compress', 'cleanup'],
+                         [step['name'] for step in steps])
+        self.assertEqual({'name': 'dump', 'exit_status': 0, 'elapsed': 1.5,
+                          'bytes': 2048000}, steps[1])
+
+    @mock.patch('mysql_backup.time.sleep')
+    @mock.patch('mysql_backup.get_backup_file')
+    def test_run_remote_backup_retry(self, get_backup_file, sleep):
+        """
+        Test that a failed download is retried and that the remote file
+        is cleaned up once the attempts run out
+        """
+
+        self.stdin = mock.MagicMock()
+        self.ssh.exec_command.return_value = (self.stdin, self.stdout,
+                                              self.stderr)
+        self.stdout.channel.recv_exit_status.return_value = 0
+        lines = ['STEP mkdir 0 3 4096\n', 'DIGEST 5e2bf57d\n',
+                 'READY /tmp/x.sql.gz\n']
+
+        self.stdout.__iter__.return_value = iter(lines)
+        get_backup_file.side_effect = [None, '/backups/x.sql.gz']
+        with mock.patch('mysql_backup.read_checksum') as read_checksum:
+            read_checksum.return_value = '5e2bf57d'
+            local_backup, _ = mysql_backup.run_remote_backup(
+                self.ssh, 'app', '/backups', self.remote_backup_dir)
+        self.assertEqual('/backups/x.sql.gz', local_backup)
+        self.assertEqual(2, get_backup_file.call_count)
+
+        self.stdin.reset_mock()
+        get_backup_file.reset_mock()
+        self.stdout.__iter__.return_value = iter(lines)
+        get_backup_file.side_effect = None
+        get_backup_file.return_value = None
+        local_backup, _ = mysql_backup.run_remote_backup(
+            self.ssh, 'app', '/backups', self.remote_backup_dir, attempts=3)
+        self.assertIsNone(local_backup)
+        self.assertEqual(3, get_backup_file.call_count)
+        self.stdin.write.assert_called_once_with('cleanup\n')
+
+    @mock.patch('mysql_backup.get_backup_file')
+    def test_run_remote_backup_negative(self, get_backup_file):
+        """Test that a failed remote step stops before any download"""
+
+        self.stdout.__iter__.return_value = iter([
+            'STEP mkdir 0 3 4096\n', 'STEP dump 2 10 0\n',
+            'ERROR mysqldump: Got error: 1049: Unknown database\n'])
+        self.stdout.channel.recv_exit_status.return_value = 2
+        local_backup, steps = mysql_backup.run_remote_backup(
+            self.ssh, 'app', '/backups', self.remote_backup_dir)
+        self.assertIsNone(local_backup)
+        self.assertEqual(2, steps[-1]['exit_status'])
+        get_backup_file.assert_not_called()
+
+    def test_verify_backups(self):
+        """Test that verify reports corrupt and missing backup files"""
+
+        for name in ('good', 'corrupt', 'missing'):
+            path = os.path.join(self.local_backup_dir, 'app', name)
+            mysql_backup.create_local_path(os.path.dirname(path))
+            with open(path, 'wb') as backup_file:
+                backup_file.write(b'backup data')
+            mysql_backup.write_checksum(
+                path, hashlib.sha256(b'backup data').hexdigest())
+        with open(os.path.join(self.local_backup_dir, 'app', 'corrupt'),
+                  'ab') as backup_file:
+            backup_file.write(b'!')
+        os.remove(os.path.join(self.local_backup_dir, 'app', 'missing'))
+
+        results = dict(mysql_backup.verify_backups(self.local_backup_dir,
+                                                   jobs=2))
+        errors = {os.path.basename(path): error
+                  for path, error in results.items()}
+        self.assertIsNone(errors['good'])
+        self.assertEqual('checksum mismatch', errors['corrupt'])
+        self.assertIn('No such file', errors['missing'])
+
+    def test_backup_metrics(self):
+        """
+        Test that stage metrics derive throughput and compression ratio
+        and are written as JSON lines and Prometheus text
+        """
+
+        metrics = mysql_backup.BackupMetrics('db1', 'app')
+        metrics.add('dump', 2.0, bytes_out=8000000)
+        metrics.add('compress', 1.0, bytes_in=8000000, bytes_out=2000000)
+        with metrics.stage('transfer') as stage:
+            stage['bytes_out'] = 2000000
+        metrics.success = True
+
+        self.assertEqual(4.0, metrics.stages[0]['mb_per_s'])
+        self.assertEqual(4.0, metrics.stages[1]['ratio'])
+        self.assertEqual('transfer', metrics.stages[2]['stage'])
+
+        mysql_backup.create_local_path(self.local_backup_dir)
+        jsonl_path = os.path.join(self.local_backup_dir, 'metrics.jsonl')
+        prom_path = os.path.join(self.local_backup_dir, 'backup.prom')
+        mysql_backup.write_metrics(jsonl_path, [metrics])
+        mysql_backup.write_prometheus(prom_path, [metrics])
+        with open(jsonl_path) as jsonl_file:
+            job = json.loads(jsonl_file.readline())
+        self.assertEqual(['dump', 'compress', 'transfer'],
+                         [stage['stage'] for stage in job['stages']])
+        with open(prom_path) as prom_file:
+            prometheus = prom_file.read()
+        self.assertIn('mysql_backup_success{server="db1",database="app"} 1',
+                      prometheus)
+        self.assertIn('mysql_backup_stage_bytes{server="db1",database="app",'
+                      'stage="compress",direction="in"} 8000000', prometheus)
+
     def tearDown(self):
         """Clean up leftover resources"""
 
         if os.path.exists(self.local_backup_dir):
-            if os.path.exists(self.local_path):
-                os.remove(self.local_path)
-            os.rmdir(self.local_backup_dir)
+            shutil.rmtree(self.local_backup_dir)
 
 
 if __name__ == '__main__':